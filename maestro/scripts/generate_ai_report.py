@@ -5,13 +5,95 @@ Maestro AI Test Report Generator
 This script takes Maestro test results in JSON format and generates an enhanced
 report with AI-powered insights on the UI and user experience.
 
+The results file is Maestro's command output (e.g. commands-(flow).json): the
+screenshots taken by takeScreenshot steps are located from it, along with each
+step's status and duration. Pass --walk-screenshots to scan .maestro/screenshots
+next to the results file instead.
+
+Each run writes a manifest (maestro_report_manifest.json in the output directory)
+recording every screenshot's hashes, metadata and analysis. Later runs reuse the
+entries of unchanged screenshots, and --rebuild-from-manifest regenerates the
+HTML from it without touching images or the API.
+
+Screenshots are shown as lazily loaded thumbnails (written to thumbnails/ in the
+output directory and named by content hash, so unchanged frames are not
+re-rendered) that link to the full-size image. --bundle additionally packs the
+report, thumbnails and screenshots into one zip for artifact upload.
+
+--baseline-dir compares each screenshot pixel by pixel (NumPy) with the file of
+the same name in a baseline directory, writes diff heatmaps to diffs/ and only
+sends frames that changed (or have no baseline) for AI analysis. Byte-identical
+frames are skipped by hash; any other pair costs roughly 75 ms per 1080p frame on
+one core, two thirds of it decoding the PNGs (so about 15 s for 200 frames).
+Comparisons run on --max-workers threads, which scales with cores.
+
+--videos adds keyframes from screen recordings (e.g. maestro_videos/): frames
+are streamed out of ffmpeg at --video-fps, and a frame is kept once the screen
+has changed and settled again, so flows need no explicit screenshot steps.
+
+--analyzer picks the analysis backend: "remote" (default) calls the chat
+completions endpoint, "heuristic" inspects layout and contrast locally with
+Pillow, and "stub" starts a bundled local model server that answers
+deterministically; the last two need no network or API key.
+
+The bench subcommand synthesizes runs of N screenshots, times each stage
+(parsing, metadata, encoding, analysis against the stub server, HTML) and the
+whole report, and records peak RSS per N. Each N runs --repeat times;
+--baseline fails the run only when even the fastest run of a stage is slower
+than the median of a previous --json result by more than the tolerance, the
+noise floor and the spread between runs. "bench --imports" guards start-up
+time instead: heavy dependencies are imported on first use, and it fails when
+importing the module exceeds its budget, prints, or loads one of them.
+
+--trace-jsonl / --trace-chrome record a span (start, duration, bytes, items)
+for every stage: finding and parsing results, metadata, encoding, API calls,
+analysis, HTML writing and the optional stages. JSON lines suit scripts; the
+Chrome trace-event file opens in chrome://tracing or Perfetto. A per-stage
+summary is printed, and --trace-in-report also embeds it in the HTML.
+
+--queue runs the report as a resumable job: per-screenshot state lives in a
+SQLite work queue, so an interrupted run picks up where it stopped, failed
+screenshots are only analysed again after "job retry", and --job-workers (or
+extra "job work" processes on the same machine) pull from the same queue.
+
+--aggregate reads many results files (directories and/or globs) in parallel
+worker processes and writes one trend report with per-flow pass rates and run
+duration percentiles instead of a screenshot report.
+
+Both reports include step timing: per-command latency percentiles and the
+slowest steps; the trend report also lists flaky steps (the same step of a
+flow both passing and failing across runs).
+
 Usage:
   python generate_ai_report.py test-results.json
+  python generate_ai_report.py test-results.json --walk-screenshots
+  python generate_ai_report.py test-results.json --max-workers 8
+  python generate_ai_report.py test-results.json --no-cache
+  python generate_ai_report.py test-results.json --dedup --dedup-distance 4
+  python generate_ai_report.py test-results.json --max-dimension 768 --upload-format webp
+  python generate_ai_report.py test-results.json --rate-limit 2 --max-retries 5
+  python generate_ai_report.py test-results.json --batch-size 6
+  python generate_ai_report.py --rebuild-from-manifest -o reports/
+  python generate_ai_report.py test-results.json --thumbnail-size 240 --bundle
+  python generate_ai_report.py test-results.json --baseline-dir baseline_screenshots/
+  python generate_ai_report.py test-results.json --videos maestro_videos/ --video-fps 4
+  python generate_ai_report.py test-results.json --analyzer heuristic
+  python generate_ai_report.py test-results.json --analyzer stub --stub-latency 0.5
+  python generate_ai_report.py bench --counts 10 100 500 --json bench.json
+  python generate_ai_report.py bench --counts 10 100 500 --repeat 5 --baseline bench.json
+  python generate_ai_report.py bench --imports
+  python generate_ai_report.py test-results.json --trace-chrome trace.json --trace-in-report
+  python generate_ai_report.py test-results.json --queue report-job.sqlite --job-workers 4
+  python generate_ai_report.py job status report-job.sqlite
+  python generate_ai_report.py job retry report-job.sqlite screen_042.png
+  python generate_ai_report.py --aggregate ci-results/ "nightly/**/commands-*.json"
 
 Requirements:
   - Python 3.6+
   - OpenAI API key (set as environment variable OPENAI_API_KEY)
   - Pillow library (PIL)
+  - NumPy (only for --baseline-dir)
+  - ffmpeg on PATH (only for --videos)
   - requests
 
 Note: This is a simplified demo script. In a production environment, you'd want
@@ -19,175 +101,2808 @@ more robust error handling and configuration options.
 """
 
 import argparse
+import contextlib
+import glob
+import hashlib
+import importlib.util
+import io
 import json
+import math
 import os
+import random
+import re
+import shutil
+import struct
+import subprocess
 import sys
-from datetime import datetime
+import tempfile
+import threading
+import time
+import zipfile
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import base64
 from pathlib import Path
 
-# Check for optional dependencies - if not available, provide fallback functionality
-try:
-    from PIL import Image
+# Check for optional dependencies - if not available, provide fallback functionality.
+# They are only looked up here; each is imported where it is first used, so
+# importing this module (or running --help) stays fast and prints nothing.
+# Pillow is only imported when a screenshot actually needs it (EXIF or an unknown format).
+HAS_PIL = importlib.util.find_spec("PIL") is not None
+# NumPy is only needed for baseline comparison
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+# requests is imported when the first AIClient is created
+HAS_REQUESTS = importlib.util.find_spec("requests") is not None
+
+# Chat completions endpoint; override with OPENAI_API_URL (or --api-url) to
+# point the script at a proxy or a local stub server.
+DEFAULT_API_URL = "https://api.openai.com/v1/chat/completions"
+DEFAULT_MODEL = "gpt-4-vision-preview"
+ANALYSIS_PROMPT = (
+    "Analyze this mobile app UI screenshot. Identify UI elements, layout structure, "
+    "and point out any potential UX issues or improvements."
+)
+BATCH_ANALYSIS_PROMPT = (
+    "These are {count} consecutive screenshots from one mobile app UI test flow, in order. "
+    "For each screenshot, identify UI elements, layout structure and potential UX issues, "
+    "and note how it follows from the previous screen. Respond only with a JSON array of "
+    "{count} objects of the form {{\"screenshot\": <number>, \"analysis\": \"<text>\"}}."
+)
+MAX_TOKENS_PER_IMAGE = 300
+SCREENSHOT_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MAESTRO_PASSED_STATUSES = ("COMPLETED", "WARNED")
+
+# Maestro names its command output commands-(<flow file>).json
+MAESTRO_COMMANDS_FILE = re.compile(r"commands-\((.+)\)\.json$")
+# Results files handed to each worker process per task when aggregating
+AGGREGATE_CHUNK_SIZE = 256
+REPORT_PERCENTILES = (50, 95, 99)
+# Rows shown in the slowest-steps and flaky-steps tables
+TOP_STEPS_LIMIT = 10
+
+# Per-run manifest of screenshot hashes, metadata and analyses, kept next to the reports
+MANIFEST_FILENAME = "maestro_report_manifest.json"
+MANIFEST_VERSION = 1
+
+# Analyses are cached by image content, so unchanged frames are never re-sent
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "maestro_ai_report",
+)
+CACHE_MAX_BYTES = 100 * 1024 * 1024
+CACHE_MAX_AGE_DAYS = 30
+
+# dHash size (bits per side) and the default Hamming distance for near-duplicates
+DHASH_SIZE = 8
+DEFAULT_DEDUP_DISTANCE = 5
+
+# Screenshots are shrunk and re-encoded before upload; the vision model gains
+# nothing from full device resolution
+DEFAULT_MAX_DIMENSION = 1024
+DEFAULT_UPLOAD_FORMAT = "JPEG"
+DEFAULT_UPLOAD_QUALITY = 85
+UPLOAD_FORMATS = ("JPEG", "WEBP")
+
+# Report thumbnails: longest side in pixels, JPEG quality, directory under the output dir
+DEFAULT_THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 75
+THUMBNAIL_DIR = "thumbnails"
+# Directory holding the full-size screenshots inside a --bundle archive
+BUNDLE_SCREENSHOT_DIR = "screenshots"
+# src/href attributes of the report, relinked in its --bundle copy
+LINK_ATTRIBUTE = re.compile(rb'\b(src|href)="([^"]*)"')
+
+# Baseline comparison: a pixel counts as changed when a channel differs by more
+# than the tolerance; a frame is unchanged while this fraction of pixels match
+DIFF_PIXEL_TOLERANCE = 16
+DEFAULT_BASELINE_THRESHOLD = 0.999
+DIFF_DIR = "diffs"
+DIFF_HEATMAP_SIZE = 640
+
+# Keyframes from screen recordings: sampling rate, frame width, the dHash distance
+# from the last keyframe that counts as a new screen, and the distance between
+# consecutive samples below which the screen has settled
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm")
+DEFAULT_VIDEO_FPS = 2.0
+VIDEO_FRAME_WIDTH = 540
+DEFAULT_SCENE_THRESHOLD = 10
+SCENE_STABLE_DISTANCE = 2
+DEFAULT_MAX_KEYFRAMES = 30
+KEYFRAME_DIR = "keyframes"
+
+# Analysis backends selectable with --analyzer
+ANALYZERS = ("remote", "heuristic", "stub")
+# Heuristic analyzer: working size, and the thresholds behind its findings
+HEURISTIC_SIZE = 256
+HEURISTIC_COLORS = 8
+HEURISTIC_MIN_COLOR_SHARE = 0.005
+HEURISTIC_BLANK_STDDEV = 4.0
+HEURISTIC_EDGE_LEVEL = 32
+HEURISTIC_BUSY_EDGES = 0.25
+HEURISTIC_SPARSE_EDGES = 0.02
+WCAG_AA_CONTRAST = 4.5
+
+# bench subcommand defaults
+BENCH_COUNTS = (10, 50, 200)
+BENCH_SIZE = "1080x2400"
+BENCH_STAGES = ("parse", "metadata", "encode", "analysis", "html", "report")
+BENCH_TOLERANCE = 0.25
+# Each N is run this many times; the gate compares the fastest run against the baseline's median
+BENCH_REPEAT = 3
+# Stage slowdowns smaller than this many seconds, or than the stage's own spread across runs,
+# are treated as noise
+BENCH_NOISE_SECONDS = 0.05
+
+# Modules that must not be loaded by importing this script (bench --imports)
+DEFERRED_IMPORTS = ("requests", "PIL", "numpy", "http.server", "multiprocessing", "sqlite3", "email.utils")
+# Import-time budget for this module, in milliseconds
+IMPORT_TIME_BUDGET_MS = 50
+
+# Job queue (--queue): seconds before a claimed screenshot may be handed to another worker
+JOB_LEASE_SECONDS = 900
+# Analysis statuses a job keeps as done; errors fail, anything else (skipped) stays pending
+JOB_DONE_STATUSES = ("success", "duplicate", "unchanged")
+
+# HTTP behaviour of AI calls
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_RETRIES = 3
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Retry-After is honoured beyond BACKOFF_MAX up to this; longer waits are treated as bogus
+RETRY_AFTER_MAX = 600.0
+
+# Batch mode packs several screenshots into one request, up to this much base64 image data
+DEFAULT_BATCH_MAX_BYTES = 10 * 1024 * 1024
+
+class Span:
+    """One timed stage; add() accumulates counters such as bytes and items."""
+    
+    __slots__ = ("name", "attrs", "thread", "start_ns", "end_ns")
+    
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.thread = threading.current_thread().name
+        self.start_ns = self.end_ns = 0
+    
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+class _NullSpan:
+    __slots__ = ()
+    
+    def add(self, **counts):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Tracer:
+    """
+    Collects spans from every thread of a report run.
+    
+    Exports them as JSON lines or Chrome trace events and summarises them per
+    stage. Stages running on worker threads overlap, so per-stage totals can
+    exceed the wall-clock time of the run.
+    """
+    
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.origin_ns = time.perf_counter_ns()
+    
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        span = Span(name, attrs)
+        span.start_ns = time.perf_counter_ns()
+        try:
+            yield span
+        finally:
+            span.end_ns = time.perf_counter_ns()
+            with self.lock:
+                self.spans.append(span)
+    
+    def _records(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        for span in spans:
+            yield span, (span.start_ns - self.origin_ns) / 1000, (span.end_ns - span.start_ns) / 1000
+    
+    def write_jsonl(self, path):
+        """One JSON object per span: name, start_us, duration_us, thread and its counters."""
+        with open(path, "w", encoding="utf-8") as f:
+            for span, start_us, duration_us in self._records():
+                f.write(json.dumps(dict(span.attrs, name=span.name, start_us=round(start_us, 1),
+                                        duration_us=round(duration_us, 1), thread=span.thread)) + "\n")
+    
+    def write_chrome_trace(self, path):
+        """Chrome trace-event JSON (complete "X" events plus thread names)."""
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+        for span, start_us, duration_us in self._records():
+            if span.thread not in thread_ids:
+                thread_ids[span.thread] = len(thread_ids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": pid,
+                               "tid": thread_ids[span.thread], "args": {"name": span.thread}})
+            events.append({"name": span.name, "cat": "report", "ph": "X", "ts": start_us,
+                           "dur": duration_us, "pid": pid, "tid": thread_ids[span.thread],
+                           "args": span.attrs})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    
+    def summary(self):
+        """Per stage: count, total_s, mean_ms, max_ms, bytes and items; slowest total first."""
+        stages = {}
+        for span, _, duration_us in self._records():
+            stage = stages.setdefault(span.name, {"stage": span.name, "count": 0, "total_s": 0.0,
+                                                  "max_ms": 0.0, "bytes": 0, "items": 0})
+            stage["count"] += 1
+            stage["total_s"] += duration_us / 1e6
+            stage["max_ms"] = max(stage["max_ms"], duration_us / 1000)
+            stage["bytes"] += span.attrs.get("bytes", 0)
+            stage["items"] += span.attrs.get("items", 0)
+        for stage in stages.values():
+            stage["mean_ms"] = stage["total_s"] * 1000 / stage["count"]
+        return sorted(stages.values(), key=lambda stage: -stage["total_s"])
+    
+    def print_summary(self):
+        wall = (time.perf_counter_ns() - self.origin_ns) / 1e9
+        print(f"{'stage':<18} {'count':>6} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'items':>7} {'MB':>8}")
+        for stage in self.summary():
+            print(f"{stage['stage']:<18} {stage['count']:>6} {stage['total_s']:>9.3f} {stage['mean_ms']:>9.2f} "
+                  f"{stage['max_ms']:>9.2f} {stage['items']:>7} {stage['bytes'] / 1e6:>8.2f}")
+        print(f"wall clock {wall:.3f} s (stage totals add up time spent on all threads)")
+
+# Tracer receiving spans from trace(); None while tracing is off
+_active_tracer = None
+
+def trace(name, **attrs):
+    """A span of the active tracer, or a shared no-op span when tracing is off."""
+    tracer = _active_tracer
+    if tracer is None:
+        return contextlib.nullcontext(_NULL_SPAN)
+    return tracer.span(name, **attrs)
+
+@contextlib.contextmanager
+def tracing(tracer):
+    """Make tracer the active tracer for the duration of the block."""
+    global _active_tracer
+    previous, _active_tracer = _active_tracer, tracer
+    try:
+        yield tracer
+    finally:
+        _active_tracer = previous
+
+class AnalysisCache:
+    """
+    Persistent on-disk cache of AI analyses.
+    
+    Entries are JSON files named by sha256(image bytes + prompt + model), so a
+    byte-identical screenshot hits the cache no matter where it lives. Reading
+    an entry refreshes its mtime; evict() drops entries older than max_age_days
+    and then the least recently used ones until the cache fits in max_bytes.
+    """
+    
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=CACHE_MAX_BYTES,
+                 max_age_days=CACHE_MAX_AGE_DAYS):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(image_bytes, prompt, model, variant=""):
+        """
+        Content-addressed key for an image analysed with a given prompt and model.
+        
+        variant distinguishes other settings that change what the model sees,
+        such as upload preprocessing.
+        """
+        digest = hashlib.sha256(image_bytes)
+        for part in (prompt, model, variant):
+            digest.update(b"\0" + part.encode("utf-8"))
+        return digest.hexdigest()
+    
+    def _entry_path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+    
+    def get(self, key, count=True):
+        """
+        Return the cached analysis for key, or None on a miss or expired entry.
+        
+        count=False leaves hits and misses alone, for bookkeeping entries that
+        are not analyses.
+        """
+        entry_path = self._entry_path(key)
+        analysis = None
+        try:
+            if time.time() - entry_path.stat().st_mtime > self.max_age_seconds:
+                entry_path.unlink()
+            else:
+                with open(entry_path, "r", encoding="utf-8") as f:
+                    analysis = json.load(f)
+                os.utime(entry_path)
+        except (OSError, ValueError):
+            analysis = None
+
+        if count:
+            with self._lock:
+                if analysis is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return analysis
+    
+    def put(self, key, analysis):
+        """Store an analysis; written to a temp file and renamed so readers never see partial JSON."""
+        entry_path = self._entry_path(key)
+        try:
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=entry_path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(analysis, f)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            print(f"Warning: could not write analysis cache entry: {e}")
+    
+    def evict(self):
+        """Remove expired entries, then least recently used ones beyond max_bytes."""
+        if not self.cache_dir.exists():
+            return 0
+        
+        now = time.time()
+        entries = []
+        removed = 0
+        for entry_path in self.cache_dir.glob("*/*.json"):
+            try:
+                stat = entry_path.stat()
+                if now - stat.st_mtime > self.max_age_seconds:
+                    entry_path.unlink()
+                    removed += 1
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry_path))
+            except OSError:
+                continue
+        
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                entry_path.unlink()
+                total_bytes -= size
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+JPEG_COMPONENT_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+# Start-of-frame markers carry the image size; C4/C8/CC share the range but are not SOFs
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# (path) -> (mtime_ns, size, metadata); entries are reused until the file changes, and the
+# least recently used are dropped beyond METADATA_CACHE_MAX_ENTRIES so long-lived processes stay flat
+METADATA_CACHE_MAX_ENTRIES = 10000
+_metadata_cache = OrderedDict()
+_metadata_cache_lock = threading.Lock()
+
+def _read_jpeg_header(f):
+    """Walk JPEG marker segments up to the first SOF, noting whether an EXIF block was seen."""
+    has_exif = False
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte:
+            return None
+        
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue  # standalone markers have no length field
+        if marker in (0xD9, 0xDA):
+            return None  # end of image / start of scan before any frame header
+        
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width, components = struct.unpack(">BHHB", f.read(6))
+            return {
+                "width": width,
+                "height": height,
+                "format": "JPEG",
+                "mode": JPEG_COMPONENT_MODES.get(components, "RGB"),
+                "has_exif": has_exif,
+            }
+        if marker == 0xE1:
+            has_exif = has_exif or f.read(6) == b"Exif\0\0"
+            f.seek(length - 8, os.SEEK_CUR)
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+def read_image_header(screenshot_path):
+    """
+    Read width, height, format and mode from the PNG IHDR or JPEG SOF header.
+    
+    Only a few bytes are read and nothing is decoded. Returns None for formats
+    it does not recognise so the caller can fall back to Pillow.
+    """
+    with open(screenshot_path, "rb") as f:
+        head = f.read(26)
+        if head.startswith(PNG_SIGNATURE) and head[12:16] == b"IHDR":
+            width, height, bit_depth, color_type = struct.unpack(">IIBB", head[16:26])
+            mode = PNG_COLOR_MODES.get(color_type)
+            if color_type == 0 and bit_depth == 1:
+                mode = "1"
+            elif color_type == 0 and bit_depth == 16:
+                mode = "I;16"
+            return {
+                "width": width,
+                "height": height,
+                "format": "PNG",
+                "mode": mode,
+                "has_exif": False,
+            }
+        if head[:2] == b"\xff\xd8":
+            f.seek(2)
+            return _read_jpeg_header(f)
+    return None
+
+def _read_exif_datetime(img):
+    """Return the EXIF DateTime of an open Pillow image, or None when there is no EXIF."""
     from PIL.ExifTags import TAGS
-    HAS_PIL = True
-except ImportError:
-    HAS_PIL = False
-    print("Warning: Pillow not installed. Image processing will be limited.")
-
-try:
-    import requests
-    HAS_REQUESTS = True
-except ImportError:
-    HAS_REQUESTS = False
-    print("Warning: Requests not installed. AI analysis will be skipped.")
+    
+    raw_exif = img._getexif() if hasattr(img, '_getexif') else None
+    if not raw_exif:
+        return None
+    exif = {TAGS.get(k, k): v for k, v in raw_exif.items()}
+    return exif.get("DateTime", "Unknown")
+
+def _get_metadata_with_pil(screenshot_path):
+    """Full Pillow path, used for formats the header reader does not understand."""
+    from PIL import Image
+    
+    with Image.open(screenshot_path) as img:
+        metadata = {
+            "path": screenshot_path,
+            "width": img.width,
+            "height": img.height,
+            "format": img.format,
+            "mode": img.mode,
+        }
+        exif_datetime = _read_exif_datetime(img)
+    if exif_datetime is not None:
+        metadata["datetime"] = exif_datetime
+    return metadata
+
+def _extract_screenshot_metadata(screenshot_path):
+    header = read_image_header(screenshot_path)
+    if header is None:
+        return _get_metadata_with_pil(screenshot_path) if HAS_PIL else {"path": screenshot_path}
+    
+    metadata = {"path": screenshot_path}
+    metadata.update((k, v) for k, v in header.items() if k != "has_exif")
+    
+    # Pillow is only needed to decode the EXIF block itself
+    if header["has_exif"] and HAS_PIL:
+        from PIL import Image
+        
+        with Image.open(screenshot_path) as img:
+            exif_datetime = _read_exif_datetime(img)
+        if exif_datetime is not None:
+            metadata["datetime"] = exif_datetime
+    return metadata
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per second with bursts up to `capacity`."""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+class AIClient:
+    """
+    Reusable HTTP client for the chat completions API.
+    
+    A single requests.Session keeps connections alive across screenshots
+    (pool_size connections, enough for the worker pool); it is created, and
+    requests imported, on the first request. Every request has a
+    timeout; connection errors and 429/5xx responses are retried up to
+    max_retries times with exponential backoff and full jitter, capped at
+    backoff_max. A server's Retry-After overrides that cap: the client waits at
+    least that long, up to retry_after_max so a bogus header cannot stall the
+    run. An optional rate limit (requests per second) is shared by all threads
+    using the client.
+    """
+    
+    def __init__(self, api_url=None, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES,
+                 rate_limit=None, pool_size=10, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 retry_after_max=RETRY_AFTER_MAX):
+        self.api_url = api_url or os.environ.get("OPENAI_API_URL", DEFAULT_API_URL)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+    
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
+    
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.retry_after_max))
+        return delay
+    
+    def post(self, payload, api_key):
+        """
+        POST payload, retrying transient failures.
+        
+        Returns the final response (which may still be an error status once
+        retries are exhausted); re-raises the last connection error or timeout.
+        """
+        import requests
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            
+            try:
+                with trace("api_call", attempt=attempt) as span:
+                    response = self.session.post(
+                        self.api_url, headers=headers, json=payload, timeout=self.timeout
+                    )
+                    span.add(bytes=len(response.content))
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+            time.sleep(self._backoff(attempt, parse_retry_after(response.headers.get("Retry-After"))))
+        return response
+    
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+# One pooled client per endpoint for callers that don't pass their own
+_default_clients = {}
+_default_clients_lock = threading.Lock()
+
+def get_default_client(api_url=None):
+    api_url = api_url or os.environ.get("OPENAI_API_URL", DEFAULT_API_URL)
+    with _default_clients_lock:
+        if api_url not in _default_clients:
+            _default_clients[api_url] = AIClient(api_url)
+        return _default_clients[api_url]
+
+def detect_mime_type(image_bytes):
+    """MIME type from the file signature, defaulting to JPEG like the original upload code."""
+    if image_bytes.startswith(PNG_SIGNATURE):
+        return "image/png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/jpeg"
+
+class ImagePreprocessor:
+    """
+    Shrinks and re-encodes screenshots before they are sent to the vision API.
+    
+    Images larger than max_dimension on either side are resized to fit (0 keeps
+    the original size) and encoded as JPEG or WebP at the given quality; a
+    resized image is always sent resized, even in the rare case where that
+    costs more bytes, since max_dimension is a limit rather than a hint. Images
+    that already fit keep their original bytes whenever re-encoding would not
+    make them smaller, and every image does when Pillow is not installed.
+    """
+    
+    def __init__(self, max_dimension=DEFAULT_MAX_DIMENSION, image_format=DEFAULT_UPLOAD_FORMAT,
+                 quality=DEFAULT_UPLOAD_QUALITY):
+        image_format = image_format.upper()
+        if image_format not in UPLOAD_FORMATS:
+            raise ValueError(f"Unsupported upload format: {image_format}")
+        self.max_dimension = max_dimension
+        self.image_format = image_format
+        self.quality = quality
+    
+    @property
+    def cache_tag(self):
+        """Identifies these settings in analysis cache keys."""
+        return f"{self.image_format}:{self.max_dimension}:{self.quality}"
+    
+    def prepare(self, image_bytes):
+        """Return (upload_bytes, mime_type) for the given original image bytes."""
+        if not HAS_PIL:
+            return image_bytes, detect_mime_type(image_bytes)
+        
+        from PIL import Image
+        
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            resized = bool(self.max_dimension) and max(img.size) > self.max_dimension
+            if resized:
+                img.draft("RGB", (self.max_dimension, self.max_dimension))
+                img.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+            
+            if self.image_format == "JPEG" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            elif img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.mode or "transparency" in img.info else "RGB")
+            
+            output = io.BytesIO()
+            img.save(output, self.image_format, quality=self.quality)
+        
+        encoded = output.getvalue()
+        if not resized and len(encoded) >= len(image_bytes):
+            return image_bytes, detect_mime_type(image_bytes)
+        return encoded, f"image/{self.image_format.lower()}"
 
 def get_screenshot_metadata(screenshot_path):
-    """Extract metadata from a screenshot."""
-    if not HAS_PIL:
-        return {"path": screenshot_path}
+    """
+    Extract metadata from a screenshot.
     
+    Results are cached per path and reused while the file's mtime and size are
+    unchanged, so repeated runs over the same directory skip the file reads. The
+    cache keeps the METADATA_CACHE_MAX_ENTRIES most recently used paths.
+    """
     try:
-        img = Image.open(screenshot_path)
-        metadata = {
+        stat = os.stat(screenshot_path)
+        with _metadata_cache_lock:
+            cached = _metadata_cache.get(screenshot_path)
+            if cached is not None:
+                _metadata_cache.move_to_end(screenshot_path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return dict(cached[2])
+        
+        metadata = _extract_screenshot_metadata(screenshot_path)
+        with _metadata_cache_lock:
+            _metadata_cache[screenshot_path] = (stat.st_mtime_ns, stat.st_size, metadata)
+            _metadata_cache.move_to_end(screenshot_path)
+            while len(_metadata_cache) > METADATA_CACHE_MAX_ENTRIES:
+                _metadata_cache.popitem(last=False)
+        return dict(metadata)
+    except Exception as e:
+        print(f"Error processing image {screenshot_path}: {e}")
+        return {"path": screenshot_path, "error": str(e)}
+
+def dhash(screenshot_path, hash_size=DHASH_SIZE):
+    """
+    Difference hash of a screenshot as an int of hash_size * hash_size bits.
+    
+    The image is shrunk to (hash_size + 1) x hash_size grayscale and each bit
+    records whether a pixel is brighter than its right neighbour, so small
+    rendering differences (cursor blink, clock) barely change the hash.
+    """
+    from PIL import Image
+    
+    with Image.open(screenshot_path) as img:
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        return dhash_image(img, hash_size)
+
+def dhash_image(img, hash_size=DHASH_SIZE):
+    """dhash() of an already opened PIL image."""
+    from PIL import Image
+    
+    pixels = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+def compute_dhashes(screenshot_paths, max_workers=1, known_hashes=None):
+    """
+    Return {path: dhash or None} for screenshot_paths.
+    
+    Paths present in known_hashes (e.g. unchanged files from a previous
+    manifest) are not re-read.
+    """
+    known_hashes = known_hashes or {}
+    
+    def safe_dhash(screenshot_path):
+        if screenshot_path in known_hashes:
+            return known_hashes[screenshot_path]
+        try:
+            return dhash(screenshot_path)
+        except Exception as e:
+            print(f"Error hashing image {screenshot_path}: {e}")
+            return None
+    
+    if max_workers <= 1:
+        hashes = [safe_dhash(path) for path in screenshot_paths]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = list(executor.map(safe_dhash, screenshot_paths))
+    return dict(zip(screenshot_paths, hashes))
+
+def group_near_duplicates(screenshot_paths, max_distance=DEFAULT_DEDUP_DISTANCE, max_workers=1,
+                          hashes=None):
+    """
+    Group visually near-identical screenshots by dHash.
+    
+    The first screenshot of each group (in input order) is its representative.
+    Returns {duplicate_path: (representative_index, representative_path, distance)}
+    where representative_index is the 1-based position in screenshot_paths.
+    Screenshots that cannot be hashed are never treated as duplicates.
+    hashes may be a precomputed {path: dhash} mapping (see compute_dhashes).
+    """
+    if hashes is None:
+        hashes = compute_dhashes(screenshot_paths, max_workers=max_workers)
+    hashes = [hashes.get(path) for path in screenshot_paths]
+    
+    representatives = []
+    duplicates = {}
+    for index, (screenshot_path, value) in enumerate(zip(screenshot_paths, hashes), start=1):
+        if value is None:
+            continue
+        for rep_index, rep_path, rep_value in representatives:
+            distance = hamming_distance(value, rep_value)
+            if distance <= max_distance:
+                duplicates[screenshot_path] = (rep_index, rep_path, distance)
+                break
+        else:
+            representatives.append((index, screenshot_path, value))
+    return duplicates
+
+def make_thumbnail(screenshot_path, thumbnail_dir, size=DEFAULT_THUMBNAIL_SIZE):
+    """
+    Write a JPEG thumbnail of screenshot_path into thumbnail_dir.
+    
+    Thumbnails are named by content hash and size, so one that already exists
+    is reused without decoding the screenshot. Returns {"file", "width", "height"}.
+    """
+    from PIL import Image
+    
+    name = f"{file_sha256(screenshot_path)[:32]}_{size}.jpg"
+    thumbnail_path = os.path.join(thumbnail_dir, name)
+    if os.path.exists(thumbnail_path):
+        header = read_image_header(thumbnail_path)
+        if header is not None:
+            return {"file": name, "width": header["width"], "height": header["height"]}
+    
+    with Image.open(screenshot_path) as img:
+        img.draft("RGB", (size, size))
+        img.thumbnail((size, size), Image.LANCZOS)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        width, height = img.size
+        fd, tmp_path = tempfile.mkstemp(dir=thumbnail_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, "JPEG", quality=THUMBNAIL_QUALITY)
+            os.replace(tmp_path, thumbnail_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return {"file": name, "width": width, "height": height}
+
+def iter_thumbnails(screenshot_paths, thumbnail_dir, size=DEFAULT_THUMBNAIL_SIZE, max_workers=1):
+    """
+    Yield (path, thumbnail) for screenshot_paths in order, rendering up to
+    max_workers at once and never more than max_workers * 2 ahead of the caller.
+    
+    Screenshots that cannot be thumbnailed yield None and are shown full size.
+    """
+    Path(thumbnail_dir).mkdir(parents=True, exist_ok=True)
+    
+    def safe_thumbnail(screenshot_path):
+        try:
+            return make_thumbnail(screenshot_path, thumbnail_dir, size)
+        except Exception as e:
+            print(f"Error creating thumbnail for {screenshot_path}: {e}")
+            return None
+    
+    if max_workers <= 1:
+        for screenshot_path in screenshot_paths:
+            yield screenshot_path, safe_thumbnail(screenshot_path)
+        return
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for screenshot_path in screenshot_paths:
+            pending.append((screenshot_path, executor.submit(safe_thumbnail, screenshot_path)))
+            if len(pending) >= max_workers * 2:
+                screenshot_path, future = pending.popleft()
+                yield screenshot_path, future.result()
+        while pending:
+            screenshot_path, future = pending.popleft()
+            yield screenshot_path, future.result()
+
+def make_thumbnails(screenshot_paths, thumbnail_dir, size=DEFAULT_THUMBNAIL_SIZE, max_workers=1):
+    """Return {path: thumbnail} for screenshot_paths (see iter_thumbnails)."""
+    return dict(iter_thumbnails(screenshot_paths, thumbnail_dir, size, max_workers))
+
+def find_baseline(screenshot_path, baseline_dir):
+    """The baseline file with the same name (any screenshot extension), or None."""
+    name = os.path.basename(screenshot_path)
+    stem = os.path.splitext(name)[0]
+    for candidate in [name] + [stem + extension for extension in SCREENSHOT_EXTENSIONS]:
+        baseline_path = os.path.join(baseline_dir, candidate)
+        if os.path.isfile(baseline_path):
+            return baseline_path
+    return None
+
+def _load_rgb(screenshot_path):
+    import numpy as np
+    from PIL import Image
+    
+    with Image.open(screenshot_path) as img:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return np.asarray(img)
+
+def diff_images(current, baseline, tolerance=DIFF_PIXEL_TOLERANCE):
+    """
+    Compare two equally sized HxWx3 uint8 arrays.
+    
+    Returns (diff, changed): the largest channel difference of each pixel and
+    the mask of pixels differing by more than tolerance. Stays in uint8
+    throughout, so a 1080p frame is a handful of vectorised passes.
+    """
+    import numpy as np
+    
+    channels = np.maximum(current, baseline) - np.minimum(current, baseline)
+    # Element-wise over channel views; .max(axis=2) on a 3-wide axis is ~20x slower
+    diff = np.maximum(np.maximum(channels[:, :, 0], channels[:, :, 1]), channels[:, :, 2])
+    return diff, diff > tolerance
+
+def write_diff_heatmap(current, diff, heatmap_path, max_dimension=DIFF_HEATMAP_SIZE):
+    """
+    Write the current frame, darkened, with differences overlaid in red.
+    
+    Both are reduced to heatmap size first: the frame by sampling and the
+    diff by taking the maximum of each block, so single changed pixels
+    stay visible.
+    """
+    import numpy as np
+    from PIL import Image
+    
+    step = max(1, -(-max(diff.shape) // max_dimension))
+    height, width = diff.shape[0] // step, diff.shape[1] // step
+    pooled = diff[:height * step:step, :width * step:step].copy()
+    for row in range(step):
+        for column in range(step):
+            np.maximum(pooled, diff[row:height * step:step, column:width * step:step], out=pooled)
+    
+    background = current[:height * step:step, :width * step:step, 1] // 3
+    highlight = (np.minimum(pooled, 63) * 4).astype(np.uint8)
+    heatmap = np.stack([np.maximum(background, highlight), background, background], axis=2)
+    Image.fromarray(heatmap).save(heatmap_path, "PNG", compress_level=1)
+
+def compare_to_baseline(screenshot_path, baseline_path, heatmap_path=None,
+                        threshold=DEFAULT_BASELINE_THRESHOLD, tolerance=DIFF_PIXEL_TOLERANCE):
+    """
+    Compare a screenshot with its baseline.
+    
+    Returns a dict with baseline, status ("unchanged", "changed",
+    "size-changed" or "new" when there is no baseline), similarity (fraction
+    of matching pixels), changed_pixels and heatmap (written to heatmap_path
+    for changed frames, else None). Byte-identical files are not decoded.
+    """
+    comparison = {"baseline": baseline_path, "status": "new", "similarity": None,
+                  "changed_pixels": None, "heatmap": None}
+    if baseline_path is None:
+        return comparison
+    if (os.path.getsize(screenshot_path) == os.path.getsize(baseline_path)
+            and file_sha256(screenshot_path) == file_sha256(baseline_path)):
+        comparison.update(status="unchanged", similarity=1.0, changed_pixels=0)
+        return comparison
+    
+    import numpy as np
+    
+    current = _load_rgb(screenshot_path)
+    baseline = _load_rgb(baseline_path)
+    if current.shape != baseline.shape:
+        comparison.update(status="size-changed", similarity=0.0,
+                          changed_pixels=current.shape[0] * current.shape[1])
+        return comparison
+    
+    diff, changed = diff_images(current, baseline, tolerance)
+    changed_pixels = int(np.count_nonzero(changed))
+    similarity = 1.0 - changed_pixels / changed.size
+    comparison.update(status="unchanged" if similarity >= threshold else "changed",
+                      similarity=similarity, changed_pixels=changed_pixels)
+    if comparison["status"] == "changed" and heatmap_path:
+        write_diff_heatmap(current, diff, heatmap_path)
+        comparison["heatmap"] = heatmap_path
+    return comparison
+
+def baseline_comparer(baseline_dir, diff_dir, threshold=DEFAULT_BASELINE_THRESHOLD):
+    """
+    Return compare(number, screenshot_path), which compares one frame with its
+    baseline in baseline_dir and writes its heatmap to diff_dir as
+    <number>_<name>_diff.png. Failures come back as status "error".
+    
+    Each pair that is not byte-identical is decoded in full, which dominates
+    the cost: about 75 ms per 1080p frame on one core. Only more workers on
+    more cores make a large set faster.
+    """
+    Path(diff_dir).mkdir(parents=True, exist_ok=True)
+    
+    def compare(number, screenshot_path):
+        stem = os.path.splitext(os.path.basename(screenshot_path))[0]
+        heatmap_path = os.path.join(diff_dir, f"{number:04d}_{stem}_diff.png")
+        try:
+            with trace("baseline_compare", items=1):
+                return compare_to_baseline(screenshot_path, find_baseline(screenshot_path, baseline_dir),
+                                           heatmap_path, threshold)
+        except Exception as e:
+            print(f"Error comparing {screenshot_path} with baseline: {e}")
+            return {"baseline": None, "status": "error", "reason": str(e), "similarity": None,
+                    "changed_pixels": None, "heatmap": None}
+    
+    return compare
+
+def compare_with_baseline(screenshot_paths, baseline_dir, diff_dir, threshold=DEFAULT_BASELINE_THRESHOLD,
+                          max_workers=1):
+    """
+    Return {path: comparison} for screenshot_paths against baseline_dir,
+    comparing up to max_workers frames at once (decoding and NumPy release
+    the GIL). Heatmaps are written to diff_dir.
+    """
+    compare = baseline_comparer(baseline_dir, diff_dir, threshold)
+    numbers = range(1, len(screenshot_paths) + 1)
+    if max_workers <= 1:
+        comparisons = list(map(compare, numbers, screenshot_paths))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            comparisons = list(executor.map(compare, numbers, screenshot_paths))
+    return dict(zip(screenshot_paths, comparisons))
+
+def _baseline_match(screenshot_path, base_dir, comparison):
+    """The finished result of a frame that matches its baseline, which is not analysed."""
+    return {
+        "metadata": get_screenshot_metadata(screenshot_path),
+        "ai_analysis": {"status": "unchanged",
+                        "reason": f"Matches baseline ({comparison['similarity']:.2%} similar)"},
+        "relative_path": os.path.relpath(screenshot_path, start=base_dir),
+    }
+
+def collect_videos(sources):
+    """Expand video files and directories (not recursive) into a sorted list of recordings."""
+    videos = []
+    for source in sources:
+        if os.path.isdir(source):
+            videos.extend(os.path.join(source, name) for name in sorted(os.listdir(source))
+                          if name.lower().endswith(VIDEO_EXTENSIONS))
+        elif os.path.isfile(source):
+            videos.append(source)
+        else:
+            print(f"Warning: video not found: {source}")
+    return videos
+
+def _read_ppm_frame(stream):
+    """Read one binary PPM (P6) image from stream as a PIL image; None at end of stream."""
+    from PIL import Image
+    
+    magic = stream.readline()
+    if not magic:
+        return None
+    if magic.strip() != b"P6":
+        raise ValueError(f"Unexpected frame header {magic!r}")
+    width, height = map(int, stream.readline().split())
+    stream.readline()  # maximum value, always 255 for rgb24
+    data = stream.read(width * height * 3)
+    if len(data) < width * height * 3:
+        return None
+    return Image.frombytes("RGB", (width, height), data)
+
+def iter_video_frames(video_path, fps=DEFAULT_VIDEO_FPS, width=VIDEO_FRAME_WIDTH):
+    """
+    Yield (timestamp_seconds, PIL image) samples of a video at fps.
+    
+    ffmpeg decodes and scales the video and writes PPM frames to a pipe that
+    is read one frame at a time, so only the current frame is in memory.
+    Stopping iteration early terminates ffmpeg.
+    """
+    command = [
+        "ffmpeg", "-v", "error", "-i", video_path,
+        "-vf", f"fps={fps},scale='min({width},iw)':-2",
+        "-f", "image2pipe", "-vcodec", "ppm", "-",
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    count = 0
+    try:
+        while True:
+            frame = _read_ppm_frame(process.stdout)
+            if frame is None:
+                break
+            yield count / fps, frame
+            count += 1
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        returncode = process.wait()
+    if count == 0 and returncode:
+        raise RuntimeError(f"ffmpeg could not decode {video_path} (exit code {returncode})")
+
+class KeyframeExtractor:
+    """
+    Picks keyframes out of screen recordings.
+    
+    Sampled frames are compared by dHash. Once a frame is scene_threshold
+    bits away from the last keyframe the screen is considered changed, and the
+    next sample that barely differs from its predecessor (the transition has
+    settled) becomes a keyframe. The first frame is always a keyframe and at
+    most max_keyframes are kept per video.
+    """
+    
+    def __init__(self, fps=DEFAULT_VIDEO_FPS, scene_threshold=DEFAULT_SCENE_THRESHOLD,
+                 max_keyframes=DEFAULT_MAX_KEYFRAMES, frame_width=VIDEO_FRAME_WIDTH):
+        self.fps = fps
+        self.scene_threshold = scene_threshold
+        self.max_keyframes = max_keyframes
+        self.frame_width = frame_width
+    
+    def select(self, frames):
+        """Yield the (timestamp, image) keyframes of a stream of (timestamp, image) samples."""
+        keyframe_hash = previous_hash = None
+        changing = None  # latest (timestamp, image, hash) since the screen changed
+        kept = 0
+        for timestamp, img in frames:
+            value = dhash_image(img)
+            if keyframe_hash is None:
+                keep = True
+            elif changing is not None:
+                settled = hamming_distance(value, previous_hash) <= SCENE_STABLE_DISTANCE
+                changed = hamming_distance(value, keyframe_hash) >= self.scene_threshold
+                keep = settled and changed
+                # Still moving: remember it; settled back on the keyframe's screen: forget it
+                changing = (timestamp, img, value) if changed and not settled else None
+            else:
+                keep = False
+                if hamming_distance(value, keyframe_hash) >= self.scene_threshold:
+                    changing = (timestamp, img, value)
+            previous_hash = value
+            
+            if keep:
+                yield timestamp, img
+                keyframe_hash = value
+                kept += 1
+                if kept >= self.max_keyframes:
+                    return
+        
+        # The recording ended on a new screen that was still settling
+        if changing is not None and hamming_distance(changing[2], keyframe_hash) >= self.scene_threshold:
+            yield changing[0], changing[1]
+    
+    def extract(self, video_path, output_dir):
+        """Write the keyframes of video_path as PNGs under output_dir; returns their paths."""
+        stem = os.path.splitext(os.path.basename(video_path))[0]
+        keyframe_dir = os.path.join(output_dir, KEYFRAME_DIR, stem)
+        Path(keyframe_dir).mkdir(parents=True, exist_ok=True)
+        
+        paths = []
+        frames = iter_video_frames(video_path, self.fps, self.frame_width)
+        for timestamp, img in self.select(frames):
+            keyframe_path = os.path.join(keyframe_dir, f"{stem}_{int(timestamp * 1000):08d}ms.png")
+            img.save(keyframe_path, "PNG")
+            paths.append(keyframe_path)
+        return paths
+
+def extract_video_keyframes(video_paths, output_dir, extractor=None):
+    """Keyframe paths for every recording in video_paths, in order; failures are reported and skipped."""
+    extractor = extractor or KeyframeExtractor()
+    keyframes = []
+    for video_path in video_paths:
+        try:
+            with trace("keyframes", video=os.path.basename(video_path)) as span:
+                paths = extractor.extract(video_path, output_dir)
+                span.add(items=len(paths))
+        except Exception as e:
+            print(f"Error extracting keyframes from {video_path}: {e}")
+            continue
+        print(f"Extracted {len(paths)} keyframes from {os.path.basename(video_path)}")
+        keyframes.extend(paths)
+    return keyframes
+
+def _build_payload(prompt, images):
+    """Chat completions payload for a text prompt followed by (label, mime_type, base64) images."""
+    content = [{"type": "text", "text": prompt}]
+    for label, mime_type, encoded_image in images:
+        if label:
+            content.append({"type": "text", "text": label})
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{mime_type};base64,{encoded_image}"
+            }
+        })
+    return {
+        "model": DEFAULT_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": content
+            }
+        ],
+        "max_tokens": MAX_TOKENS_PER_IMAGE * len(images)
+    }
+
+def _prepare_upload(image_bytes, preprocessor):
+    """Return (base64 text, mime_type, upload size info) for one image."""
+    with trace("encode", items=1, bytes=len(image_bytes)):
+        if preprocessor is not None:
+            upload_bytes, mime_type = preprocessor.prepare(image_bytes)
+        else:
+            upload_bytes, mime_type = image_bytes, detect_mime_type(image_bytes)
+        upload_sizes = {"bytes_before": len(image_bytes), "bytes_after": len(upload_bytes)}
+        return base64.b64encode(upload_bytes).decode('utf-8'), mime_type, upload_sizes
+
+# Prompt slot of the cache entries that record an image's upload size, so batches can be planned unencoded
+UPLOAD_SIZE_CACHE_PROMPT = "upload size"
+
+def _cache_key(cache, image_bytes, prompt, preprocessor):
+    if cache is None:
+        return None
+    return cache.make_key(
+        image_bytes, prompt, DEFAULT_MODEL,
+        variant=preprocessor.cache_tag if preprocessor else "",
+    )
+
+def analyze_screenshot_with_ai(screenshot_path, api_url=None, cache=None, preprocessor=None,
+                               client=None, api_key=None):
+    """
+    Analyze screenshot with AI to identify UI elements and potential issues.
+    
+    When a cache is given it is consulted before any network call, and
+    successful analyses are stored in it. When a preprocessor is given the
+    image is shrunk/re-encoded before upload; results of an upload carry
+    bytes_before and bytes_after. Requests go through client (an AIClient),
+    or a shared pooled client for api_url when none is given. api_key
+    defaults to OPENAI_API_KEY.
+    """
+    if not HAS_REQUESTS:
+        return {"status": "skipped", "reason": "requests library not available"}
+        
+    # Check for API key
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        return {"status": "skipped", "reason": "OpenAI API key not found in environment"}
+    
+    try:
+        with open(screenshot_path, "rb") as image_file:
+            image_bytes = image_file.read()
+        
+        cache_key = _cache_key(cache, image_bytes, ANALYSIS_PROMPT, preprocessor)
+        if cache_key is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return dict(cached, cached=True)
+        
+        # Convert image to base64
+        encoded_image, mime_type, upload_sizes = _prepare_upload(image_bytes, preprocessor)
+        
+        # Send to OpenAI API
+        payload = _build_payload(ANALYSIS_PROMPT, [(None, mime_type, encoded_image)])
+        response = (client or get_default_client(api_url)).post(payload, api_key)
+        
+        if response.status_code == 200:
+            result = response.json()
+            analysis = {
+                "status": "success",
+                "analysis": result["choices"][0]["message"]["content"]
+            }
+            if cache_key is not None:
+                cache.put(cache_key, analysis)
+            return dict(analysis, **upload_sizes)
+        else:
+            return {
+                "status": "error",
+                "reason": f"API error: {response.status_code}",
+                "details": response.text,
+                **upload_sizes
+            }
+    
+    except Exception as e:
+        return {"status": "error", "reason": str(e)}
+
+def parse_batch_response(content, count):
+    """
+    Split a batched answer into per-screenshot analyses.
+    
+    Expects the JSON array requested by BATCH_ANALYSIS_PROMPT (optionally wrapped
+    in prose or a code fence) and falls back to "Screenshot N" headings. Returns
+    a list of count entries, None for screenshots the model did not cover.
+    """
+    analyses = [None] * count
+    start, end = content.find("["), content.rfind("]")
+    if start != -1 and end > start:
+        try:
+            items = json.loads(content[start:end + 1])
+        except ValueError:
+            items = None
+        if isinstance(items, list):
+            for position, item in enumerate(items, start=1):
+                number, text = position, item
+                if isinstance(item, dict):
+                    number, text = item.get("screenshot", position), item.get("analysis")
+                if isinstance(number, int) and 1 <= number <= count and isinstance(text, str):
+                    analyses[number - 1] = text
+    
+    if not any(analyses):
+        parts = re.split(r"(?im)^[#*\s]*screenshot\s+(\d+)\b[^\n]*\n", content)
+        for number, text in zip(parts[1::2], parts[2::2]):
+            if 1 <= int(number) <= count and text.strip():
+                analyses[int(number) - 1] = text.strip()
+    
+    if count == 1 and analyses[0] is None and content.strip():
+        analyses[0] = content.strip()
+    return analyses
+
+def analyze_screenshot_batch_with_ai(screenshot_paths, api_url=None, cache=None, preprocessor=None,
+                                     client=None, max_bytes=DEFAULT_BATCH_MAX_BYTES, api_key=None):
+    """
+    Analyze several screenshots with as few requests as possible.
+    
+    The screenshots are packed, in order, into requests carrying at most
+    max_bytes of base64 image data (a larger single image still gets its own
+    request). Each answer describes a screenshot in the context of the ones
+    before it, so the cache holds whole requests: a request is answered locally
+    only when the same images were sent together, in the same order, before.
+    The cache also remembers each image's upload size, so on a rerun requests
+    are packed and looked up from file digests alone and an image is only
+    preprocessed and encoded when its request has to be sent.
+    Returns one analysis dict per path, in the same shape as
+    analyze_screenshot_with_ai.
+    """
+    if not HAS_REQUESTS:
+        return [{"status": "skipped", "reason": "requests library not available"}
+                for _ in screenshot_paths]
+    
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        return [{"status": "skipped", "reason": "OpenAI API key not found in environment"}
+                for _ in screenshot_paths]
+    
+    results = [None] * len(screenshot_paths)
+    # [index, image bytes until encoded, digest, upload sizes, (base64, mime type) once encoded]
+    uploads = []
+    for i, screenshot_path in enumerate(screenshot_paths):
+        try:
+            with open(screenshot_path, "rb") as image_file:
+                image_bytes = image_file.read()
+            digest = hashlib.sha256(image_bytes).digest()
+            size_key = _cache_key(cache, digest, UPLOAD_SIZE_CACHE_PROMPT, preprocessor)
+            upload_sizes = cache.get(size_key, count=False) if size_key is not None else None
+            if upload_sizes is not None:
+                uploads.append([i, image_bytes, digest, upload_sizes, None])
+                continue
+            encoded_image, mime_type, upload_sizes = _prepare_upload(image_bytes, preprocessor)
+            upload_sizes = dict(upload_sizes, encoded_bytes=len(encoded_image))
+            if size_key is not None:
+                cache.put(size_key, upload_sizes)
+            uploads.append([i, None, digest, upload_sizes, (encoded_image, mime_type)])
+        except Exception as e:
+            results[i] = {"status": "error", "reason": str(e)}
+    
+    def send(batch):
+        prompt = BATCH_ANALYSIS_PROMPT.format(count=len(batch))
+        cache_key = _cache_key(cache, b"".join(upload[2] for upload in batch), prompt, preprocessor)
+        if cache_key is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                for number, upload in enumerate(batch, start=1):
+                    results[upload[0]] = {"status": "success", "analysis": cached["analyses"][number - 1],
+                                          "batch_size": len(batch), "cached": True}
+                return
+        
+        try:
+            for upload in batch:
+                if upload[4] is None:
+                    upload[4] = _prepare_upload(upload[1], preprocessor)[:2]
+                    upload[1] = None
+        except Exception as e:
+            for upload in batch:
+                results[upload[0]] = {"status": "error", "reason": str(e)}
+            return
+        images = [
+            (f"Screenshot {number}: {os.path.basename(screenshot_paths[upload[0]])}", upload[4][1], upload[4][0])
+            for number, upload in enumerate(batch, start=1)
+        ]
+        payload = _build_payload(prompt, images)
+        try:
+            response = (client or get_default_client(api_url)).post(payload, api_key)
+            if response.status_code == 200:
+                content = response.json()["choices"][0]["message"]["content"]
+                analyses = parse_batch_response(content, len(batch))
+            else:
+                error = {"status": "error", "reason": f"API error: {response.status_code}",
+                         "details": response.text}
+                analyses = None
+        except Exception as e:
+            error = {"status": "error", "reason": str(e)}
+            analyses = None
+        
+        if cache_key is not None and analyses is not None and None not in analyses:
+            cache.put(cache_key, {"status": "success", "analyses": analyses})
+        for number, (i, _, _, sizes, _) in enumerate(batch, start=1):
+            upload_sizes = {"bytes_before": sizes["bytes_before"], "bytes_after": sizes["bytes_after"]}
+            if analyses is None:
+                results[i] = dict(error, **upload_sizes)
+            elif analyses[number - 1] is None:
+                results[i] = dict(
+                    status="error",
+                    reason=f"Batch response had no analysis for screenshot {number}",
+                    details=content,
+                    **upload_sizes
+                )
+            else:
+                results[i] = dict(status="success", analysis=analyses[number - 1], batch_size=len(batch),
+                                  **upload_sizes)
+    
+    batch, batch_bytes = [], 0
+    for upload in uploads:
+        if batch and batch_bytes + upload[3]["encoded_bytes"] > max_bytes:
+            send(batch)
+            batch, batch_bytes = [], 0
+        batch.append(upload)
+        batch_bytes += upload[3]["encoded_bytes"]
+    if batch:
+        send(batch)
+    return results
+
+class RemoteAnalyzer:
+    """Analysis by a vision model behind an OpenAI-compatible chat completions endpoint."""
+    
+    name = "remote"
+    
+    def __init__(self, api_url=None, cache=None, preprocessor=None, client=None, api_key=None,
+                 max_bytes=DEFAULT_BATCH_MAX_BYTES):
+        self.api_url = api_url
+        self.cache = cache
+        self.preprocessor = preprocessor
+        self.client = client
+        self.api_key = api_key
+        self.max_bytes = max_bytes
+    
+    def unavailable_reason(self):
+        """Why analysis cannot run, or None when it can."""
+        if not HAS_REQUESTS:
+            return "requests library not available"
+        if not (self.api_key or os.environ.get("OPENAI_API_KEY")):
+            return "OpenAI API key not found in environment"
+        return None
+    
+    def analyze(self, screenshot_path):
+        return analyze_screenshot_with_ai(
+            screenshot_path, api_url=self.api_url, cache=self.cache, preprocessor=self.preprocessor,
+            client=self.client, api_key=self.api_key,
+        )
+    
+    def analyze_batch(self, screenshot_paths):
+        return analyze_screenshot_batch_with_ai(
+            screenshot_paths, api_url=self.api_url, cache=self.cache, preprocessor=self.preprocessor,
+            client=self.client, max_bytes=self.max_bytes, api_key=self.api_key,
+        )
+
+def _relative_luminance(rgb):
+    """WCAG relative luminance of an (r, g, b) colour with 0-255 channels."""
+    def linear(channel):
+        channel /= 255
+        return channel / 12.92 if channel <= 0.03928 else ((channel + 0.055) / 1.055) ** 2.4
+    r, g, b = (linear(channel) for channel in rgb[:3])
+    return 0.2126 * r + 0.7152 * g + 0.0722 * b
+
+def contrast_ratio(a, b):
+    """WCAG contrast ratio between two colours, from 1 to 21."""
+    lighter, darker = sorted((_relative_luminance(a), _relative_luminance(b)), reverse=True)
+    return (lighter + 0.05) / (darker + 0.05)
+
+def _content_bands(row_profile, min_gap):
+    """Count runs of non-empty rows separated by at least min_gap empty rows."""
+    bands = 0
+    gap = min_gap
+    for filled in row_profile:
+        if filled:
+            if gap >= min_gap:
+                bands += 1
+            gap = 0
+        else:
+            gap += 1
+    return bands
+
+class HeuristicAnalyzer:
+    """
+    Offline analysis from pixel statistics: no network, no model.
+    
+    Looks at brightness, contrast between the background and the strongest
+    common foreground colour (a stand-in for text on background), edge
+    density and how content is laid out vertically, and reports the findings as text in the same result
+    shape as the remote analyzer, with the raw numbers under "metrics".
+    """
+    
+    name = "heuristic"
+    
+    def unavailable_reason(self):
+        return None if HAS_PIL else "Pillow not installed"
+    
+    def measure(self, screenshot_path):
+        """Return the metrics dict for one screenshot."""
+        from PIL import Image, ImageFilter, ImageStat
+        
+        with Image.open(screenshot_path) as img:
+            width, height = img.size
+            img.draft("RGB", (HEURISTIC_SIZE, HEURISTIC_SIZE))
+            small = img.convert("RGB")
+        small.thumbnail((HEURISTIC_SIZE, HEURISTIC_SIZE))
+        gray = small.convert("L")
+        stats = ImageStat.Stat(gray)
+        
+        # Background is the most common colour; foreground the highest-contrast
+        # colour that still covers a meaningful share of the screen
+        quantized = small.quantize(colors=HEURISTIC_COLORS)
+        palette = quantized.getpalette()
+        counts = sorted(quantized.getcolors(), reverse=True)
+        background = tuple(palette[counts[0][1] * 3:counts[0][1] * 3 + 3])
+        total = small.width * small.height
+        foreground_ratio = max(
+            [contrast_ratio(background, palette[index * 3:index * 3 + 3])
+             for count, index in counts[1:] if count / total >= HEURISTIC_MIN_COLOR_SHARE],
+            default=1.0,
+        )
+        
+        edges = gray.filter(ImageFilter.FIND_EDGES).point(lambda v: 255 if v > HEURISTIC_EDGE_LEVEL else 0)
+        edge_pixels = edges.tobytes()
+        columns, rows = edges.size
+        # Ignore the 1px frame FIND_EDGES leaves at the image border
+        row_profile = [any(edge_pixels[row * columns + 1:(row + 1) * columns - 1])
+                       for row in range(1, rows - 1)]
+        filled_rows = [row for row, filled in enumerate(row_profile) if filled]
+        
+        return {
+            "width": width,
+            "height": height,
+            "mean_luminance": stats.mean[0] / 255,
+            "stddev": stats.stddev[0],
+            "contrast_ratio": foreground_ratio,
+            "edge_density": edge_pixels.count(255) / len(edge_pixels),
+            "content_bands": _content_bands(row_profile, max(2, rows // 40)),
+            "content_top": filled_rows[0] / len(row_profile) if filled_rows else None,
+            "content_bottom": (filled_rows[-1] + 1) / len(row_profile) if filled_rows else None,
+        }
+    
+    def describe(self, metrics):
+        findings = [f"{metrics['width']}x{metrics['height']}, "
+                    f"{'dark' if metrics['mean_luminance'] < 0.35 else 'light'} theme "
+                    f"(mean luminance {metrics['mean_luminance']:.0%})."]
+        if metrics["stddev"] < HEURISTIC_BLANK_STDDEV:
+            findings.append("The screen is blank or a single colour: possibly still loading or "
+                            "an empty state.")
+            return findings
+        
+        if metrics["content_top"] is None:
+            # Smooth gradients and photos vary without edges that mark out content
+            findings.append("Layout: no distinct content region (no sharp edges found).")
+        else:
+            findings.append(f"Layout: {metrics['content_bands']} content region(s) stacked vertically, "
+                            f"spanning {metrics['content_top']:.0%}-{metrics['content_bottom']:.0%} "
+                            f"of the screen height.")
+        if metrics["edge_density"] > HEURISTIC_BUSY_EDGES:
+            findings.append(f"Visually busy ({metrics['edge_density']:.0%} edge pixels); consider "
+                            f"more whitespace or grouping.")
+        elif metrics["edge_density"] < HEURISTIC_SPARSE_EDGES:
+            findings.append("Very sparse content; check that the screen finished rendering.")
+        if metrics["contrast_ratio"] < WCAG_AA_CONTRAST:
+            findings.append(f"Low foreground/background contrast ({metrics['contrast_ratio']:.1f}:1; "
+                            f"WCAG AA asks for {WCAG_AA_CONTRAST}:1 for body text).")
+        else:
+            findings.append(f"Foreground/background contrast is {metrics['contrast_ratio']:.1f}:1.")
+        return findings
+    
+    def analyze(self, screenshot_path):
+        try:
+            metrics = self.measure(screenshot_path)
+            analysis = "\n".join(self.describe(metrics))
+        except Exception as e:
+            return {"status": "error", "reason": str(e)}
+        return {"status": "success", "analysis": analysis, "metrics": metrics}
+    
+    def analyze_batch(self, screenshot_paths):
+        return [self.analyze(screenshot_path) for screenshot_path in screenshot_paths]
+
+class StubModelServer:
+    """
+    Local stand-in for the chat completions endpoint.
+    
+    Answers every request after latency seconds with a deterministic
+    analysis derived from the images' content (a JSON array, as batch mode
+    asks for, when a request carries several), so the whole pipeline can be
+    run and timed without network access. Use as a context manager, or
+    call start() and stop().
+    
+    failures is a list of (status, headers) error responses served, in order,
+    before the first answer. requests counts answered requests; with
+    record=True their payloads are kept in payloads. Each client address seen
+    is added to connections (connections are kept alive).
+    """
+    
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0, failures=(), record=False):
+        self.latency = latency
+        self.failures = list(failures)
+        self.requests = 0
+        self.payloads = [] if record else None
+        self.connections = set()
+        self.lock = threading.Lock()
+        stub = self
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with stub.lock:
+                    stub.connections.add(self.client_address)
+                    failure = stub.failures.pop(0) if stub.failures else None
+                    if failure is None:
+                        stub.requests += 1
+                        if stub.payloads is not None:
+                            stub.payloads.append(payload)
+                time.sleep(stub.latency)
+                if failure is not None:
+                    status, headers = failure
+                    body = b'{"error": "injected"}'
+                else:
+                    status, headers = 200, {}
+                    body = json.dumps({
+                        "choices": [{"message": {"role": "assistant", "content": stub.answer(payload)}}]
+                    }).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}/v1/chat/completions"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    
+    @staticmethod
+    def describe(image_url):
+        """The stub's analysis of one image, given its data URL."""
+        return (f"Stub analysis of image {hashlib.sha256(image_url.encode('ascii')).hexdigest()[:12]}: "
+                f"layout, navigation and accessibility not evaluated.")
+    
+    @classmethod
+    def answer(cls, payload):
+        content = payload["messages"][0]["content"] if payload.get("messages") else []
+        images = [part["image_url"]["url"] for part in content if part.get("type") == "image_url"]
+        analyses = [cls.describe(url) for url in images]
+        if len(analyses) == 1:
+            return analyses[0]
+        return json.dumps([{"screenshot": number, "analysis": analysis}
+                           for number, analysis in enumerate(analyses, start=1)])
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *exc):
+        self.stop()
+
+class StubAnalyzer(RemoteAnalyzer):
+    """
+    RemoteAnalyzer pointed at a StubModelServer.
+    
+    Its own name keeps the manifest from serving stub answers to a real run.
+    """
+    
+    name = "stub"
+
+def iter_json_array(f, chunk_size=64 * 1024):
+    """
+    Yield the elements of a top-level JSON array, reading f incrementally.
+    
+    Only the element being decoded (plus one chunk) is held in memory, so
+    multi-MB Maestro command logs are parsed in a single streaming pass.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+    
+    def next_char():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                return ""
+            fill()
+    
+    if next_char() != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    if next_char() == "]":
+        return
+    
+    while True:
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if end == len(buffer) and not eof:
+                fill()  # a number could continue in the next chunk
+                continue
+            break
+        yield value
+        pos = end
+        
+        separator = next_char()
+        pos += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or ']' in JSON array, found {separator!r}")
+
+def _command_name(command):
+    """'takeScreenshotCommand' -> 'takeScreenshot' for a Maestro command entry."""
+    for key, value in command.items():
+        if value is not None:
+            return key[:-len("Command")] if key.endswith("Command") else key
+    return "unknown"
+
+def _resolve_screenshot(base_dir, path):
+    """Find the file Maestro wrote for a takeScreenshot path (saved with .png appended)."""
+    candidates = [path] if path.lower().endswith(SCREENSHOT_EXTENSIONS) else [f"{path}.png", path]
+    for candidate in candidates:
+        for directory in (base_dir, os.path.join(base_dir, ".maestro", "screenshots")):
+            full_path = os.path.join(directory, candidate)
+            if os.path.isfile(full_path):
+                return full_path
+    return None
+
+def _step_from_entry(index, entry):
+    """Build a step dict (without its screenshot) from one Maestro command entry."""
+    command = entry.get("command") or {}
+    metadata = entry.get("metadata") or {}
+    error = metadata.get("error")
+    return {
+        "index": index,
+        "command": _command_name(command),
+        "status": metadata.get("status", "UNKNOWN"),
+        "timestamp": metadata.get("timestamp"),
+        "duration_ms": metadata.get("duration"),
+        "screenshot": None,
+        "error": error.get("message") if isinstance(error, dict) else error,
+    }
+
+def parse_maestro_results(test_results):
+    """
+    Read Maestro command output in one streaming pass.
+    
+    Accepts the command list Maestro writes (a JSON array of
+    {"command": {...}, "metadata": {...}} entries) or an object holding it
+    under "commands". Returns a dict with:
+      steps               - per command: index, command, status, timestamp,
+                            duration_ms, screenshot and error
+      screenshot_paths    - existing screenshot files, in the order taken
+      missing_screenshots - takeScreenshot paths with no file on disk
+    """
+    base_dir = os.path.dirname(os.path.abspath(test_results))
+    steps = []
+    screenshot_paths = []
+    missing_screenshots = []
+    
+    with open(test_results, 'r', encoding='utf-8') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == "[":
+            entries = iter_json_array(f)
+        elif first == "{":
+            entries = json.load(f).get("commands") or []
+        else:
+            raise ValueError("Results file is empty or not JSON")
+        
+        for index, entry in enumerate(entries, start=1):
+            if not isinstance(entry, dict):
+                continue
+            step = _step_from_entry(index, entry)
+            
+            command = entry.get("command") or {}
+            screenshot = (command.get("takeScreenshotCommand") or {}).get("path")
+            if screenshot:
+                screenshot_path = _resolve_screenshot(base_dir, screenshot)
+                if screenshot_path is None:
+                    missing_screenshots.append(screenshot)
+                elif screenshot_path not in screenshot_paths:
+                    screenshot_paths.append(screenshot_path)
+                step["screenshot"] = screenshot_path
+            steps.append(step)
+    
+    return {
+        "steps": steps,
+        "screenshot_paths": screenshot_paths,
+        "missing_screenshots": missing_screenshots,
+    }
+
+def flow_name(results_file):
+    """'commands-(hello_world.yaml).json' -> 'hello_world.yaml'; other names lose their extension."""
+    name = os.path.basename(results_file)
+    match = MAESTRO_COMMANDS_FILE.match(name)
+    return match.group(1) if match else os.path.splitext(name)[0]
+
+def collect_results_files(sources):
+    """
+    Expand directories (searched recursively for *.json) and glob patterns
+    into a sorted, de-duplicated list of results files.
+    """
+    files = set()
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                files.update(os.path.join(root, name) for name in names
+                             if name.endswith(".json") and name != MANIFEST_FILENAME)
+        else:
+            files.update(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+    return sorted(files)
+
+def _index_results_file(results_file):
+    """
+    Read one results file into a compact run record for ResultsIndex.
+    
+    Returns (path, flow, commands, statuses, durations, start_ms), or
+    (path, None, error message) when the file cannot be read.
+    """
+    try:
+        with open(results_file, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries.get("commands") or []
+        if not isinstance(entries, list):
+            raise ValueError("not a Maestro command list")
+    except (OSError, ValueError) as e:
+        return (results_file, None, str(e))
+    
+    commands, statuses, durations = [], [], []
+    start_ms = None
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        metadata = entry.get("metadata") or {}
+        commands.append(_command_name(entry.get("command") or {}))
+        statuses.append(metadata.get("status", "UNKNOWN"))
+        duration = metadata.get("duration")
+        durations.append(float(duration) if isinstance(duration, (int, float)) else math.nan)
+        timestamp = metadata.get("timestamp")
+        if start_ms is None and isinstance(timestamp, (int, float)):
+            start_ms = timestamp
+    return (results_file, flow_name(results_file), commands, statuses, durations, start_ms)
+
+def _index_results_chunk(results_files):
+    """Worker-process entry point: index a chunk of results files."""
+    return [_index_results_file(results_file) for results_file in results_files]
+
+def percentiles(values, qs=REPORT_PERCENTILES):
+    """Linearly interpolated percentiles of values (NaNs ignored); None for no data."""
+    ordered = sorted(value for value in values if not math.isnan(value))
+    if not ordered:
+        return [None] * len(qs)
+    result = []
+    for q in qs:
+        rank = (len(ordered) - 1) * q / 100
+        low = int(rank)
+        high = min(low + 1, len(ordered) - 1)
+        result.append(ordered[low] + (ordered[high] - ordered[low]) * (rank - low))
+    return result
+
+def command_latency(samples):
+    """
+    Per-command latency from (command, duration_ms) samples.
+    
+    Returns dicts with command, count, percentiles and max_ms, slowest p95 first.
+    """
+    by_command = {}
+    for command, duration in samples:
+        if duration is not None and not math.isnan(duration):
+            by_command.setdefault(command, []).append(duration)
+    latency = [
+        {"command": command, "count": len(durations),
+         "percentiles": percentiles(durations), "max_ms": max(durations)}
+        for command, durations in by_command.items()
+    ]
+    latency.sort(key=lambda row: (-row["percentiles"][1], row["command"]))
+    return latency
+
+def slowest_steps(steps, limit=TOP_STEPS_LIMIT):
+    """The limit steps of one run with the longest durations, slowest first."""
+    timed = [step for step in steps if isinstance(step["duration_ms"], (int, float))]
+    return sorted(timed, key=lambda step: -step["duration_ms"])[:limit]
+
+class ResultsIndex:
+    """
+    Columnar in-memory index of many Maestro runs.
+    
+    Flow, command and status names are interned to small integers and every
+    column is a typed array, so 10k runs of a few dozen steps each fit in a
+    few MB and aggregate with plain loops over contiguous data.
+    
+    Run columns:  run_flow, run_passed, run_duration (ms), run_start (epoch ms
+                  of the first step, NaN if unknown), plus run_files.
+    Step columns: step_run, step_index, step_command, step_status,
+                  step_duration (ms, NaN if missing).
+    """
+    
+    def __init__(self):
+        self.names = {"flow": [], "command": [], "status": []}
+        self._ids = {"flow": {}, "command": {}, "status": {}}
+        self.run_files = []
+        self.run_flow = array("I")
+        self.run_passed = array("b")
+        self.run_duration = array("d")
+        self.run_start = array("d")
+        self.step_run = array("I")
+        self.step_index = array("I")
+        self.step_command = array("I")
+        self.step_status = array("I")
+        self.step_duration = array("d")
+        self.errors = []
+    
+    def intern(self, kind, name):
+        ids = self._ids[kind]
+        if name not in ids:
+            ids[name] = len(self.names[kind])
+            self.names[kind].append(name)
+        return ids[name]
+    
+    def add_run(self, record):
+        """Append one record from _index_results_file."""
+        if record[1] is None:
+            self.errors.append((record[0], record[2]))
+            return
+        path, flow, commands, statuses, durations, start_ms = record
+        run = len(self.run_files)
+        self.run_files.append(path)
+        self.run_flow.append(self.intern("flow", flow))
+        self.run_passed.append("FAILED" not in statuses)
+        self.run_duration.append(sum(d for d in durations if not math.isnan(d)))
+        self.run_start.append(math.nan if start_ms is None else float(start_ms))
+        
+        self.step_run.extend([run] * len(commands))
+        self.step_index.extend(range(1, len(commands) + 1))
+        self.step_command.extend([self.intern("command", command) for command in commands])
+        self.step_status.extend([self.intern("status", status) for status in statuses])
+        self.step_duration.extend(durations)
+    
+    def __len__(self):
+        return len(self.run_files)
+    
+    def flow_summary(self):
+        """Per flow: runs, passed, pass rate and run duration percentiles (ms)."""
+        by_flow = {}
+        for flow, passed, duration in zip(self.run_flow, self.run_passed, self.run_duration):
+            runs = by_flow.setdefault(flow, [0, []])
+            runs[0] += passed
+            runs[1].append(duration)
+        summary = []
+        for flow, (passed, durations) in sorted(by_flow.items(), key=lambda item: self.names["flow"][item[0]]):
+            summary.append({
+                "flow": self.names["flow"][flow],
+                "runs": len(durations),
+                "passed": passed,
+                "pass_rate": passed / len(durations),
+                "percentiles": percentiles(durations),
+            })
+        return summary
+    
+    def _steps_by_position(self):
+        """{(flow, step index, command): [step row, ...]} over every run."""
+        positions = {}
+        run_flow = self.run_flow
+        for row, (run, index, command) in enumerate(zip(self.step_run, self.step_index, self.step_command)):
+            positions.setdefault((run_flow[run], index, command), []).append(row)
+        return positions
+    
+    def _position_name(self, position):
+        flow, index, command = position
+        return self.names["flow"][flow], index, self.names["command"][command]
+    
+    def command_latency(self):
+        """command_latency() over every step of every run."""
+        commands = self.names["command"]
+        return command_latency(
+            (commands[command], duration) for command, duration in zip(self.step_command, self.step_duration)
+        )
+    
+    def slowest_steps(self, limit=TOP_STEPS_LIMIT):
+        """
+        Steps of a flow (identified by position and command) with the highest
+        p95 duration across runs: dicts with flow, index, command, runs and
+        percentiles.
+        """
+        step_duration = self.step_duration
+        rows = []
+        for position, step_rows in self._steps_by_position().items():
+            values = percentiles([step_duration[row] for row in step_rows])
+            if values[1] is None:
+                continue
+            flow, index, command = self._position_name(position)
+            rows.append({"flow": flow, "index": index, "command": command,
+                         "runs": len(step_rows), "percentiles": values})
+        rows.sort(key=lambda row: -row["percentiles"][1])
+        return rows[:limit]
+    
+    def flaky_steps(self, limit=TOP_STEPS_LIMIT):
+        """
+        Steps of a flow that both passed and failed across runs.
+        
+        Returns dicts with flow, index, command, runs, failures, failure_rate
+        and flips (pass/fail changes between consecutive runs, ordered by
+        start time), most flips first. Steps that were skipped or never
+        reached do not count as runs.
+        """
+        passed_ids = {self._ids["status"].get(status) for status in MAESTRO_PASSED_STATUSES}
+        failed_id = self._ids["status"].get("FAILED")
+        if failed_id is None:
+            return []
+        run_start = self.run_start
+        step_status = self.step_status
+        rows = []
+        for position, step_rows in self._steps_by_position().items():
+            outcomes = [
+                (run_start[self.step_run[row]], step_status[row] == failed_id)
+                for row in step_rows
+                if step_status[row] == failed_id or step_status[row] in passed_ids
+            ]
+            failures = sum(failed for _, failed in outcomes)
+            if not 0 < failures < len(outcomes):
+                continue
+            outcomes.sort(key=lambda outcome: (math.isnan(outcome[0]), outcome[0]))
+            flips = sum(a[1] != b[1] for a, b in zip(outcomes, outcomes[1:]))
+            flow, index, command = self._position_name(position)
+            rows.append({"flow": flow, "index": index, "command": command, "runs": len(outcomes),
+                         "failures": failures, "failure_rate": failures / len(outcomes),
+                         "flips": flips})
+        rows.sort(key=lambda row: (-row["flips"], -row["failures"], row["flow"], row["index"]))
+        return rows[:limit]
+    
+    def daily_trend(self):
+        """Per UTC day of the first step: [(date, flow, runs, passed)], oldest first."""
+        by_day = {}
+        for flow, passed, start in zip(self.run_flow, self.run_passed, self.run_start):
+            if math.isnan(start):
+                continue
+            day = datetime.fromtimestamp(start / 1000, timezone.utc).date().isoformat()
+            counts = by_day.setdefault((day, self.names["flow"][flow]), [0, 0])
+            counts[0] += 1
+            counts[1] += passed
+        return [(day, flow, runs, passed) for (day, flow), (runs, passed) in sorted(by_day.items())]
+
+def build_results_index(results_files, max_workers=1, chunk_size=AGGREGATE_CHUNK_SIZE):
+    """
+    Index results_files, parsing them in up to max_workers processes.
+    
+    Files are handed out in chunks so per-task overhead stays small; small
+    inputs (or max_workers <= 1) are parsed in this process.
+    """
+    index = ResultsIndex()
+    chunks = _chunks(results_files, chunk_size)
+    if max_workers <= 1 or len(results_files) <= chunk_size:
+        for chunk in chunks:
+            for record in _index_results_chunk(chunk):
+                index.add_run(record)
+        return index
+    
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for chunk_records in executor.map(_index_results_chunk, chunks):
+            for record in chunk_records:
+                index.add_run(record)
+    return index
+
+def find_screenshots(test_results):
+    """Return the screenshots next to the results file, sorted for a stable report order."""
+    screenshot_dir = os.path.join(os.path.dirname(test_results), ".maestro/screenshots")
+    screenshot_paths = []
+    with trace("find_screenshots") as span:
+        if os.path.exists(screenshot_dir):
+            for root, _, files in os.walk(screenshot_dir):
+                for file in files:
+                    if file.lower().endswith(SCREENSHOT_EXTENSIONS):
+                        screenshot_paths.append(os.path.join(root, file))
+        span.add(items=len(screenshot_paths))
+    return sorted(screenshot_paths)
+
+def _duplicate_analysis(duplicate_of, base_dir):
+    rep_index, rep_path, distance = duplicate_of
+    return {
+        "status": "duplicate",
+        "reason": f"Near-identical to screenshot {rep_index} (distance {distance})",
+        "representative_index": rep_index,
+        "representative": os.path.relpath(rep_path, start=base_dir),
+        "distance": distance,
+    }
+
+def process_screenshot(screenshot_path, base_dir, api_url=None, cache=None, duplicate_of=None,
+                       preprocessor=None, client=None, analyzer=None):
+    """
+    Collect metadata and (when configured) AI analysis for one screenshot.
+    
+    duplicate_of is a (representative_index, representative_path, distance)
+    tuple from group_near_duplicates; such screenshots are never sent for analysis.
+    analyzer is the analysis backend; by default a RemoteAnalyzer built from
+    api_url, cache, preprocessor and client.
+    """
+    analyzer = analyzer or RemoteAnalyzer(api_url, cache, preprocessor, client)
+    with trace("metadata", items=1):
+        metadata = get_screenshot_metadata(screenshot_path)
+    
+    # Only do AI analysis if explicitly requested and dependencies are available
+    ai_analysis = {"status": "skipped", "reason": "AI analysis not requested"}
+    if duplicate_of is not None:
+        ai_analysis = _duplicate_analysis(duplicate_of, base_dir)
+    elif analyzer.unavailable_reason() is None:
+        print(f"Analyzing screenshot: {os.path.basename(screenshot_path)}")
+        with trace("analysis", items=1, backend=analyzer.name):
+            ai_analysis = analyzer.analyze(screenshot_path)
+    
+    return {
+        "metadata": metadata,
+        "ai_analysis": ai_analysis,
+        "relative_path": os.path.relpath(screenshot_path, start=base_dir)
+    }
+
+def process_screenshot_batch(screenshot_paths, base_dir, api_url=None, cache=None, duplicates=None,
+                             preprocessor=None, client=None, max_bytes=DEFAULT_BATCH_MAX_BYTES,
+                             analyzer=None):
+    """Batch-mode counterpart of process_screenshot: one result per path, in order."""
+    analyzer = analyzer or RemoteAnalyzer(api_url, cache, preprocessor, client, max_bytes=max_bytes)
+    duplicates = duplicates or {}
+    available = analyzer.unavailable_reason() is None
+    results = []
+    to_analyze = []
+    for screenshot_path in screenshot_paths:
+        with trace("metadata", items=1):
+            metadata = get_screenshot_metadata(screenshot_path)
+        result = {
+            "metadata": metadata,
+            "ai_analysis": {"status": "skipped", "reason": "AI analysis not requested"},
+            "relative_path": os.path.relpath(screenshot_path, start=base_dir)
+        }
+        if screenshot_path in duplicates:
+            result["ai_analysis"] = _duplicate_analysis(duplicates[screenshot_path], base_dir)
+        elif available:
+            to_analyze.append((result, screenshot_path))
+        results.append(result)
+    
+    if to_analyze:
+        names = ", ".join(os.path.basename(path) for _, path in to_analyze)
+        print(f"Analyzing batch of {len(to_analyze)} screenshots: {names}")
+        with trace("analysis", items=len(to_analyze), backend=analyzer.name):
+            analyses = analyzer.analyze_batch([path for _, path in to_analyze])
+        for (result, _), analysis in zip(to_analyze, analyses):
+            result["ai_analysis"] = analysis
+    return results
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_analyzed_screenshots(screenshot_paths, base_dir, max_workers=1, api_url=None, cache=None,
+                              duplicates=None, preprocessor=None, client=None, batch_size=1,
+                              batch_max_bytes=DEFAULT_BATCH_MAX_BYTES, reuse=None, analyzer=None, compare=None):
+    """
+    Yield processed screenshots in input order with at most max_workers in flight.
+    
+    Each worker runs the whole per-screenshot stage (metadata, base64 encoding and
+    the API round trip), so slow HTTP calls overlap with local work. Only a small
+    window of futures is kept pending, so finished results are handed to the caller
+    as soon as every earlier screenshot is done instead of piling up in memory.
+    
+    duplicates is the mapping returned by group_near_duplicates, if any. With
+    batch_size > 1 each unit of work is a run of consecutive screenshots analysed
+    by process_screenshot_batch. reuse maps paths to already finished results
+    (from a previous run's manifest, or a finished job), which are passed
+    through untouched.
+    
+    compare, when given, is called in the worker as compare(number, path), with
+    number counting from 1 (see baseline_comparer). Frames it reports unchanged
+    are not analysed, and every result carries its comparison under "baseline".
+    """
+    duplicates = duplicates or {}
+    reuse = reuse or {}
+    numbered = enumerate(screenshot_paths, start=1)
+    
+    if batch_size > 1:
+        units = _chunks(numbered, batch_size)
+        
+        def process_fresh(paths):
+            return process_screenshot_batch(paths, base_dir, api_url=api_url, cache=cache,
+                                            duplicates=duplicates, preprocessor=preprocessor,
+                                            client=client, max_bytes=batch_max_bytes, analyzer=analyzer)
+    else:
+        units = ([item] for item in numbered)
+        
+        def process_fresh(paths):
+            return [process_screenshot(paths[0], base_dir, api_url=api_url, cache=cache,
+                                       duplicate_of=duplicates.get(paths[0]),
+                                       preprocessor=preprocessor, client=client, analyzer=analyzer)]
+    
+    def process(unit):
+        comparisons = [compare(number, path) for number, path in unit] if compare else None
+        finished = {}
+        for position, (_, path) in enumerate(unit):
+            if comparisons and comparisons[position]["status"] == "unchanged":
+                finished[path] = _baseline_match(path, base_dir, comparisons[position])
+            elif path in reuse:
+                finished[path] = reuse[path]
+        fresh = [path for _, path in unit if path not in finished]
+        computed = iter(process_fresh(fresh) if fresh else [])
+        results = [finished[path] if path in finished else next(computed) for _, path in unit]
+        if comparisons:
+            results = [dict(result, baseline=dict(comparison)) for result, comparison in zip(results, comparisons)]
+        return results
+    
+    if max_workers <= 1:
+        for unit in units:
+            yield from process(unit)
+        return
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for unit in units:
+            pending.append(executor.submit(process, unit))
+            if len(pending) >= max_workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def analyze_screenshots(screenshot_paths, base_dir, max_workers=1, api_url=None, cache=None,
+                        duplicates=None, preprocessor=None, client=None, batch_size=1,
+                        batch_max_bytes=DEFAULT_BATCH_MAX_BYTES, analyzer=None):
+    """Process all screenshots and return the results as a list, in input order."""
+    return list(iter_analyzed_screenshots(
+        screenshot_paths, base_dir, max_workers=max_workers, api_url=api_url, cache=cache,
+        duplicates=duplicates, preprocessor=preprocessor, client=client, batch_size=batch_size,
+        batch_max_bytes=batch_max_bytes, analyzer=analyzer,
+    ))
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def analysis_settings(preprocessor=None, batch_size=1, analyzer=None):
+    """Fingerprint of everything besides the image that changes an analysis."""
+    prompt = BATCH_ANALYSIS_PROMPT if batch_size > 1 else ANALYSIS_PROMPT
+    return "|".join([
+        analyzer.name if analyzer else RemoteAnalyzer.name,
+        DEFAULT_MODEL,
+        hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16],
+        preprocessor.cache_tag if preprocessor else "original",
+    ])
+
+def load_manifest(manifest_path):
+    """Return a previously written manifest, or None if it is missing or unreadable."""
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def find_unchanged_entries(manifest, screenshot_paths):
+    """
+    Return {path: manifest entry} for screenshots whose content is unchanged.
+    
+    A matching (size, mtime_ns) is trusted without reading the file; when only
+    the mtime differs the content hash decides.
+    """
+    previous = {entry["path"]: entry for entry in manifest.get("screenshots", [])}
+    unchanged = {}
+    for screenshot_path in screenshot_paths:
+        entry = previous.get(screenshot_path)
+        if entry is None:
+            continue
+        try:
+            stat = os.stat(screenshot_path)
+            if stat.st_size != entry["size"]:
+                continue
+            if stat.st_mtime_ns != entry["mtime_ns"]:
+                if file_sha256(screenshot_path) != entry["sha256"]:
+                    continue
+                entry = dict(entry, mtime_ns=stat.st_mtime_ns)
+        except (OSError, KeyError):
+            continue
+        unchanged[screenshot_path] = entry
+    return unchanged
+
+class ManifestWriter:
+    """
+    Streams manifest entries to a temporary file next to the manifest.
+    
+    The previous manifest is only replaced (atomically) by commit(), so an
+    interrupted run never leaves a truncated manifest behind.
+    """
+    
+    def __init__(self, manifest_path, results_file, report_path, settings, steps):
+        self.manifest_path = manifest_path
+        directory = os.path.dirname(os.path.abspath(manifest_path))
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        self.f = os.fdopen(fd, "w", encoding="utf-8")
+        header = json.dumps({
+            "version": MANIFEST_VERSION,
+            "results_file": results_file,
+            "report": os.path.basename(report_path),
+            "generated": datetime.now().isoformat(timespec="seconds"),
+            "settings": settings,
+            "steps": steps,
+        })
+        self.f.write(header[:-1] + ', "screenshots": [')
+        self.count = 0
+    
+    def add(self, screenshot, previous_entry=None, dhash_value=None):
+        """Record one processed screenshot; previous_entry supplies hashes for unchanged files."""
+        screenshot_path = screenshot["metadata"]["path"]
+        if previous_entry is not None:
+            size, mtime_ns = previous_entry["size"], previous_entry["mtime_ns"]
+            sha256 = previous_entry["sha256"]
+        else:
+            stat = os.stat(screenshot_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            sha256 = file_sha256(screenshot_path)
+        entry = {
             "path": screenshot_path,
-            "width": img.width,
-            "height": img.height,
-            "format": img.format,
-            "mode": img.mode,
+            "relative_path": screenshot["relative_path"],
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "sha256": sha256,
+            "dhash": dhash_value,
+            "metadata": screenshot["metadata"],
+            "ai_analysis": screenshot["ai_analysis"],
+            "thumbnail": screenshot.get("thumbnail"),
+            "full_size": screenshot.get("full_size"),
+            "baseline": screenshot.get("baseline"),
         }
-        
-        # Get EXIF data if available
-        if hasattr(img, '_getexif') and img._getexif():
-            exif = {TAGS.get(k, k): v for k, v in img._getexif().items()}
-            metadata["datetime"] = exif.get("DateTime", "Unknown")
-        
-        return metadata
-    except Exception as e:
-        print(f"Error processing image {screenshot_path}: {e}")
-        return {"path": screenshot_path, "error": str(e)}
+        self.f.write(("," if self.count else "") + "\n" + json.dumps(entry))
+        self.count += 1
+    
+    def commit(self):
+        self.f.write("\n]}\n")
+        self.f.close()
+        os.replace(self.tmp_path, self.manifest_path)
+    
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmp_path)
 
-def analyze_screenshot_with_ai(screenshot_path):
-    """Analyze screenshot with AI to identify UI elements and potential issues."""
-    if not HAS_REQUESTS:
-        return {"status": "skipped", "reason": "requests library not available"}
-        
-    # Check for API key
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        return {"status": "skipped", "reason": "OpenAI API key not found in environment"}
+def rebuild_report_from_manifest(manifest_path, output_dir="."):
+    """Regenerate the HTML report from a manifest alone: no image reads, no network."""
+    manifest = load_manifest(manifest_path)
+    if manifest is None:
+        print(f"Error: No usable manifest at {manifest_path}")
+        return False
     
-    try:
-        # Convert image to base64
-        with open(screenshot_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        # Send to OpenAI API
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_path = os.path.join(output_dir, f"maestro_report_{timestamp}.html")
+    
+    steps = manifest.get("steps", [])
+    step_by_screenshot = {step["screenshot"]: step for step in steps if step.get("screenshot")}
+    with open(report_path, 'w') as f:
+        write_report_header(f, manifest["results_file"], steps)
+        for index, entry in enumerate(manifest["screenshots"], start=1):
+            write_screenshot_item(f, index, entry, step_by_screenshot.get(entry["path"]))
+        write_report_footer(f)
+    
+    print(f"Report rebuilt from manifest: {report_path}")
+    return report_path
+
+class ReportBundle:
+    """
+    Builds the zip bundle of a report while the report is being streamed.
+    
+    Assets are stored in the archive as soon as their screenshot is written
+    (images as is; they are already compressed), and the archived copy of the
+    report, whose links point into the archive, goes to a temporary file; so
+    nothing kept in memory grows with the run. The bundle only appears next
+    to the report, atomically, on commit().
+    """
+    
+    def __init__(self, report_path):
+        self.bundle_path = os.path.splitext(report_path)[0] + ".zip"
+        self.report_name = os.path.basename(report_path)
+        directory = os.path.dirname(os.path.abspath(report_path))
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        fd, self.report_tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        self.report = os.fdopen(fd, "wb")
+        self.archive = zipfile.ZipFile(self.tmp_path, "w", compression=zipfile.ZIP_DEFLATED)
+        self.count = 0
+    
+    def add(self, name, path):
+        """Store the file at path as name; a name already stored (shared thumbnails) is skipped."""
+        try:
+            self.archive.getinfo(name)
+        except KeyError:
+            self.archive.write(path, name, compress_type=zipfile.ZIP_STORED)
+            self.count += 1
+    
+    def write(self, html, links=None):
+        """
+        Append html to the archived copy of the report.
         
-        payload = {
-            "model": "gpt-4-vision-preview",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Analyze this mobile app UI screenshot. Identify UI elements, layout structure, and point out any potential UX issues or improvements."
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encoded_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 300
-        }
+        links ({link in the report: archive name}) are rewritten in that copy
+        only, so the report on disk keeps pointing at the files on disk.
+        """
+        data = html.encode("utf-8")
+        if links:
+            links = {link.encode("utf-8"): name.encode("utf-8") for link, name in links.items()}
+            data = LINK_ATTRIBUTE.sub(
+                lambda match: match.group(1) + b'="' + links.get(match.group(2), match.group(2)) + b'"', data)
+        self.report.write(data)
+    
+    def commit(self):
+        """Add the report copy and move the bundle into place; returns its path."""
+        self.report.close()
+        self.archive.write(self.report_tmp_path, self.report_name)
+        self.archive.close()
+        os.unlink(self.report_tmp_path)
+        os.replace(self.tmp_path, self.bundle_path)
+        return self.bundle_path
+    
+    def abort(self):
+        self.report.close()
+        self.archive.close()
+        os.unlink(self.report_tmp_path)
+        os.unlink(self.tmp_path)
+
+class JobQueue:
+    """
+    Per-screenshot state of a resumable report job, kept in a SQLite file.
+    
+    Screenshots move from pending to running (claimed by one worker) to done
+    or failed, and finished results are stored with them. Any number of worker
+    processes on the same machine can share a queue: claims are taken in
+    IMMEDIATE transactions, and screenshots claimed by a worker that died (or
+    whose lease ran out) are handed out again. config, when given, is the
+    analyzer configuration workers in other processes build their backend
+    from (see analyzer_from_config).
+    """
+    
+    def __init__(self, path, config=None):
+        import sqlite3
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS items (
+                path TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                pid INTEGER,
+                lease_until REAL,
+                result TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS items_by_state ON items (state, position);
+        """)
+        if config is not None:
+            with self._transaction() as db:
+                self._set_meta(db, "config", config)
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+    
+    @staticmethod
+    def _set_meta(db, key, value):
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+    
+    @staticmethod
+    def _get_meta(db, key, default=None):
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+    
+    def meta(self, key, default=None):
+        with self.lock:
+            return self._get_meta(self.db, key, default)
+    
+    def enqueue(self, screenshot_paths, settings, base_dir, batch_size=1):
+        """
+        Make the queue hold exactly screenshot_paths, keeping the state of known ones.
         
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload
-        )
+        Results computed under different analysis settings are discarded, and
+        screenshots left running by a dead process go back to pending.
+        """
+        with self._transaction() as db:
+            if self._get_meta(db, "settings") not in (None, settings):
+                db.execute("UPDATE items SET state = 'pending', attempts = 0, result = NULL, error = NULL")
+            self._set_meta(db, "settings", settings)
+            self._set_meta(db, "base_dir", base_dir)
+            self._set_meta(db, "batch_size", batch_size)
+            
+            wanted = set(screenshot_paths)
+            stale = [(path,) for (path,) in db.execute("SELECT path FROM items") if path not in wanted]
+            db.executemany("DELETE FROM items WHERE path = ?", stale)
+            db.executemany("INSERT OR IGNORE INTO items (path, position) VALUES (?, ?)",
+                           ((path, position) for position, path in enumerate(screenshot_paths)))
+            db.executemany("UPDATE items SET position = ? WHERE path = ?",
+                           ((position, path) for position, path in enumerate(screenshot_paths)))
+            
+            orphaned = [(path,) for path, pid in db.execute("SELECT path, pid FROM items WHERE state = 'running'")
+                        if not _pid_alive(pid)]
+            db.executemany("UPDATE items SET state = 'pending' WHERE path = ?", orphaned)
+    
+    def claim(self, limit=1):
+        """Claim up to limit pending (or abandoned) screenshots, in report order."""
+        now = time.time()
+        with self._transaction() as db:
+            paths = [path for (path,) in db.execute(
+                "SELECT path FROM items WHERE state = 'pending' OR (state = 'running' AND lease_until < ?) "
+                "ORDER BY position LIMIT ?", (now, limit))]
+            db.executemany(
+                "UPDATE items SET state = 'running', pid = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE path = ?", ((os.getpid(), now + JOB_LEASE_SECONDS, path) for path in paths))
+        return paths
+    
+    def finish(self, results):
+        """
+        Store (path, result) pairs.
         
-        if response.status_code == 200:
-            result = response.json()
-            analysis = result["choices"][0]["message"]["content"]
-            return {
-                "status": "success",
-                "analysis": analysis
-            }
-        else:
-            return {
-                "status": "error",
-                "reason": f"API error: {response.status_code}",
-                "details": response.text
-            }
+        Results whose analysis errored are marked failed. Screenshots that were
+        not analysed at all (skipped, e.g. without an API key) go back to
+        pending without a result, so a later run analyses them.
+        """
+        rows = []
+        for path, result in results:
+            analysis = result["ai_analysis"]
+            status = analysis.get("status")
+            if status in JOB_DONE_STATUSES:
+                rows.append(("done", json.dumps(result), None, path))
+            elif status == "error":
+                rows.append(("failed", json.dumps(result), analysis.get("reason"), path))
+            else:
+                rows.append(("pending", None, None, path))
+        with self._transaction() as db:
+            db.executemany("UPDATE items SET state = ?, result = ?, error = ?, pid = NULL WHERE path = ?", rows)
     
-    except Exception as e:
-        return {"status": "error", "reason": str(e)}
-
-def generate_report(test_results, output_dir="."):
-    """Generate an HTML report with AI insights from test results."""
-    # Create output directory if it doesn't exist
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    def release(self, paths):
+        """Put claimed screenshots back, e.g. when their worker is interrupted."""
+        with self._transaction() as db:
+            db.executemany("UPDATE items SET state = 'pending', pid = NULL WHERE path = ? AND state = 'running'",
+                           ((path,) for path in paths))
     
-    # Parse test results
-    results = {}
+    def retry(self, screenshots=None):
+        """
+        Return failed screenshots to pending; screenshots limits this to the
+        given paths or file names. Returns the paths that will be retried.
+        """
+        with self._transaction() as db:
+            paths = [path for (path,) in db.execute("SELECT path FROM items WHERE state = 'failed'")
+                     if not screenshots or path in screenshots or os.path.basename(path) in screenshots]
+            db.executemany("UPDATE items SET state = 'pending', result = NULL, error = NULL WHERE path = ?",
+                           ((path,) for path in paths))
+        return paths
+    
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM items GROUP BY state"))
+    
+    def failures(self):
+        """(path, attempts, error) of every failed screenshot, in report order."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, attempts, error FROM items WHERE state = 'failed' ORDER BY position").fetchall()
+    
+    def results(self):
+        """Finished (done or failed) results by screenshot path."""
+        with self.lock:
+            rows = self.db.execute("SELECT path, result FROM items WHERE state IN ('done', 'failed')").fetchall()
+        return {path: json.loads(result) for path, result in rows}
+    
+    def close(self):
+        self.db.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def _pid_alive(pid):
+    if pid is None:
+        return False
     try:
-        with open(test_results, 'r') as f:
-            results = json.load(f)
-    except Exception as e:
-        print(f"Error reading test results: {e}")
+        os.kill(pid, 0)
+    except ProcessLookupError:
         return False
+    except PermissionError:
+        return True
+    return True
+
+def analyzer_from_config(config):
+    """
+    Build (analyzer, client) from a job queue's analyzer configuration.
     
-    # Basic validation
-    if not isinstance(results, dict):
-        print("Error: Invalid test results format")
-        return False
+    config holds the CLI's analysis options: analyzer, api_url, api_key (only
+    for the stub), cache_dir, upload_format, max_dimension, upload_quality,
+    batch_max_bytes, timeout, max_retries and rate_limit.
+    """
+    if config.get("analyzer") == "heuristic":
+        return HeuristicAnalyzer(), None
+    client = None
+    if HAS_REQUESTS:
+        client = AIClient(
+            config.get("api_url"),
+            timeout=config.get("timeout", DEFAULT_TIMEOUT),
+            max_retries=config.get("max_retries", DEFAULT_MAX_RETRIES),
+            rate_limit=config.get("rate_limit"),
+            pool_size=max(config.get("threads", 1), 1),
+        )
+    cache = AnalysisCache(config["cache_dir"]) if config.get("cache_dir") else None
+    upload_format = config.get("upload_format", "original")
+    preprocessor = None if upload_format == "original" else ImagePreprocessor(
+        config.get("max_dimension", DEFAULT_MAX_DIMENSION), upload_format,
+        config.get("upload_quality", DEFAULT_UPLOAD_QUALITY)
+    )
+    analyzer_class = StubAnalyzer if config.get("analyzer") == "stub" else RemoteAnalyzer
+    analyzer = analyzer_class(config.get("api_url"), cache, preprocessor, client, api_key=config.get("api_key"),
+                              max_bytes=config.get("batch_max_bytes", DEFAULT_BATCH_MAX_BYTES))
+    return analyzer, client
+
+def run_job_worker(queue_path, analyzer=None, threads=1):
+    """
+    Process screenshots from the queue at queue_path until none are left to claim.
     
-    # Create report filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    report_path = os.path.join(output_dir, f"maestro_report_{timestamp}.html")
+    analyzer defaults to one built from the queue's configuration, which is how
+    workers in other processes get theirs. threads workers claim and process
+    concurrently; nothing is claimed while the analyzer is unavailable.
+    Returns the number of screenshots processed.
+    """
+    queue = JobQueue(queue_path)
+    client = None
+    try:
+        if analyzer is None:
+            config = queue.meta("config")
+            if config is None:
+                raise ValueError(f"Job queue {queue_path} has no analyzer configuration")
+            analyzer, client = analyzer_from_config(dict(config, threads=threads))
+        reason = analyzer.unavailable_reason()
+        if reason is not None:
+            print(f"Job queue {queue_path}: not processing, {reason}")
+            return 0
+        base_dir = queue.meta("base_dir")
+        batch_size = max(queue.meta("batch_size", 1), 1)
+        
+        def work():
+            processed = 0
+            while True:
+                paths = queue.claim(batch_size)
+                if not paths:
+                    return processed
+                try:
+                    if batch_size > 1:
+                        results = process_screenshot_batch(paths, base_dir, analyzer=analyzer)
+                    else:
+                        results = [process_screenshot(paths[0], base_dir, analyzer=analyzer)]
+                except BaseException:
+                    queue.release(paths)
+                    raise
+                queue.finish(zip(paths, results))
+                processed += len(paths)
+        
+        if threads <= 1:
+            return work()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(work) for _ in range(threads)]
+            return sum(future.result() for future in futures)
+    finally:
+        if client is not None:
+            client.close()
+        queue.close()
+
+def run_job(queue, screenshot_paths, settings, base_dir, batch_size=1, analyzer=None, workers=1, threads=1):
+    """
+    Bring the queue up to date with screenshot_paths and drain it.
     
-    # Find screenshots - this is just a simplified example
-    # In a real script, you would parse the test results to find the actual screenshots
-    screenshot_dir = os.path.join(os.path.dirname(test_results), ".maestro/screenshots")
-    screenshots = []
-    
-    if os.path.exists(screenshot_dir):
-        for root, _, files in os.walk(screenshot_dir):
-            for file in files:
-                if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    screenshot_path = os.path.join(root, file)
-                    metadata = get_screenshot_metadata(screenshot_path)
-                    
-                    # Only do AI analysis if explicitly requested and dependencies are available
-                    ai_analysis = {"status": "skipped", "reason": "AI analysis not requested"}
-                    if HAS_REQUESTS and os.environ.get("OPENAI_API_KEY"):
-                        print(f"Analyzing screenshot: {file}")
-                        ai_analysis = analyze_screenshot_with_ai(screenshot_path)
-                    
-                    screenshots.append({
-                        "metadata": metadata,
-                        "ai_analysis": ai_analysis,
-                        "relative_path": os.path.relpath(screenshot_path, start=os.path.dirname(test_results))
-                    })
-    
-    # Generate HTML report
-    with open(report_path, 'w') as f:
-        f.write(f"""<!DOCTYPE html>
+    With workers > 1 that many worker processes are spawned; otherwise the
+    queue is worked in this process with analyzer. Workers whose analyzer is
+    unavailable claim nothing, so the screenshots stay pending for a later run.
+    Returns the finished results by path; failures stay failed until retried
+    with "job retry".
+    """
+    queue.enqueue(screenshot_paths, settings, base_dir, batch_size)
+    counts = queue.counts()
+    print(f"Job queue {queue.path}: {counts.get('done', 0)} done, {counts.get('failed', 0)} failed, "
+          f"{counts.get('pending', 0) + counts.get('running', 0)} to process")
+    if workers <= 1:
+        run_job_worker(queue.path, analyzer=analyzer, threads=threads)
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [executor.submit(run_job_worker, queue.path, threads=threads) for _ in range(workers)]
+            for future in futures:
+                future.result()
+    
+    failed = queue.counts().get("failed", 0)
+    if failed:
+        print(f"Job queue: {failed} screenshots failed; "
+              f"retry them with: generate_ai_report.py job retry {queue.path}")
+    return queue.results()
+
+def write_steps_summary(f, steps):
+    """Write the pass/fail summary and per-step timing table for parsed Maestro steps."""
+    passed = sum(1 for step in steps if step["status"] in MAESTRO_PASSED_STATUSES)
+    failed = sum(1 for step in steps if step["status"] == "FAILED")
+    total_ms = sum(step["duration_ms"] or 0 for step in steps)
+    f.write(f"""    <p>Steps: {len(steps)} ({passed} passed, {failed} failed), total duration {total_ms / 1000:.1f} s</p>
+    <table class="steps">
+        <tr><th>#</th><th>Command</th><th>Status</th><th>Duration (ms)</th></tr>
+""")
+    for step in steps:
+        status_class = "success" if step["status"] in MAESTRO_PASSED_STATUSES else (
+            "error" if step["status"] == "FAILED" else "skipped")
+        duration = step["duration_ms"] if step["duration_ms"] is not None else ""
+        f.write(f"""        <tr><td>{step["index"]}</td><td>{step["command"]}</td><td class="{status_class}">{step["status"]}</td><td>{duration}</td></tr>\n""")
+    f.write("""    </table>\n""")
+    write_step_timing(f, steps)
+
+def _format_seconds(ms):
+    return "" if ms is None else f"{ms / 1000:.2f}"
+
+def _percentile_headers():
+    return "".join(f"<th>p{q} (s)</th>" for q in REPORT_PERCENTILES)
+
+def _percentile_cells(values):
+    return "".join(f"<td>{_format_seconds(value)}</td>" for value in values)
+
+def write_latency_table(f, latency):
+    """Write a per-command latency table from command_latency()."""
+    f.write(f"""    
+    <h3>Command Latency</h3>
+    <table class="steps">
+        <tr><th>Command</th><th>Count</th>{_percentile_headers()}<th>Max (s)</th></tr>
+""")
+    for row in latency:
+        f.write(f"""        <tr><td>{row["command"]}</td><td>{row["count"]}</td>{_percentile_cells(row["percentiles"])}<td>{_format_seconds(row["max_ms"])}</td></tr>\n""")
+    f.write("""    </table>\n""")
+
+def write_step_timing(f, steps):
+    """Write command latency and slowest-step tables for one run's steps."""
+    latency = command_latency((step["command"], step["duration_ms"]) for step in steps
+                              if isinstance(step["duration_ms"], (int, float)))
+    if not latency:
+        return
+    write_latency_table(f, latency)
+    f.write("""    
+    <h3>Slowest Steps</h3>
+    <table class="steps">
+        <tr><th>#</th><th>Command</th><th>Status</th><th>Duration (s)</th></tr>
+""")
+    for step in slowest_steps(steps):
+        f.write(f"""        <tr><td>{step["index"]}</td><td>{step["command"]}</td><td>{step["status"]}</td><td>{_format_seconds(step["duration_ms"])}</td></tr>\n""")
+    f.write("""    </table>\n""")
+
+def write_html_head(f, title):
+    """Write the document head, shared stylesheet and page heading."""
+    f.write(f"""<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Maestro AI Test Report</title>
+    <title>{title}</title>
     <style>
         body {{
             font-family: Arial, sans-serif;
@@ -235,55 +2950,123 @@ def generate_report(test_results, output_dir="."):
         .skipped {{
             color: orange;
         }}
+        .steps {{
+            border-collapse: collapse;
+        }}
+        .steps th, .steps td {{
+            border: 1px solid #ddd;
+            padding: 4px 8px;
+            text-align: left;
+        }}
     </style>
 </head>
 <body>
-    <h1>Maestro AI Test Report</h1>
+    <h1>{title}</h1>
     <p>Generated on {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p>
-    
+""")
+
+def write_report_header(f, test_results, steps=None):
+    """Write everything up to and including the opening screenshot container."""
+    write_html_head(f, "Maestro AI Test Report")
+    f.write(f"""    
     <h2>Test Summary</h2>
     <p>File: {os.path.basename(test_results)}</p>
+""")
+    if steps:
+        write_steps_summary(f, steps)
     
+    f.write("""    
     <h2>Screenshots Analysis</h2>
     <div class="screenshot-container">
 """)
 
-        for i, screenshot in enumerate(screenshots):
-            metadata = screenshot["metadata"]
-            ai_analysis = screenshot["ai_analysis"]
-            
-            status_class = "skipped"
-            if ai_analysis["status"] == "success":
-                status_class = "success"
-            elif ai_analysis["status"] == "error":
-                status_class = "error"
-            
-            f.write(f"""
+def _screenshot_image(index, screenshot):
+    """Lazily loaded <img>: the thumbnail linking to the full-size image when there is one."""
+    full_size = screenshot.get("full_size") or screenshot["relative_path"]
+    thumbnail = screenshot.get("thumbnail")
+    if not thumbnail:
+        return f'<img src="{full_size}" alt="Screenshot {index}" loading="lazy">'
+    return (f'<a href="{full_size}"><img src="{THUMBNAIL_DIR}/{thumbnail["file"]}" '
+            f'width="{thumbnail["width"]}" height="{thumbnail["height"]}" '
+            f'alt="Screenshot {index}" loading="lazy"></a>')
+
+def _baseline_summary(baseline):
+    if baseline["status"] == "new":
+        return "no baseline image"
+    if baseline["status"] == "error":
+        return f"comparison failed ({baseline['reason']})"
+    if baseline["status"] == "size-changed":
+        return f"{baseline['status']} vs {os.path.basename(baseline['baseline'])}"
+    summary = (f"{baseline['status']}, {baseline['similarity']:.2%} similar "
+               f"({baseline['changed_pixels']} changed pixels)")
+    if baseline.get("heatmap_src"):
+        summary += f' &ndash; <a href="{baseline["heatmap_src"]}">diff heatmap</a>'
+    return summary
+
+def write_screenshot_item(f, index, screenshot, step=None):
+    """Write one screenshot-item block; index is 1-based, step the Maestro step that took it."""
+    metadata = screenshot["metadata"]
+    ai_analysis = screenshot["ai_analysis"]
+    
+    status_class = "skipped"
+    if ai_analysis["status"] == "success":
+        status_class = "success"
+    elif ai_analysis["status"] == "error":
+        status_class = "error"
+    
+    f.write(f"""
         <div class="screenshot-item">
-            <h3>Screenshot {i+1}: {os.path.basename(metadata["path"])}</h3>
-            <img src="{screenshot['relative_path']}" alt="Screenshot {i+1}">
+            <h3 id="screenshot-{index}">Screenshot {index}: {os.path.basename(metadata["path"])}</h3>
+            {_screenshot_image(index, screenshot)}
             <div class="metadata">
                 <p><strong>Path:</strong> {metadata["path"]}</p>
 """)
-            
-            # Add extra metadata if available
-            if "width" in metadata:
-                f.write(f"""                <p><strong>Dimensions:</strong> {metadata["width"]}x{metadata["height"]}</p>\n""")
-            if "format" in metadata:
-                f.write(f"""                <p><strong>Format:</strong> {metadata["format"]}</p>\n""")
-            
-            f.write(f"""            </div>
+    
+    # Add extra metadata if available
+    if "width" in metadata:
+        f.write(f"""                <p><strong>Dimensions:</strong> {metadata["width"]}x{metadata["height"]}</p>\n""")
+    if "format" in metadata:
+        f.write(f"""                <p><strong>Format:</strong> {metadata["format"]}</p>\n""")
+    if step is not None:
+        f.write(f"""                <p><strong>Step:</strong> #{step["index"]} {step["command"]} ({step["status"]}, {step["duration_ms"]} ms)</p>\n""")
+    baseline = screenshot.get("baseline")
+    if baseline:
+        f.write(f"""                <p><strong>Baseline:</strong> {_baseline_summary(baseline)}</p>\n""")
+    if "bytes_after" in ai_analysis:
+        f.write(f"""                <p><strong>Upload size:</strong> {ai_analysis["bytes_before"] // 1024} KB &rarr; {ai_analysis["bytes_after"] // 1024} KB</p>\n""")
+    
+    f.write(f"""            </div>
             <h4>AI Analysis <span class="{status_class}">({ai_analysis["status"]})</span></h4>
 """)
 
-            if ai_analysis["status"] == "success":
-                f.write(f"""            <div class="analysis">{ai_analysis["analysis"]}</div>\n""")
-            else:
-                f.write(f"""            <div class="analysis">Reason: {ai_analysis.get("reason", "Unknown")}</div>\n""")
-            
-            f.write("""        </div>\n""")
-        
-        f.write("""
+    if ai_analysis["status"] == "success":
+        f.write(f"""            <div class="analysis">{ai_analysis["analysis"]}</div>\n""")
+    elif ai_analysis["status"] == "duplicate":
+        rep_index = ai_analysis["representative_index"]
+        f.write(f"""            <div class="analysis">Near-identical to <a href="#screenshot-{rep_index}">Screenshot {rep_index}: {os.path.basename(ai_analysis["representative"])}</a> (distance {ai_analysis["distance"]}); see its analysis.</div>\n""")
+    else:
+        f.write(f"""            <div class="analysis">Reason: {ai_analysis.get("reason", "Unknown")}</div>\n""")
+    
+    f.write("""        </div>\n""")
+
+def write_trace_summary(f, tracer):
+    """Close the screenshot container early and write the tracer's per-stage table."""
+    f.write("""
+    </div>
+    
+    <h2>Timing</h2>
+    <table class="steps">
+        <tr><th>Stage</th><th>Count</th><th>Total (s)</th><th>Mean (ms)</th><th>Max (ms)</th><th>Items</th><th>MB</th></tr>
+""")
+    for stage in tracer.summary():
+        f.write(f"""        <tr><td>{stage["stage"]}</td><td>{stage["count"]}</td><td>{stage["total_s"]:.3f}</td><td>{stage["mean_ms"]:.2f}</td><td>{stage["max_ms"]:.2f}</td><td>{stage["items"]}</td><td>{stage["bytes"] / 1e6:.2f}</td></tr>\n""")
+    f.write("""    </table>
+    <div>
+""")
+
+def write_report_footer(f):
+    """Close the screenshot container and the document."""
+    f.write("""
     </div>
     
     <h2>Recommendations</h2>
@@ -300,22 +3083,887 @@ def generate_report(test_results, output_dir="."):
 </body>
 </html>
 """)
+
+def write_aggregate_report(f, index, file_count):
+    """Write the multi-run trend report for a ResultsIndex."""
+    write_html_head(f, "Maestro Test Trends")
+    passed = sum(index.run_passed)
+    f.write(f"""    
+    <h2>Summary</h2>
+    <p>Results files: {file_count} ({len(index.errors)} unreadable), runs: {len(index)}, passed: {passed}</p>
+    
+    <h2>Flows</h2>
+    <table class="steps">
+        <tr><th>Flow</th><th>Runs</th><th>Passed</th><th>Pass rate</th>{_percentile_headers()}</tr>
+""")
+    for flow in index.flow_summary():
+        rate_class = "success" if flow["passed"] == flow["runs"] else "error"
+        f.write(f"""        <tr><td>{flow["flow"]}</td><td>{flow["runs"]}</td><td>{flow["passed"]}</td><td class="{rate_class}">{flow["pass_rate"]:.1%}</td>{_percentile_cells(flow["percentiles"])}</tr>\n""")
+    f.write("""    </table>\n""")
+    
+    f.write("""    
+    <h2>Step Timing</h2>
+""")
+    write_latency_table(f, index.command_latency())
+    f.write(f"""    
+    <h3>Slowest Steps</h3>
+    <table class="steps">
+        <tr><th>Flow</th><th>#</th><th>Command</th><th>Runs</th>{_percentile_headers()}</tr>
+""")
+    for step in index.slowest_steps():
+        f.write(f"""        <tr><td>{step["flow"]}</td><td>{step["index"]}</td><td>{step["command"]}</td><td>{step["runs"]}</td>{_percentile_cells(step["percentiles"])}</tr>\n""")
+    f.write("""    </table>\n""")
+    
+    flaky = index.flaky_steps()
+    f.write("""    
+    <h2>Flaky Steps</h2>
+""")
+    if flaky:
+        f.write("""    <table class="steps">
+        <tr><th>Flow</th><th>#</th><th>Command</th><th>Runs</th><th>Failures</th><th>Failure rate</th><th>Flips</th></tr>
+""")
+        for step in flaky:
+            f.write(f"""        <tr><td>{step["flow"]}</td><td>{step["index"]}</td><td>{step["command"]}</td><td>{step["runs"]}</td><td>{step["failures"]}</td><td class="error">{step["failure_rate"]:.1%}</td><td>{step["flips"]}</td></tr>\n""")
+        f.write("""    </table>\n""")
+    else:
+        f.write("""    <p>No step both passed and failed across these runs.</p>\n""")
+    
+    trend = index.daily_trend()
+    if trend:
+        f.write("""    
+    <h2>Daily Trend</h2>
+    <table class="steps">
+        <tr><th>Date (UTC)</th><th>Flow</th><th>Runs</th><th>Pass rate</th></tr>
+""")
+        for day, flow, runs, day_passed in trend:
+            f.write(f"""        <tr><td>{day}</td><td>{flow}</td><td>{runs}</td><td>{day_passed / runs:.1%}</td></tr>\n""")
+        f.write("""    </table>\n""")
+    
+    if index.errors:
+        f.write("""    
+    <h2>Unreadable Results Files</h2>
+    <ul>
+""")
+        for path, error in index.errors:
+            f.write(f"""        <li>{path}: {error}</li>\n""")
+        f.write("""    </ul>\n""")
+    
+    f.write("""
+    <footer>
+        <p>© Maestro AI Report Generator</p>
+    </footer>
+</body>
+</html>
+""")
+
+def generate_report(test_results, output_dir=".", max_workers=1, api_url=None, cache=None,
+                    dedup_distance=None, preprocessor=None, client=None, batch_size=1,
+                    batch_max_bytes=DEFAULT_BATCH_MAX_BYTES, screenshot_source="results",
+                    manifest_path=None, incremental=True, thumbnail_size=None, bundle=False,
+                    baseline_dir=None, baseline_threshold=DEFAULT_BASELINE_THRESHOLD,
+                    videos=None, keyframe_extractor=None, analyzer=None, embed_trace=False,
+                    job_queue=None, job_workers=1):
+    """
+    Generate an HTML report with AI insights from test results.
+    
+    screenshot_source is "results" to process exactly the screenshots named by
+    takeScreenshot steps in the results file, or "walk" to scan
+    .maestro/screenshots next to it.
+    
+    With a manifest_path, a manifest of per-screenshot hashes, metadata and
+    analyses is written there. When incremental, the previous manifest at that
+    path is read first and unchanged screenshots with a successful analysis
+    under the same settings are reused instead of being reprocessed.
+    
+    With a thumbnail_size, screenshots are shown as thumbnails (rendered into
+    <output_dir>/thumbnails) that link to the full-size image. bundle also packs
+    the report, thumbnails and screenshots into a zip next to the report.
+    
+    With a baseline_dir, screenshots are compared with their same-named
+    baseline; frames at least baseline_threshold similar are not analysed and
+    changed ones get a diff heatmap in <output_dir>/diffs.
+    
+    videos lists screen recordings (files or directories); their keyframes,
+    chosen by keyframe_extractor (a KeyframeExtractor), are written to
+    <output_dir>/keyframes and processed after the screenshots.
+    
+    analyzer selects the analysis backend (RemoteAnalyzer, HeuristicAnalyzer);
+    by default screenshots go to api_url as before.
+    
+    Stages are traced into the tracer activated with tracing(), if any;
+    embed_trace adds its per-stage summary to the report.
+    
+    With a job_queue (a JobQueue), screenshots still to be analysed go through
+    the queue first, worked by job_workers processes; an interrupted job
+    resumes from the queue's finished results when run again.
+    """
+    # Create output directory if it doesn't exist
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    
+    # Parse test results
+    steps = []
+    with trace("parse_results") as span:
+        try:
+            if screenshot_source == "walk":
+                with open(test_results, 'r') as f:
+                    results = json.load(f)
+                if not isinstance(results, (dict, list)):
+                    print("Error: Invalid test results format")
+                    return False
+                screenshot_paths = find_screenshots(test_results)
+            else:
+                maestro_results = parse_maestro_results(test_results)
+                steps = maestro_results["steps"]
+                screenshot_paths = maestro_results["screenshot_paths"]
+                span.add(items=len(steps), bytes=os.path.getsize(test_results))
+                for missing in maestro_results["missing_screenshots"]:
+                    print(f"Warning: screenshot not found for step: {missing}")
+                if not screenshot_paths:
+                    print("No screenshots referenced by the results file "
+                          "(use --walk-screenshots to scan .maestro/screenshots instead)")
+        except Exception as e:
+            print(f"Error reading test results: {e}")
+            return False
+    step_by_screenshot = {step["screenshot"]: step for step in steps if step["screenshot"]}
+    
+    if videos:
+        if not HAS_PIL or shutil.which("ffmpeg") is None:
+            print("Warning: Pillow and ffmpeg are required for video keyframes. Skipping recordings.")
+        else:
+            screenshot_paths = screenshot_paths + extract_video_keyframes(
+                collect_videos(videos), output_dir, keyframe_extractor
+            )
+    
+    # Create report filename
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_path = os.path.join(output_dir, f"maestro_report_{timestamp}.html")
+    
+    # Entries from the previous run whose screenshot content has not changed
+    settings = analysis_settings(preprocessor, batch_size, analyzer)
+    unchanged = {}
+    previous = load_manifest(manifest_path) if manifest_path and incremental else None
+    if previous is not None:
+        with trace("manifest_check", items=len(screenshot_paths)):
+            unchanged = find_unchanged_entries(previous, screenshot_paths)
+    
+    # Optionally collapse near-identical frames so only one per group is analysed
+    duplicates = {}
+    hashes = {}
+    if dedup_distance is not None:
+        if HAS_PIL:
+            known_hashes = {path: entry["dhash"] for path, entry in unchanged.items()
+                            if entry.get("dhash") is not None}
+            with trace("dedup", items=len(screenshot_paths)):
+                hashes = compute_dhashes(screenshot_paths, max_workers=max_workers,
+                                         known_hashes=known_hashes)
+                duplicates = group_near_duplicates(
+                    screenshot_paths, max_distance=dedup_distance, hashes=hashes
+                )
+            print(f"Deduplication: {len(duplicates)} of {len(screenshot_paths)} screenshots "
+                  f"are near-duplicates and will not be analysed")
+        else:
+            print("Warning: Pillow not installed. Skipping screenshot deduplication.")
+    
+    reuse = {}
+    if previous is not None and previous.get("settings") == settings:
+        for path, entry in unchanged.items():
+            if path not in duplicates and entry["ai_analysis"].get("status") == "success":
+                reuse[path] = {
+                    "metadata": entry["metadata"],
+                    "ai_analysis": entry["ai_analysis"],
+                    "relative_path": entry["relative_path"],
+                }
+    if previous is not None:
+        print(f"Manifest: reusing analyses for {len(reuse)} of {len(screenshot_paths)} screenshots")
+    # Their upload sizes are from the run that analysed them; nothing is sent for them now
+    from_manifest = set(reuse)
+    
+    # Frames are compared with their baseline by the analysis workers, just before
+    # they would be analysed, so comparisons stream with the report
+    compare = None
+    matching_baseline = set()
+    if baseline_dir:
+        if HAS_PIL and HAS_NUMPY:
+            compare = baseline_comparer(baseline_dir, os.path.join(output_dir, DIFF_DIR), baseline_threshold)
+            if job_queue is not None:
+                # ...except that the job must not queue frames that match their baseline
+                comparisons = compare_with_baseline(screenshot_paths, baseline_dir,
+                                                    os.path.join(output_dir, DIFF_DIR),
+                                                    threshold=baseline_threshold, max_workers=max_workers)
+                matching_baseline = {path for path, comparison in comparisons.items()
+                                     if comparison["status"] == "unchanged"}
+                
+                def compare(number, screenshot_path):
+                    return comparisons[screenshot_path]
+        else:
+            print("Warning: Pillow and NumPy are required for baseline comparison. Skipping it.")
+    
+    if job_queue is not None:
+        queued = [path for path in screenshot_paths
+                  if path not in reuse and path not in duplicates and path not in matching_baseline]
+        with trace("job", items=len(queued)):
+            finished = run_job(
+                job_queue, queued, settings, os.path.dirname(test_results), batch_size=batch_size,
+                analyzer=analyzer or RemoteAnalyzer(api_url, cache, preprocessor, client, max_bytes=batch_max_bytes),
+                workers=job_workers, threads=max_workers,
+            )
+        reuse.update(finished)
+    
+    # Thumbnails are rendered a few screenshots ahead of the report
+    thumbnail_stream = None
+    if thumbnail_size:
+        if HAS_PIL:
+            thumbnail_stream = iter_thumbnails(screenshot_paths, os.path.join(output_dir, THUMBNAIL_DIR),
+                                               size=thumbnail_size, max_workers=max_workers)
+        else:
+            print("Warning: Pillow not installed. Showing full-size screenshots.")
+    
+    manifest = None
+    if manifest_path:
+        manifest = ManifestWriter(manifest_path, test_results, report_path, settings, steps)
+    report_bundle = ReportBundle(report_path) if bundle else None
+    
+    # Stream the HTML report: each screenshot is written and flushed as soon as it
+    # (and every screenshot before it) has been analysed, so memory stays flat and
+    # a killed job still leaves a readable partial report. Its assets go into the
+    # bundle at the same time.
+    screenshot_count = matching = 0
+    uploads = bytes_before = bytes_after = 0
+    try:
+        with open(report_path, 'w') as f:
+            def emit(write, *args, links=None):
+                if report_bundle is None:
+                    write(f, *args)
+                    return
+                buffer = io.StringIO()
+                write(buffer, *args)
+                f.write(buffer.getvalue())
+                report_bundle.write(buffer.getvalue(), links)
+            
+            emit(write_report_header, test_results, steps)
+            f.flush()
+            
+            for screenshot in iter_analyzed_screenshots(
+                screenshot_paths,
+                os.path.dirname(test_results),
+                max_workers=max_workers,
+                api_url=api_url,
+                cache=cache,
+                duplicates=duplicates,
+                preprocessor=preprocessor,
+                client=client,
+                batch_size=batch_size,
+                batch_max_bytes=batch_max_bytes,
+                reuse=reuse,
+                analyzer=analyzer,
+                compare=compare,
+            ):
+                screenshot_count += 1
+                screenshot_path = screenshot["metadata"]["path"]
+                screenshot["full_size"] = os.path.relpath(screenshot_path, start=output_dir)
+                links = None
+                if thumbnail_stream is not None:
+                    with trace("thumbnails", items=1):
+                        _, thumbnail = next(thumbnail_stream)
+                    if thumbnail is not None:
+                        screenshot["thumbnail"] = thumbnail
+                        if report_bundle is not None:
+                            report_bundle.add(f"{THUMBNAIL_DIR}/{thumbnail['file']}",
+                                              os.path.join(output_dir, THUMBNAIL_DIR, thumbnail["file"]))
+                if report_bundle is not None:
+                    archive_name = f"{BUNDLE_SCREENSHOT_DIR}/{screenshot_count:04d}_{os.path.basename(screenshot_path)}"
+                    report_bundle.add(archive_name, screenshot_path)
+                    links = {screenshot["full_size"]: archive_name}
+                comparison = screenshot.get("baseline")
+                if comparison is not None:
+                    matching += comparison["status"] == "unchanged"
+                    if comparison["heatmap"]:
+                        comparison["heatmap_src"] = f"{DIFF_DIR}/{os.path.basename(comparison['heatmap'])}"
+                        if report_bundle is not None:
+                            report_bundle.add(comparison["heatmap_src"], comparison["heatmap"])
+                with trace("html", items=1):
+                    emit(write_screenshot_item, screenshot_count, screenshot,
+                         step_by_screenshot.get(screenshot_path), links=links)
+                    f.flush()
+                
+                if "bytes_after" in screenshot["ai_analysis"] and screenshot_path not in from_manifest:
+                    uploads += 1
+                    bytes_before += screenshot["ai_analysis"]["bytes_before"]
+                    bytes_after += screenshot["ai_analysis"]["bytes_after"]
+                
+                if manifest is not None:
+                    manifest.add(screenshot, unchanged.get(screenshot_path), hashes.get(screenshot_path))
+            
+            if embed_trace and _active_tracer is not None:
+                emit(write_trace_summary, _active_tracer)
+            emit(write_report_footer)
+    except BaseException:
+        if manifest is not None:
+            manifest.abort()
+        if report_bundle is not None:
+            report_bundle.abort()
+        raise
+    finally:
+        if thumbnail_stream is not None:
+            thumbnail_stream.close()
+    
+    if compare is not None:
+        print(f"Baseline: {matching} of {screenshot_count} screenshots match {baseline_dir}; "
+              f"only the rest were analysed")
+    
+    if manifest is not None:
+        with trace("manifest_write", items=manifest.count):
+            manifest.commit()
+    
+    if report_bundle is not None:
+        with trace("bundle", items=report_bundle.count):
+            bundle_path = report_bundle.commit()
+        print(f"Report bundle: {bundle_path}")
+    
+    if uploads:
+        print(f"Uploaded {uploads} screenshots: {bytes_before / 1024:.0f} KB before preprocessing, "
+              f"{bytes_after / 1024:.0f} KB sent")
+    
+    if cache is not None:
+        cache.evict()
+        print(f"AI analysis cache: {cache.hits} hits, {cache.misses} misses")
     
     print(f"Report generated: {report_path}")
-    return True
+    return report_path
+
+def generate_aggregate_report(sources, output_dir=".", max_workers=1):
+    """
+    Generate one trend report across every results file matched by sources
+    (directories and/or glob patterns).
+    """
+    results_files = collect_results_files(sources)
+    if not results_files:
+        print("Error: No results files found")
+        return False
+    
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_path = os.path.join(output_dir, f"maestro_trends_{timestamp}.html")
+    
+    start = time.perf_counter()
+    index = build_results_index(results_files, max_workers=max_workers)
+    print(f"Indexed {len(index)} runs from {len(results_files)} results files "
+          f"in {time.perf_counter() - start:.2f} s")
+    for path, error in index.errors:
+        print(f"Warning: could not read {path}: {error}")
+    
+    with open(report_path, 'w') as f:
+        write_aggregate_report(f, index, len(results_files))
+    
+    print(f"Trend report generated: {report_path}")
+    return report_path
+
+def synthesize_run(directory, count, size=(1080, 2400), image_format="PNG", seed=0):
+    """
+    Write count screenshots and a matching Maestro commands file into directory.
+    
+    Each screenshot is a distinct coarse random block pattern, so images neither
+    compress to nothing nor deduplicate. Returns the results file path.
+    """
+    from PIL import Image
+    
+    rng = random.Random(seed)
+    width, height = size
+    blocks = (max(1, width // 40), max(1, height // 40))
+    extension = "jpg" if image_format.upper() == "JPEG" else image_format.lower()
+    commands = [{"command": {"launchAppCommand": {"appId": "com.example.bench"}},
+                 "metadata": {"status": "COMPLETED", "timestamp": 1716565547000, "duration": 1500}}]
+    for i in range(count):
+        name = f"screen_{i:05d}"
+        pattern = Image.frombytes("RGB", blocks, rng.randbytes(blocks[0] * blocks[1] * 3))
+        pattern.resize(size, Image.NEAREST).save(os.path.join(directory, f"{name}.{extension}"), image_format)
+        commands.append({"command": {"tapOnElementCommand": {"selector": {"textRegex": f"Item {i}"}}},
+                         "metadata": {"status": "COMPLETED", "duration": rng.randint(50, 800)}})
+        commands.append({"command": {"takeScreenshotCommand": {"path": f"{name}.{extension}"}},
+                         "metadata": {"status": "COMPLETED", "duration": rng.randint(100, 300)}})
+    results_file = os.path.join(directory, "commands-(bench.yaml).json")
+    with open(results_file, "w") as f:
+        json.dump(commands, f)
+    return results_file
+
+def _peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # bytes on macOS, KB elsewhere
+
+def run_benchmark(count, size=(1080, 2400), image_format="PNG", max_workers=4, batch_size=1,
+                  stub_latency=0.0):
+    """
+    Time every stage of the report pipeline for count synthetic screenshots.
+    
+    Analysis runs against a StubModelServer, so only local work and loopback
+    HTTP are measured. Returns a dict with count, bytes (of screenshots),
+    stages ({stage: seconds}) and peak_rss_kb of this process.
+    """
+    stages = {}
+    
+    @contextlib.contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        stages[name] = time.perf_counter() - start
+    
+    with tempfile.TemporaryDirectory() as directory:
+        results_file = synthesize_run(directory, count, size, image_format)
+        with stage("parse"):
+            screenshot_paths = parse_maestro_results(results_file)["screenshot_paths"]
+        
+        with _metadata_cache_lock:
+            _metadata_cache.clear()
+        with stage("metadata"):
+            for screenshot_path in screenshot_paths:
+                get_screenshot_metadata(screenshot_path)
+        
+        preprocessor = ImagePreprocessor()
+        with stage("encode"):
+            for screenshot_path in screenshot_paths:
+                with open(screenshot_path, "rb") as f:
+                    _prepare_upload(f.read(), preprocessor)
+        
+        with StubModelServer(latency=stub_latency) as server:
+            client = AIClient(server.url, pool_size=max(max_workers, 1))
+            analyzer = StubAnalyzer(server.url, preprocessor=preprocessor, client=client, api_key="bench")
+            with stage("analysis"):
+                results = analyze_screenshots(screenshot_paths, directory, max_workers=max_workers,
+                                              batch_size=batch_size, analyzer=analyzer)
+            
+            with stage("html"):
+                with open(os.path.join(directory, "report.html"), "w") as f:
+                    write_report_header(f, results_file)
+                    for index, screenshot in enumerate(results, start=1):
+                        write_screenshot_item(f, index, screenshot)
+                    write_report_footer(f)
+            
+            with stage("report"):
+                generate_report(results_file, os.path.join(directory, "report"), max_workers=max_workers,
+                                batch_size=batch_size, analyzer=analyzer)
+            client.close()
+        
+        return {
+            "count": count,
+            "bytes": sum(os.path.getsize(path) for path in screenshot_paths),
+            "stages": stages,
+            "peak_rss_kb": _peak_rss_kb(),
+        }
+
+def _run_benchmark_isolated(count, **kwargs):
+    """run_benchmark in a freshly spawned process, so peak RSS belongs to this N alone."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_benchmark, count, **kwargs).result()
 
-def main():
+def measure_import_time(runs=3):
+    """
+    Import this module in fresh interpreters under python -X importtime.
+    
+    Returns the best of runs for the module's cumulative import time (ms), its
+    slowest direct imports in that run, and which DEFERRED_IMPORTS it loaded.
+    """
+    module = Path(__file__).stem
+    code = f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); import {module}"
+    # Measure with a warm bytecode cache, as an installed script would run
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    best = None
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                 capture_output=True, text=True, check=True, env=env)
+        rows = []
+        for line in process.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) != 3 or not line.startswith("import time:") or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].rstrip()
+            rows.append((len(name) - len(name.lstrip()), name.strip(), int(fields[1]) / 1000))
+        position = next(i for i, (_, name, _) in enumerate(rows) if name == module)
+        depth, _, total_ms = rows[position]
+        children = []
+        for child_depth, name, ms in reversed(rows[:position]):
+            if child_depth <= depth:
+                break
+            if child_depth == depth + 2:
+                children.append((name, ms))
+        if best is None or total_ms < best["import_ms"]:
+            loaded = {name for _, name, _ in rows}
+            best = {
+                "import_ms": total_ms,
+                "slowest_imports": sorted(children, key=lambda child: -child[1])[:5],
+                "deferred_loaded": [name for name in DEFERRED_IMPORTS if name in loaded],
+                "stdout": process.stdout,
+            }
+    return best
+
+def summarize_benchmark_runs(runs):
+    """
+    Fold repeated run_benchmark results for one N into one result.
+    
+    stages holds each stage's median, runs every measurement ({stage: [seconds]})
+    and peak_rss_kb the largest peak seen.
+    """
+    stage_runs = {name: [run["stages"][name] for run in runs] for name in runs[0]["stages"]}
+    peaks = [run["peak_rss_kb"] for run in runs if run["peak_rss_kb"]]
+    return {
+        "count": runs[0]["count"],
+        "bytes": runs[0]["bytes"],
+        "stages": {name: percentiles(seconds, (50,))[0] for name, seconds in stage_runs.items()},
+        "runs": stage_runs,
+        "peak_rss_kb": max(peaks) if peaks else runs[0]["peak_rss_kb"],
+    }
+
+def compare_benchmarks(current, baseline, tolerance=BENCH_TOLERANCE, noise=BENCH_NOISE_SECONDS):
+    """
+    Return human-readable regressions of current against baseline results.
+    
+    A stage regresses when its fastest current run is more than tolerance (a
+    fraction) slower than the baseline's median for the same N, and the
+    slowdown exceeds both noise (seconds) and the spread of either side's runs.
+    Results without runs (a single measurement each) have no spread.
+    """
+    def measurements(result, name):
+        return result.get("runs", {}).get(name) or [result["stages"][name]]
+    
+    previous = {result["count"]: result for result in baseline}
+    regressions = []
+    for result in current:
+        before = previous.get(result["count"])
+        if before is None:
+            continue
+        for name in result["stages"]:
+            if name not in before["stages"]:
+                continue
+            new_runs, old_runs = measurements(result, name), measurements(before, name)
+            seconds, old = min(new_runs), percentiles(old_runs, (50,))[0]
+            spread = max(max(new_runs) - min(new_runs), max(old_runs) - min(old_runs))
+            if seconds > old * (1 + tolerance) and seconds - old > max(noise, spread):
+                regressions.append(f"N={result['count']} {name}: {old:.3f} s -> {seconds:.3f} s "
+                                   f"(+{(seconds / old - 1) if old else float('inf'):.0%})")
+    return regressions
+
+def print_benchmarks(results):
+    header = f"{'N':>6} " + " ".join(f"{name:>9}" for name in BENCH_STAGES) + f" {'shots/s':>8} {'peak MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        stages = result["stages"]
+        throughput = result["count"] / stages["report"] if stages["report"] else 0
+        peak = f"{result['peak_rss_kb'] / 1024:.0f}" if result["peak_rss_kb"] else "n/a"
+        print(f"{result['count']:>6} " + " ".join(f"{stages[name]:>9.3f}" for name in BENCH_STAGES)
+              + f" {throughput:>8.1f} {peak:>8}")
+    print("(median stage times in seconds; report is generate_report end to end)")
+
+def bench_main(argv):
+    parser = argparse.ArgumentParser(prog="generate_ai_report.py bench",
+                                     description="Benchmark the report pipeline on synthetic screenshots")
+    parser.add_argument("--counts", type=int, nargs="+", default=list(BENCH_COUNTS),
+                        help="Screenshot counts to benchmark")
+    parser.add_argument("--size", default=BENCH_SIZE, help=f"Screenshot size WxH (default: {BENCH_SIZE})")
+    parser.add_argument("--format", choices=("png", "jpeg", "webp"), default="png",
+                        help="Screenshot file format")
+    parser.add_argument("--max-workers", "-j", type=int, default=4, help="Concurrent analysis workers")
+    parser.add_argument("--batch-size", type=int, default=1, help="Screenshots per analysis request")
+    parser.add_argument("--stub-latency", type=float, default=0.0,
+                        help="Seconds the stub model server waits per request")
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT,
+                        help=f"Runs per count; stage times are their median (default: {BENCH_REPEAT})")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Fail if a stage is slower than in this earlier --json file")
+    parser.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE,
+                        help=f"Allowed slowdown against --baseline as a fraction (default: {BENCH_TOLERANCE})")
+    parser.add_argument("--noise-floor", type=float, default=BENCH_NOISE_SECONDS,
+                        help=f"Slowdowns under this many seconds never fail --baseline "
+                             f"(default: {BENCH_NOISE_SECONDS})")
+    parser.add_argument("--imports", action="store_true",
+                        help="Only measure the module's import time (python -X importtime) and fail when it "
+                             "exceeds --import-budget, prints anything or loads a heavy dependency")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_TIME_BUDGET_MS,
+                        help=f"Import-time budget in ms (default: {IMPORT_TIME_BUDGET_MS})")
+    args = parser.parse_args(argv)
+    
+    if args.imports:
+        result = measure_import_time()
+        print(f"import time: {result['import_ms']:.1f} ms (budget {args.import_budget:g} ms)")
+        for name, ms in result["slowest_imports"]:
+            print(f"  {name:<28} {ms:>7.1f} ms")
+        problems = []
+        if result["import_ms"] > args.import_budget:
+            problems.append("over budget")
+        if result["deferred_loaded"]:
+            problems.append(f"loads {', '.join(result['deferred_loaded'])} at import time")
+        if result["stdout"]:
+            problems.append("prints at import time")
+        for problem in problems:
+            print(f"Regression: {problem}")
+        return 1 if problems else 0
+    
+    if not (HAS_PIL and HAS_REQUESTS):
+        print("Error: bench needs Pillow and requests")
+        return 1
+    try:
+        size = tuple(int(part) for part in args.size.lower().split("x"))
+    except ValueError:
+        size = ()
+    if len(size) != 2:
+        parser.error(f"--size must look like 1080x2400, got {args.size}")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    
+    results = []
+    for count in args.counts:
+        results.append(summarize_benchmark_runs([_run_benchmark_isolated(
+            count, size=size, image_format=args.format.upper(), max_workers=args.max_workers,
+            batch_size=args.batch_size, stub_latency=args.stub_latency,
+        ) for _ in range(args.repeat)]))
+    print_benchmarks(results)
+    
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_benchmarks(results, json.load(f), args.tolerance, args.noise_floor)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+def job_main(argv):
+    parser = argparse.ArgumentParser(prog="generate_ai_report.py job",
+                                     description="Inspect or work on the queue of a --queue report job")
+    actions = parser.add_subparsers(dest="action", required=True)
+    status = actions.add_parser("status", help="Show per-state counts and failed screenshots")
+    status.add_argument("queue", help="Job queue file")
+    retry = actions.add_parser("retry", help="Queue failed screenshots again for the next run")
+    retry.add_argument("queue", help="Job queue file")
+    retry.add_argument("screenshots", nargs="*", help="Paths or file names to retry (default: all failed)")
+    work = actions.add_parser("work", help="Join a running job as an extra worker process")
+    work.add_argument("queue", help="Job queue file")
+    work.add_argument("--threads", type=int, default=1, help="Concurrent analyses in this worker")
+    args = parser.parse_args(argv)
+    
+    if not os.path.exists(args.queue):
+        print(f"Error: Job queue not found: {args.queue}")
+        return 1
+    if args.action == "work":
+        print(f"Worker processed {run_job_worker(args.queue, threads=args.threads)} screenshots")
+        return 0
+    
+    queue = JobQueue(args.queue)
+    try:
+        if args.action == "retry":
+            retried = queue.retry(set(args.screenshots))
+            print(f"{len(retried)} failed screenshots queued again; rerun the report to process them")
+            return 0
+        counts = queue.counts()
+        print(", ".join(f"{state}: {counts.get(state, 0)}" for state in ("done", "failed", "running", "pending")))
+        for path, attempts, error in queue.failures():
+            print(f"  failed after {attempts} attempt(s): {path}: {error}")
+        return 0
+    finally:
+        queue.close()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["bench"]:
+        return bench_main(argv[1:])
+    if argv[:1] == ["job"]:
+        return job_main(argv[1:])
+    
     parser = argparse.ArgumentParser(description="Generate AI-enhanced report from Maestro test results")
-    parser.add_argument("results_file", help="Path to Maestro test results JSON file")
+    parser.add_argument("results_file", nargs="?", help="Path to Maestro test results JSON file")
     parser.add_argument("--output-dir", "-o", default=".", help="Directory to save the report")
+    parser.add_argument("--manifest", default=None,
+                        help=f"Run manifest path (default: <output-dir>/{MANIFEST_FILENAME})")
+    parser.add_argument("--no-incremental", action="store_true",
+                        help="Reprocess every screenshot even if the manifest says it is unchanged")
+    parser.add_argument("--rebuild-from-manifest", action="store_true",
+                        help="Regenerate the HTML from the manifest only (no image reads, no API calls)")
+    parser.add_argument("--aggregate", nargs="+", metavar="PATH_OR_GLOB",
+                        help="Build a multi-run trend report from these results directories/globs")
+    parser.add_argument("--thumbnail-size", type=int, default=DEFAULT_THUMBNAIL_SIZE,
+                        help=f"Longest side of report thumbnails in pixels (default: {DEFAULT_THUMBNAIL_SIZE})")
+    parser.add_argument("--no-thumbnails", action="store_true",
+                        help="Show full-size screenshots in the report")
+    parser.add_argument("--bundle", action="store_true",
+                        help="Also pack the report, thumbnails and screenshots into a single zip")
+    parser.add_argument("--baseline-dir", default=None,
+                        help="Compare screenshots with same-named images here; only changed frames are analysed "
+                             "(about 75 ms per 1080p frame per core; spread over --max-workers)")
+    parser.add_argument("--baseline-threshold", type=float, default=DEFAULT_BASELINE_THRESHOLD,
+                        help=f"Fraction of matching pixels for a frame to count as unchanged "
+                             f"(default: {DEFAULT_BASELINE_THRESHOLD})")
+    parser.add_argument("--videos", nargs="+", metavar="PATH",
+                        help="Screen recordings (files or directories) to take keyframes from")
+    parser.add_argument("--video-fps", type=float, default=DEFAULT_VIDEO_FPS,
+                        help=f"Frames sampled per second of video (default: {DEFAULT_VIDEO_FPS})")
+    parser.add_argument("--scene-threshold", type=int, default=DEFAULT_SCENE_THRESHOLD,
+                        help=f"dHash distance that counts as a new screen (default: {DEFAULT_SCENE_THRESHOLD})")
+    parser.add_argument("--max-keyframes", type=int, default=DEFAULT_MAX_KEYFRAMES,
+                        help=f"Keyframes kept per video at most (default: {DEFAULT_MAX_KEYFRAMES})")
+    parser.add_argument("--analyzer", choices=ANALYZERS, default="remote",
+                        help="Analysis backend: remote chat completions API, offline heuristics, "
+                             "or a bundled local stub model server")
+    parser.add_argument("--stub-latency", type=float, default=0.0,
+                        help="Seconds the stub model server waits before answering (--analyzer stub)")
+    parser.add_argument("--trace-jsonl", metavar="PATH", help="Write per-stage trace spans as JSON lines")
+    parser.add_argument("--trace-chrome", metavar="PATH",
+                        help="Write a Chrome trace-event file (chrome://tracing, Perfetto)")
+    parser.add_argument("--trace-in-report", action="store_true",
+                        help="Trace the run and embed the per-stage timing table in the report")
+    parser.add_argument("--queue", metavar="PATH",
+                        help="Run as a resumable job with its per-screenshot work queue in this SQLite file")
+    parser.add_argument("--job-workers", type=int, default=1,
+                        help="Worker processes pulling from the --queue (each runs --max-workers threads)")
+    parser.add_argument("--walk-screenshots", action="store_true",
+                        help="Scan .maestro/screenshots instead of using the screenshots named in the results")
+    parser.add_argument("--max-workers", "-j", type=int, default=4,
+                        help="Maximum screenshots analyzed concurrently (1 = sequential)")
+    parser.add_argument("--api-url", default=None,
+                        help="Chat completions endpoint (default: $OPENAI_API_URL or OpenAI)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Directory for cached AI analyses")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the AI API, ignoring and not updating the cache")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Analyse only one screenshot per group of near-identical frames")
+    parser.add_argument("--dedup-distance", type=int, default=DEFAULT_DEDUP_DISTANCE,
+                        help="Maximum dHash Hamming distance (0-64) for frames to count as duplicates")
+    parser.add_argument("--max-dimension", type=int, default=DEFAULT_MAX_DIMENSION,
+                        help="Shrink screenshots to fit this many pixels before upload (0 = keep size)")
+    parser.add_argument("--upload-format", default=DEFAULT_UPLOAD_FORMAT.lower(),
+                        choices=[fmt.lower() for fmt in UPLOAD_FORMATS] + ["original"],
+                        help="Encoding used for uploaded screenshots ('original' sends the file as-is)")
+    parser.add_argument("--upload-quality", type=int, default=DEFAULT_UPLOAD_QUALITY,
+                        help="JPEG/WebP quality for uploaded screenshots (1-100)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Seconds to wait for each AI API request")
+    parser.add_argument("--max-retries", type=int, default=DEFAULT_MAX_RETRIES,
+                        help="Retries for connection errors and 429/5xx responses")
+    parser.add_argument("--rate-limit", type=float, default=None,
+                        help="Maximum AI API requests per second across all workers")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Screenshots sent together in one AI request (1 = one per request)")
+    parser.add_argument("--batch-max-mb", type=float, default=DEFAULT_BATCH_MAX_BYTES / (1024 * 1024),
+                        help="Maximum encoded image data per batched request, in MB")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    manifest_path = args.manifest or os.path.join(args.output_dir, MANIFEST_FILENAME)
     
+    if args.rebuild_from_manifest:
+        return 0 if rebuild_report_from_manifest(manifest_path, args.output_dir) else 1
+    if args.aggregate:
+        sources = args.aggregate + ([args.results_file] if args.results_file else [])
+        return 0 if generate_aggregate_report(sources, args.output_dir, args.max_workers) else 1
+    
+    if not args.results_file:
+        parser.error("results_file is required unless --rebuild-from-manifest is given")
     if not os.path.exists(args.results_file):
         print(f"Error: Results file not found: {args.results_file}")
         return 1
     
-    success = generate_report(args.results_file, args.output_dir)
+    stub_server = None
+    if args.analyzer == "stub":
+        if not HAS_REQUESTS:
+            print("Error: the stub analyzer needs the requests library")
+            return 1
+        stub_server = StubModelServer(latency=args.stub_latency).start()
+        args.api_url = stub_server.url
+        args.no_cache = True  # stub answers must never be served for real runs later
+    
+    if not HAS_PIL:
+        print("Warning: Pillow not installed. Image processing will be limited.")
+    client = None
+    if not HAS_REQUESTS:
+        if args.analyzer != "heuristic":
+            print("Warning: Requests not installed. AI analysis will be skipped.")
+    else:
+        client = AIClient(
+            args.api_url,
+            timeout=args.timeout,
+            max_retries=args.max_retries,
+            rate_limit=args.rate_limit,
+            pool_size=max(args.max_workers, 1),
+        )
+    
+    cache = None if args.no_cache else AnalysisCache(args.cache_dir)
+    preprocessor = None if args.upload_format == "original" else ImagePreprocessor(
+        args.max_dimension, args.upload_format, args.upload_quality
+    )
+    batch_max_bytes = int(args.batch_max_mb * 1024 * 1024)
+    if args.analyzer == "heuristic":
+        analyzer = HeuristicAnalyzer()
+    elif stub_server is not None:
+        analyzer = StubAnalyzer(args.api_url, cache, preprocessor, client, api_key="stub", max_bytes=batch_max_bytes)
+    else:
+        analyzer = RemoteAnalyzer(args.api_url, cache, preprocessor, client, max_bytes=batch_max_bytes)
+    
+    job_queue = None
+    if args.queue:
+        job_queue = JobQueue(args.queue, config={
+            "analyzer": analyzer.name,
+            "api_url": args.api_url,
+            "api_key": "stub" if stub_server else None,
+            "cache_dir": None if args.no_cache else args.cache_dir,
+            "upload_format": args.upload_format,
+            "max_dimension": args.max_dimension,
+            "upload_quality": args.upload_quality,
+            "batch_max_bytes": batch_max_bytes,
+            "timeout": args.timeout,
+            "max_retries": args.max_retries,
+            "rate_limit": args.rate_limit,
+        })
+    
+    tracer = Tracer() if (args.trace_jsonl or args.trace_chrome or args.trace_in_report) else None
+    with tracing(tracer):
+        success = generate_report(
+            args.results_file,
+            args.output_dir,
+            max_workers=args.max_workers,
+            api_url=args.api_url,
+            cache=cache,
+            dedup_distance=args.dedup_distance if args.dedup else None,
+            preprocessor=preprocessor,
+            client=client,
+            batch_size=args.batch_size,
+            batch_max_bytes=batch_max_bytes,
+            screenshot_source="walk" if args.walk_screenshots else "results",
+            manifest_path=manifest_path,
+            incremental=not args.no_incremental,
+            thumbnail_size=None if args.no_thumbnails else args.thumbnail_size,
+            bundle=args.bundle,
+            baseline_dir=args.baseline_dir,
+            baseline_threshold=args.baseline_threshold,
+            videos=args.videos,
+            keyframe_extractor=KeyframeExtractor(args.video_fps, args.scene_threshold, args.max_keyframes),
+            analyzer=analyzer,
+            embed_trace=args.trace_in_report,
+            job_queue=job_queue,
+            job_workers=args.job_workers,
+        )
+    if job_queue is not None:
+        job_queue.close()
+    if client is not None:
+        client.close()
+    if stub_server is not None:
+        stub_server.stop()
+    
+    if tracer is not None:
+        tracer.print_summary()
+        if args.trace_jsonl:
+            tracer.write_jsonl(args.trace_jsonl)
+        if args.trace_chrome:
+            tracer.write_chrome_trace(args.trace_chrome)
     return 0 if success else 1
 
 if __name__ == "__main__":
@@ -0,0 +1,1819 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the Maestro AI Test Report Generator
+"""
+
+import io
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+import zlib
+from unittest.mock import patch
+
+# Import the module we're testing
+import generate_ai_report
+from generate_ai_report import (
+    AIClient,
+    AnalysisCache,
+    HeuristicAnalyzer,
+    ImagePreprocessor,
+    JobQueue,
+    KeyframeExtractor,
+    RemoteAnalyzer,
+    StubAnalyzer,
+    StubModelServer,
+    TokenBucket,
+    Tracer,
+    analyze_screenshot_with_ai,
+    analyze_screenshots,
+    build_results_index,
+    compare_to_baseline,
+    compare_with_baseline,
+    contrast_ratio,
+    collect_results_files,
+    compare_benchmarks,
+    command_latency,
+    flow_name,
+    generate_aggregate_report,
+    find_screenshots,
+    generate_report,
+    get_screenshot_metadata,
+    group_near_duplicates,
+    iter_analyzed_screenshots,
+    iter_json_array,
+    iter_video_frames,
+    make_thumbnails,
+    measure_import_time,
+    parse_batch_response,
+    parse_maestro_results,
+    parse_retry_after,
+    percentiles,
+    read_image_header,
+    slowest_steps,
+    synthesize_run,
+    tracing,
+    rebuild_report_from_manifest,
+    run_benchmark,
+    summarize_benchmark_runs,
+)
+
+
+def read_partial_report(output_dir):
+    """The HTML written so far by a generate_report call still running in output_dir."""
+    report_path, = [os.path.join(output_dir, name) for name in os.listdir(output_dir)
+                    if name.startswith("maestro_report_") and name.endswith(".html")]
+    with open(report_path, encoding="utf-8") as f:
+        return f.read()
+
+
+def write_png(path, width=4, height=4, color=(255, 255, 255)):
+    """Write a minimal solid-color RGB PNG without needing Pillow."""
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    row = b"\x00" + bytes(color) * width
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(row * height)))
+        f.write(chunk(b"IEND", b""))
+
+
+def maestro_command(name, status="COMPLETED", duration=100, timestamp=1716565547000, **fields):
+    """One entry of Maestro's command output, as written to commands-(flow).json."""
+    return {
+        "command": {f"{name}Command": fields},
+        "metadata": {"status": status, "timestamp": timestamp, "duration": duration},
+    }
+
+
+class ReportTestCase(unittest.TestCase):
+    """Creates a results file with a .maestro/screenshots directory next to it."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.results_file = os.path.join(self.test_dir, "results.json")
+        with open(self.results_file, "w") as f:
+            json.dump({"flow": "hello_world"}, f)
+        self.screenshot_dir = os.path.join(self.test_dir, ".maestro", "screenshots")
+        os.makedirs(self.screenshot_dir)
+        self.output_dir = os.path.join(self.test_dir, "report")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def make_screenshots(self, count):
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.screenshot_dir, f"screen_{i:03d}.png")
+            write_png(path, color=(i % 256, 0, 0))
+            paths.append(path)
+        return paths
+
+
+@unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+class TestConcurrentAnalysis(ReportTestCase):
+    """Test cases for the bounded-concurrency analysis stage."""
+
+    def test_find_screenshots_sorted(self):
+        """Screenshots are returned in a stable, sorted order."""
+        expected = self.make_screenshots(5)
+        self.assertEqual(find_screenshots(self.results_file), expected)
+
+    def test_order_preserved_with_workers(self):
+        """Concurrent results come back in input order."""
+        paths = self.make_screenshots(8)
+        with StubModelServer(latency=0.01) as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"):
+            results = analyze_screenshots(paths, self.test_dir, max_workers=4, api_url=server.url)
+
+        self.assertEqual([r["metadata"]["path"] for r in results], paths)
+        self.assertTrue(all(r["ai_analysis"]["status"] == "success" for r in results))
+        self.assertEqual(server.requests, 8)
+
+    def test_concurrent_speedup_over_sequential(self):
+        """Overlapping API round trips beats the sequential path on wall-clock time."""
+        paths = self.make_screenshots(8)
+        with StubModelServer(latency=0.1) as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"):
+            start = time.perf_counter()
+            analyze_screenshots(paths, self.test_dir, max_workers=1, api_url=server.url)
+            sequential = time.perf_counter() - start
+
+            start = time.perf_counter()
+            analyze_screenshots(paths, self.test_dir, max_workers=8, api_url=server.url)
+            concurrent = time.perf_counter() - start
+
+        self.assertGreater(sequential, 0.8)
+        self.assertLess(concurrent, sequential / 3)
+
+    def test_generate_report_with_stub_server(self):
+        """End-to-end report generation against the stub server."""
+        self.make_screenshots(3)
+        with StubModelServer() as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"):
+            report_path = generate_report(
+                self.results_file, self.output_dir, max_workers=2, api_url=server.url,
+                screenshot_source="walk",
+            )
+
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertEqual(html.count('<div class="screenshot-item">'), 3)
+        self.assertIn("Stub analysis", html)
+        self.assertLess(html.index("screen_000.png"), html.index("screen_002.png"))
+
+
+@unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+class TestAnalysisCache(ReportTestCase):
+    """Test cases for the content-addressed analysis cache."""
+
+    def setUp(self):
+        super().setUp()
+        self.cache = AnalysisCache(os.path.join(self.test_dir, "cache"))
+
+    def test_identical_content_hits_cache(self):
+        """A byte-identical screenshot under another name is served from the cache."""
+        first = os.path.join(self.screenshot_dir, "hello_world_initial.png")
+        second = os.path.join(self.screenshot_dir, "hello_world_again.png")
+        write_png(first)
+        write_png(second)
+
+        with StubModelServer() as server, patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+            analyze_screenshot_with_ai(first, api_url=server.url, cache=self.cache)
+            result = analyze_screenshot_with_ai(second, api_url=server.url, cache=self.cache)
+
+        self.assertEqual(server.requests, 1)
+        self.assertTrue(result["cached"])
+        self.assertTrue(result["analysis"].startswith("Stub analysis of image"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_key_depends_on_prompt_and_model(self):
+        """Changing the prompt or model produces a different key."""
+        key = AnalysisCache.make_key(b"png", "prompt", "model")
+        self.assertNotEqual(key, AnalysisCache.make_key(b"png", "other prompt", "model"))
+        self.assertNotEqual(key, AnalysisCache.make_key(b"png", "prompt", "other-model"))
+        self.assertNotEqual(key, AnalysisCache.make_key(b"gif", "prompt", "model"))
+
+    def test_expired_entries_miss_and_are_evicted(self):
+        """Entries older than max_age_days are neither served nor kept."""
+        cache = AnalysisCache(self.cache.cache_dir, max_age_days=1)
+        cache.put("ab" * 32, {"status": "success", "analysis": "old"})
+        cache.put("cd" * 32, {"status": "success", "analysis": "new"})
+        old_time = time.time() - 2 * 24 * 60 * 60
+        os.utime(cache._entry_path("ab" * 32), (old_time, old_time))
+
+        self.assertIsNone(cache.get("ab" * 32))
+        self.assertEqual(cache.evict(), 0)
+        self.assertFalse(cache._entry_path("ab" * 32).exists())
+        self.assertIsNotNone(cache.get("cd" * 32))
+
+    def test_size_eviction_drops_least_recently_used(self):
+        """Eviction keeps the most recently used entries within max_bytes."""
+        cache = AnalysisCache(self.cache.cache_dir, max_bytes=160)
+        for i, key in enumerate(["aa" * 32, "bb" * 32, "cc" * 32]):
+            cache.put(key, {"status": "success", "analysis": "x" * 40})
+            os.utime(cache._entry_path(key), (1000 + i, time.time() - 100 + i))
+
+        self.assertEqual(cache.evict(), 1)
+        self.assertFalse(cache._entry_path("aa" * 32).exists())
+        self.assertTrue(cache._entry_path("cc" * 32).exists())
+
+    def test_generate_report_prints_hit_miss_counts(self):
+        """Second run over the same screenshots makes no API calls."""
+        self.make_screenshots(3)
+        with StubModelServer() as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print") as mock_print:
+            generate_report(self.results_file, self.output_dir, api_url=server.url, cache=self.cache,
+                            screenshot_source="walk")
+            second_cache = AnalysisCache(self.cache.cache_dir)
+            generate_report(self.results_file, self.output_dir, api_url=server.url, cache=second_cache,
+                            screenshot_source="walk")
+
+        self.assertEqual(server.requests, 3)
+        self.assertEqual((second_cache.hits, second_cache.misses), (3, 0))
+        printed = [call.args[0] for call in mock_print.call_args_list if call.args]
+        self.assertIn("AI analysis cache: 3 hits, 0 misses", printed)
+
+
+class TestStreamingReport(ReportTestCase):
+    """Test cases for the incrementally written HTML report."""
+
+    def test_killed_run_leaves_partial_report(self):
+        """Items written before an interruption are already on disk."""
+        self.make_screenshots(5)
+        original = generate_ai_report.process_screenshot
+        calls = []
+
+        def flaky_process(path, *args, **kwargs):
+            calls.append(path)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            return original(path, *args, **kwargs)
+
+        with patch("generate_ai_report.process_screenshot", side_effect=flaky_process), \
+                patch("builtins.print"):
+            with self.assertRaises(KeyboardInterrupt):
+                generate_report(self.results_file, self.output_dir, max_workers=1,
+                                screenshot_source="walk")
+
+        [report_name] = os.listdir(self.output_dir)
+        with open(os.path.join(self.output_dir, report_name), encoding="utf-8") as f:
+            html = f.read()
+        self.assertIn("<h1>Maestro AI Test Report</h1>", html)
+        self.assertEqual(html.count('<div class="screenshot-item">'), 2)
+        self.assertNotIn("</html>", html)
+
+    def test_in_flight_work_is_bounded(self):
+        """The generator never runs far ahead of its consumer."""
+        paths = self.make_screenshots(50)
+        calls = []
+
+        def record(path, *args, **kwargs):
+            calls.append(path)
+            return {"metadata": {"path": path}}
+
+        with patch("generate_ai_report.process_screenshot", side_effect=record):
+            results = iter_analyzed_screenshots(paths, self.test_dir, max_workers=2)
+            first = next(results)
+            time.sleep(0.05)
+            self.assertLessEqual(len(calls), 4)
+            remaining = list(results)
+
+        self.assertEqual([first["metadata"]["path"]] + [r["metadata"]["path"] for r in remaining], paths)
+
+
+class TestScreenshotMetadata(ReportTestCase):
+    """Test cases for header-only metadata extraction and its cache."""
+
+    def setUp(self):
+        super().setUp()
+        generate_ai_report._metadata_cache.clear()
+
+    def test_png_header_without_pillow(self):
+        """PNG size, format and mode come from IHDR even when Pillow is missing."""
+        path = os.path.join(self.screenshot_dir, "screen.png")
+        write_png(path, width=1080, height=1920)
+
+        with patch("generate_ai_report.HAS_PIL", False):
+            metadata = get_screenshot_metadata(path)
+
+        self.assertEqual(metadata, {
+            "path": path, "width": 1080, "height": 1920, "format": "PNG", "mode": "RGB",
+        })
+
+    def test_unknown_format_returns_none(self):
+        """Files that are neither PNG nor JPEG are left to Pillow."""
+        path = os.path.join(self.screenshot_dir, "screen.png")
+        with open(path, "wb") as f:
+            f.write(b"GIF89a" + b"\0" * 20)
+        self.assertIsNone(read_image_header(path))
+
+    def test_cache_invalidated_when_file_changes(self):
+        """A rewritten file (new size and mtime) is re-read."""
+        path = os.path.join(self.screenshot_dir, "screen.png")
+        write_png(path, width=10, height=20)
+        self.assertEqual(get_screenshot_metadata(path)["width"], 10)
+
+        with patch("generate_ai_report.read_image_header") as mock_header:
+            self.assertEqual(get_screenshot_metadata(path)["width"], 10)
+            mock_header.assert_not_called()
+
+        write_png(path, width=30, height=20)
+        os.utime(path, ns=(0, 10 ** 9))
+        self.assertEqual(get_screenshot_metadata(path)["width"], 30)
+
+    def test_cache_is_bounded(self):
+        """Only the most recently used paths stay cached."""
+        paths = []
+        for i in range(4):
+            paths.append(os.path.join(self.screenshot_dir, f"screen_{i}.png"))
+            write_png(paths[-1], width=10 + i, height=20)
+
+        with patch("generate_ai_report.METADATA_CACHE_MAX_ENTRIES", 2):
+            get_screenshot_metadata(paths[0])
+            get_screenshot_metadata(paths[1])
+            get_screenshot_metadata(paths[0])
+            get_screenshot_metadata(paths[2])
+            get_screenshot_metadata(paths[3])
+            self.assertEqual(list(generate_ai_report._metadata_cache), [paths[2], paths[3]])
+            get_screenshot_metadata(paths[2])
+            self.assertEqual(list(generate_ai_report._metadata_cache), [paths[3], paths[2]])
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_header_matches_pillow(self):
+        """Header-only results agree with Pillow for common screenshot formats."""
+        from PIL import Image
+
+        cases = [("RGB", "PNG"), ("RGBA", "PNG"), ("L", "PNG"), ("P", "PNG"),
+                 ("1", "PNG"), ("RGB", "JPEG"), ("L", "JPEG")]
+        for mode, image_format in cases:
+            path = os.path.join(self.screenshot_dir, f"{mode}.{image_format.lower()}")
+            Image.new(mode, (37, 53)).save(path, image_format)
+            with self.subTest(mode=mode, format=image_format):
+                self.assertEqual(
+                    generate_ai_report._extract_screenshot_metadata(path),
+                    generate_ai_report._get_metadata_with_pil(path),
+                )
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_jpeg_exif_datetime_uses_pillow(self):
+        """EXIF DateTime is still reported for JPEGs that carry it."""
+        from PIL import Image
+
+        path = os.path.join(self.screenshot_dir, "photo.jpg")
+        exif = Image.Exif()
+        exif[0x0132] = "2025:05:24 16:45:47"
+        Image.new("RGB", (8, 8)).save(path, "JPEG", exif=exif)
+
+        self.assertTrue(read_image_header(path)["has_exif"])
+        self.assertEqual(get_screenshot_metadata(path)["datetime"], "2025:05:24 16:45:47")
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_metadata_micro_benchmark(self):
+        """Header-only extraction is a fraction of the cost of opening with Pillow."""
+        paths = []
+        for i in range(100):
+            path = os.path.join(self.screenshot_dir, f"screen_{i:03d}.png")
+            write_png(path, width=720, height=1280, color=(i, i, i))
+            paths.append(path)
+
+        def timed(extract):
+            start = time.perf_counter()
+            for _ in range(3):
+                for path in paths:
+                    extract(path)
+            return time.perf_counter() - start
+
+        pillow = timed(generate_ai_report._get_metadata_with_pil)
+        header = timed(generate_ai_report._extract_screenshot_metadata)
+        get_screenshot_metadata(paths[0])
+        cached = timed(get_screenshot_metadata)
+
+        self.assertLess(header, pillow / 2)
+        self.assertLess(cached, pillow / 2)
+
+
+@unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+class TestDeduplication(ReportTestCase):
+    """Test cases for perceptual-hash deduplication."""
+
+    def make_frame(self, name, seed, noise_pixel=None):
+        """A 200x400 frame of gray blocks; the same seed gives the same layout."""
+        import random
+        from PIL import Image
+
+        rng = random.Random(seed)
+        img = Image.new("L", (200, 400))
+        for y in range(0, 400, 25):
+            for x in range(0, 200, 25):
+                img.paste(rng.randrange(256), (x, y, x + 25, y + 25))
+        if noise_pixel is not None:
+            img.putpixel(noise_pixel, 0)
+        path = os.path.join(self.screenshot_dir, name)
+        img.convert("RGB").save(path, "PNG")
+        return path
+
+    def test_near_identical_frames_grouped(self):
+        """Frames that differ by a few pixels share a representative."""
+        first = self.make_frame("a_initial.png", 1)
+        again = self.make_frame("b_initial_again.png", 1, noise_pixel=(150, 10))
+        other = self.make_frame("c_other.png", 2)
+        paths = [first, again, other]
+
+        duplicates = group_near_duplicates(paths, max_distance=5)
+
+        self.assertEqual(list(duplicates), [again])
+        self.assertEqual(duplicates[again][:2], (1, first))
+
+    def test_distance_zero_only_groups_identical_hashes(self):
+        """A threshold of 0 still groups exact duplicates but nothing looser."""
+        first = self.make_frame("a.png", 1)
+        same = self.make_frame("b.png", 1)
+        other = self.make_frame("c.png", 2)
+
+        duplicates = group_near_duplicates([first, same, other], max_distance=0)
+        self.assertIn(same, duplicates)
+        self.assertNotIn(other, duplicates)
+
+    @unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+    def test_only_representatives_analysed(self):
+        """The report links duplicates to their representative instead of analysing them."""
+        self.make_frame("a_initial.png", 1)
+        self.make_frame("b_initial_again.png", 1, noise_pixel=(150, 10))
+        self.make_frame("c_other.png", 2)
+
+        with StubModelServer() as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"):
+            report_path = generate_report(
+                self.results_file, self.output_dir, api_url=server.url, dedup_distance=5,
+                screenshot_source="walk",
+            )
+
+        self.assertEqual(server.requests, 2)
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertIn('<h3 id="screenshot-1">', html)
+        self.assertIn('<a href="#screenshot-1">Screenshot 1: a_initial.png</a>', html)
+        self.assertIn("(duplicate)", html)
+
+
+class TestImagePreprocessing(ReportTestCase):
+    """Test cases for shrinking and re-encoding screenshots before upload."""
+
+    def make_noisy_png(self, name, size):
+        from PIL import Image
+
+        path = os.path.join(self.screenshot_dir, name)
+        Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3)).save(path, "PNG")
+        return path
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_large_png_resized_and_reencoded(self):
+        """A full-resolution PNG is shrunk to fit max_dimension and sent as JPEG."""
+        from PIL import Image
+        import io
+
+        with open(self.make_noisy_png("big.png", (1080, 1920)), "rb") as f:
+            original = f.read()
+
+        upload, mime_type = ImagePreprocessor(max_dimension=512).prepare(original)
+
+        self.assertEqual(mime_type, "image/jpeg")
+        self.assertLess(len(upload), len(original) / 10)
+        with Image.open(io.BytesIO(upload)) as img:
+            self.assertEqual((img.format, img.size), ("JPEG", (288, 512)))
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_webp_keeps_alpha(self):
+        """WebP uploads keep transparency and use the WebP MIME type."""
+        from PIL import Image
+        import io
+
+        source = io.BytesIO()
+        Image.new("RGBA", (2000, 1000), (10, 20, 30, 128)).save(source, "PNG")
+
+        upload, mime_type = ImagePreprocessor(1000, "webp").prepare(source.getvalue())
+
+        self.assertEqual(mime_type, "image/webp")
+        with Image.open(io.BytesIO(upload)) as img:
+            self.assertEqual((img.mode, img.size), ("RGBA", (1000, 500)))
+
+    def test_small_image_sent_as_is(self):
+        """When re-encoding would not help, the original bytes and MIME type are kept."""
+        path = os.path.join(self.screenshot_dir, "tiny.png")
+        write_png(path)
+        with open(path, "rb") as f:
+            original = f.read()
+
+        self.assertEqual(ImagePreprocessor().prepare(original), (original, "image/png"))
+        with patch("generate_ai_report.HAS_PIL", False):
+            self.assertEqual(ImagePreprocessor().prepare(original), (original, "image/png"))
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_oversized_image_resized_even_if_larger(self):
+        """max_dimension is enforced even when the resized upload is bigger than the original."""
+        from PIL import Image
+        import io
+
+        source = io.BytesIO()
+        Image.new("1", (600, 600), 1).save(source, "PNG")
+
+        upload, mime_type = ImagePreprocessor(max_dimension=512).prepare(source.getvalue())
+
+        self.assertGreater(len(upload), len(source.getvalue()))
+        self.assertEqual(mime_type, "image/jpeg")
+        with Image.open(io.BytesIO(upload)) as img:
+            self.assertEqual(img.size, (512, 512))
+
+    def test_rejects_unknown_format(self):
+        with self.assertRaises(ValueError):
+            ImagePreprocessor(image_format="bmp")
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL and generate_ai_report.HAS_REQUESTS,
+                         "Pillow and requests required")
+    def test_upload_uses_correct_mime_and_reports_sizes(self):
+        """The data URL matches the uploaded encoding and sizes reach the report."""
+        path = self.make_noisy_png("screen.png", (1080, 1920))
+        original_kb = os.path.getsize(path) // 1024
+
+        with StubModelServer(record=True) as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print") as mock_print:
+            report_path = generate_report(
+                self.results_file, self.output_dir, api_url=server.url,
+                preprocessor=ImagePreprocessor(max_dimension=768), screenshot_source="walk",
+            )
+
+        image_url = server.payloads[0]["messages"][0]["content"][1]["image_url"]["url"]
+        self.assertTrue(image_url.startswith("data:image/jpeg;base64,"))
+        with open(report_path, encoding="utf-8") as f:
+            self.assertIn(f"<strong>Upload size:</strong> {original_kb} KB &rarr;", f.read())
+        printed = " ".join(call.args[0] for call in mock_print.call_args_list if call.args)
+        self.assertIn("Uploaded 1 screenshots:", printed)
+
+    def test_cache_key_depends_on_preprocessing(self):
+        """Analyses of differently preprocessed uploads are cached separately."""
+        key = AnalysisCache.make_key(b"png", "prompt", "model", ImagePreprocessor().cache_tag)
+        other = AnalysisCache.make_key(b"png", "prompt", "model", ImagePreprocessor(512).cache_tag)
+        self.assertNotEqual(key, other)
+
+
+@unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+class TestAIClient(unittest.TestCase):
+    """Test cases for the pooled, retrying AI client."""
+
+    payload = {"model": "test", "messages": []}
+
+    def make_client(self, server, **kwargs):
+        kwargs.setdefault("backoff_base", 0.01)
+        client = AIClient(server.url, timeout=5, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_connections_are_reused(self):
+        """Sequential requests share one keep-alive connection."""
+        with StubModelServer() as server:
+            client = self.make_client(server)
+            for _ in range(5):
+                self.assertEqual(client.post(self.payload, "key").status_code, 200)
+
+        self.assertEqual(server.requests, 5)
+        self.assertEqual(len(server.connections), 1)
+
+    def test_retries_429_and_5xx(self):
+        """Transient failures are retried until the request succeeds."""
+        failures = [(429, {"Retry-After": "0"}), (503, {}), (502, {})]
+        with StubModelServer(failures=failures) as server:
+            response = self.make_client(server, max_retries=3).post(self.payload, "key")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(server.requests, 1)
+
+    def test_gives_up_after_max_retries(self):
+        """The last error response is returned once retries are exhausted."""
+        with StubModelServer(failures=[(500, {})] * 5) as server:
+            response = self.make_client(server, max_retries=2).post(self.payload, "key")
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(server.failures), 2)
+
+    def test_client_errors_not_retried(self):
+        """A 400 is final."""
+        with StubModelServer(failures=[(400, {}), (400, {})]) as server:
+            response = self.make_client(server).post(self.payload, "key")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(server.failures), 1)
+
+    def test_retry_after_is_honored(self):
+        """The client waits at least Retry-After seconds before retrying."""
+        with StubModelServer(failures=[(429, {"Retry-After": "0.3"})]) as server:
+            start = time.perf_counter()
+            self.make_client(server).post(self.payload, "key")
+            elapsed = time.perf_counter() - start
+
+        self.assertGreaterEqual(elapsed, 0.3)
+
+    def test_retry_after_beyond_backoff_max_is_honored(self):
+        """Retry-After is not clamped to backoff_max, only to retry_after_max."""
+        with StubModelServer(failures=[(429, {"Retry-After": "0.3"})]) as server:
+            start = time.perf_counter()
+            self.make_client(server, backoff_max=0.05).post(self.payload, "key")
+            elapsed = time.perf_counter() - start
+
+        self.assertGreaterEqual(elapsed, 0.3)
+        client = AIClient("http://localhost", backoff_max=1.0, retry_after_max=5.0)
+        self.assertEqual(client._backoff(0, retry_after=3600), 5.0)
+
+    def test_rate_limit_spaces_requests(self):
+        """A shared token bucket caps throughput across threads."""
+        with StubModelServer() as server:
+            client = self.make_client(server, rate_limit=20)
+            start = time.perf_counter()
+            threads = [threading.Thread(target=client.post, args=(self.payload, "key"))
+                       for _ in range(30)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+        # 20 burst tokens, then 10 more at 20/s
+        self.assertGreaterEqual(elapsed, 0.45)
+        self.assertEqual(server.requests, 30)
+
+    def test_screenshot_survives_rate_limit_response(self):
+        """A single 429 no longer fails the screenshot."""
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, "screen.png")
+            write_png(path)
+            with StubModelServer(failures=[(429, {"Retry-After": "0"})]) as server, \
+                    patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+                result = analyze_screenshot_with_ai(path, client=self.make_client(server))
+
+        self.assertEqual(result["status"], "success")
+
+
+class TestRetryHelpers(unittest.TestCase):
+    """Test cases for Retry-After parsing and the token bucket."""
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("2"), 2.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+
+    def test_token_bucket_burst_then_rate(self):
+        bucket = TokenBucket(rate=50, capacity=5)
+        start = time.perf_counter()
+        for _ in range(10):
+            bucket.acquire()
+        elapsed = time.perf_counter() - start
+        self.assertGreaterEqual(elapsed, 0.09)
+        self.assertLess(elapsed, 1.0)
+
+
+@unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+class TestBatchAnalysis(ReportTestCase):
+    """Test cases for multi-image batch requests."""
+
+    def test_batches_map_back_to_screenshots(self):
+        """Seven screenshots in batches of three take three requests, results in order."""
+        paths = self.make_screenshots(7)
+        with StubModelServer(record=True) as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"):
+            results = analyze_screenshots(paths, self.test_dir, max_workers=2,
+                                          api_url=server.url, batch_size=3)
+            self.assertEqual(server.requests, 3)
+            singles = analyze_screenshots(paths, self.test_dir, api_url=server.url)
+
+        self.assertEqual([r["metadata"]["path"] for r in results], paths)
+        # The stub's answer depends only on the image, so batched answers must match single ones
+        analyses = [r["ai_analysis"]["analysis"] for r in results]
+        self.assertEqual(analyses, [r["ai_analysis"]["analysis"] for r in singles])
+        self.assertEqual(len(set(analyses)), 7)
+        self.assertEqual([r["ai_analysis"]["batch_size"] for r in results], [3] * 6 + [1])
+        self.assertTrue(all(r["ai_analysis"]["status"] == "success" for r in results))
+
+        # Two workers may send the first two batches in either order
+        first = next(r for r in server.payloads
+                     if r["messages"][0]["content"][1]["text"] == "Screenshot 1: screen_000.png")
+        self.assertIn("3 consecutive screenshots", first["messages"][0]["content"][0]["text"])
+        self.assertEqual(first["max_tokens"], 900)
+
+    def test_payload_budget_splits_batch(self):
+        """A batch whose images exceed max_bytes is split across requests."""
+        paths = self.make_screenshots(4)
+        encoded_size = len(generate_ai_report._prepare_upload(open(paths[0], "rb").read(), None)[0])
+        with StubModelServer() as server, patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+            results = generate_ai_report.analyze_screenshot_batch_with_ai(
+                paths, api_url=server.url, max_bytes=encoded_size * 2 + 16
+            )
+
+        self.assertEqual(server.requests, 2)
+        self.assertEqual([r["batch_size"] for r in results], [2, 2, 2, 2])
+
+    def test_duplicates_left_out_of_batch(self):
+        """Only screenshots that need analysis are sent."""
+        paths = self.make_screenshots(3)
+        duplicates = {paths[2]: (1, paths[0], 0)}
+
+        with StubModelServer(record=True) as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"):
+            results = analyze_screenshots(paths, self.test_dir, api_url=server.url,
+                                          duplicates=duplicates, batch_size=3)
+
+        self.assertEqual(server.requests, 1)
+        images = [p for p in server.payloads[0]["messages"][0]["content"] if p["type"] == "image_url"]
+        self.assertEqual(len(images), 2)
+        self.assertEqual([r["ai_analysis"]["status"] for r in results],
+                         ["success", "success", "duplicate"])
+
+    def test_cache_reuses_only_the_same_sequence(self):
+        """A cached batch answer is reused for the same frames in the same order, never for one frame elsewhere."""
+        paths = self.make_screenshots(3)
+        cache = AnalysisCache(os.path.join(self.test_dir, "cache"))
+        with StubModelServer() as server, patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+            first = generate_ai_report.analyze_screenshot_batch_with_ai(paths[:2], api_url=server.url, cache=cache)
+            again = generate_ai_report.analyze_screenshot_batch_with_ai(paths[:2], api_url=server.url, cache=cache)
+            self.assertEqual(server.requests, 1)
+            self.assertEqual([r["analysis"] for r in again], [r["analysis"] for r in first])
+            self.assertTrue(all(r["cached"] for r in again))
+
+            generate_ai_report.analyze_screenshot_batch_with_ai(paths[1:], api_url=server.url, cache=cache)
+            generate_ai_report.analyze_screenshot_batch_with_ai(paths[1::-1], api_url=server.url, cache=cache)
+            self.assertEqual(server.requests, 3)
+
+    def test_cached_batches_are_not_encoded(self):
+        """A rerun looks batches up from file digests and never preprocesses or encodes an image."""
+        paths = self.make_screenshots(5)
+        cache = AnalysisCache(os.path.join(self.test_dir, "cache"))
+        encoded_size = len(generate_ai_report._prepare_upload(open(paths[0], "rb").read(), None)[0])
+        with StubModelServer() as server, patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+            first = generate_ai_report.analyze_screenshot_batch_with_ai(
+                paths, api_url=server.url, cache=cache, max_bytes=encoded_size * 2 + 16
+            )
+            with patch("generate_ai_report._prepare_upload", side_effect=AssertionError("encoded")):
+                again = generate_ai_report.analyze_screenshot_batch_with_ai(
+                    paths, api_url=server.url, cache=cache, max_bytes=encoded_size * 2 + 16
+                )
+
+        self.assertEqual(server.requests, 3)
+        self.assertEqual([r["analysis"] for r in again], [r["analysis"] for r in first])
+        self.assertEqual([r["batch_size"] for r in again], [2, 2, 2, 2, 1])
+        self.assertTrue(all(r["cached"] for r in again))
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+    def test_failed_batch_marks_every_screenshot(self):
+        """A failed request reports the error on each screenshot it carried."""
+        paths = self.make_screenshots(2)
+        with StubModelServer(failures=[(400, {})]) as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+            results = generate_ai_report.analyze_screenshot_batch_with_ai(paths, api_url=server.url)
+
+        self.assertEqual([r["reason"] for r in results], ["API error: 400"] * 2)
+
+
+class TestParseBatchResponse(unittest.TestCase):
+    """Test cases for splitting batched answers."""
+
+    def test_json_in_code_fence(self):
+        content = 'Here you go:\n```json\n[{"screenshot": 2, "analysis": "b"}, {"screenshot": 1, "analysis": "a"}]\n```'
+        self.assertEqual(parse_batch_response(content, 3), ["a", "b", None])
+
+    def test_heading_fallback(self):
+        content = "## Screenshot 1: login\nLooks fine.\n\n**Screenshot 2**\nButton too small."
+        self.assertEqual(parse_batch_response(content, 2), ["Looks fine.", "Button too small."])
+
+    def test_single_image_plain_text(self):
+        self.assertEqual(parse_batch_response("Just text", 1), ["Just text"])
+
+
+class TestMaestroResults(ReportTestCase):
+    """Test cases for locating screenshots from Maestro command output."""
+
+    def write_commands(self, commands):
+        with open(self.results_file, "w") as f:
+            json.dump(commands, f)
+
+    def test_iter_json_array_small_chunks(self):
+        """Elements split across read boundaries decode the same as json.load."""
+        data = [maestro_command("tapOn", text="My"), 12345, "text", [1, 2], {"nested": {"a": None}}]
+        text = json.dumps(data, indent=2)
+        for chunk_size in (1, 3, 7, 64):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(list(iter_json_array(io.StringIO(text), chunk_size)), data)
+        self.assertEqual(list(iter_json_array(io.StringIO(" [ ] "))), [])
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('[{"a": 1} {"b": 2}]')))
+
+    def test_parse_steps_and_screenshots(self):
+        """Screenshot paths, timings and statuses come from the command list."""
+        write_png(os.path.join(self.test_dir, "android_initial_state.png"))
+        write_png(os.path.join(self.screenshot_dir, "flutter_launched_state.png"))
+        self.write_commands([
+            maestro_command("launchApp", duration=1800, appId="com.example"),
+            maestro_command("takeScreenshot", duration=196, path="android_initial_state"),
+            maestro_command("tapOn", status="FAILED", duration=5000, text="TF"),
+            maestro_command("takeScreenshot", path="flutter_launched_state"),
+            maestro_command("takeScreenshot", status="SKIPPED", path="never_taken"),
+        ])
+
+        results = parse_maestro_results(self.results_file)
+
+        self.assertEqual([s["command"] for s in results["steps"]],
+                         ["launchApp", "takeScreenshot", "tapOn", "takeScreenshot", "takeScreenshot"])
+        self.assertEqual(results["steps"][2]["status"], "FAILED")
+        self.assertEqual(results["steps"][0]["duration_ms"], 1800)
+        self.assertEqual(results["screenshot_paths"], [
+            os.path.join(self.test_dir, "android_initial_state.png"),
+            os.path.join(self.screenshot_dir, "flutter_launched_state.png"),
+        ])
+        self.assertEqual(results["missing_screenshots"], ["never_taken"])
+
+    def test_report_only_uses_listed_screenshots(self):
+        """Stale files in .maestro/screenshots are ignored unless walking is requested."""
+        stale, current = self.make_screenshots(2)
+        self.write_commands([
+            maestro_command("launchApp", duration=1200),
+            maestro_command("takeScreenshot", duration=150, path=os.path.relpath(current, self.test_dir)),
+        ])
+
+        with patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir)
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+
+        self.assertEqual(html.count('<div class="screenshot-item">'), 1)
+        self.assertNotIn(os.path.basename(stale), html)
+        self.assertIn("Steps: 2 (2 passed, 0 failed), total duration 1.4 s", html)
+        self.assertIn("<strong>Step:</strong> #2 takeScreenshot (COMPLETED, 150 ms)", html)
+        self.assertIn("<tr><td>launchApp</td><td>1</td><td>1.20</td>", html)
+        self.assertLess(html.index("<h3>Slowest Steps</h3>"), html.index("Screenshots Analysis"))
+
+        with patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk")
+        with open(report_path, encoding="utf-8") as f:
+            self.assertEqual(f.read().count('<div class="screenshot-item">'), 2)
+
+    def test_empty_results_file_is_an_error(self):
+        open(self.results_file, "w").close()
+        with patch("builtins.print"):
+            self.assertFalse(generate_report(self.results_file, self.output_dir))
+
+
+@unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+class TestIncrementalManifest(ReportTestCase):
+    """Test cases for reusing a previous run's manifest."""
+
+    def setUp(self):
+        super().setUp()
+        self.manifest_path = os.path.join(self.test_dir, "manifest.json")
+
+    def run_report(self, server, **kwargs):
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), patch("builtins.print"):
+            return generate_report(self.results_file, self.output_dir, api_url=server.url,
+                                   screenshot_source="walk", manifest_path=self.manifest_path,
+                                   **kwargs)
+
+    def test_unchanged_screenshots_are_reused(self):
+        """A second run over the same screenshots makes no API requests."""
+        self.make_screenshots(3)
+        with StubModelServer() as server:
+            self.run_report(server)
+            self.assertEqual(server.requests, 3)
+            report_path = self.run_report(server)
+            self.assertEqual(server.requests, 3)
+
+        with open(report_path, encoding="utf-8") as f:
+            self.assertEqual(f.read().count("Stub analysis"), 3)
+        with open(self.manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.assertEqual(len(manifest["screenshots"]), 3)
+
+    def test_reused_screenshots_are_not_counted_as_uploads(self):
+        paths = self.make_screenshots(2)
+        with StubModelServer() as server:
+            self.run_report(server)
+            write_png(paths[1], width=8, color=(0, 255, 0))
+            with patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                    patch("builtins.print") as mock_print:
+                generate_report(self.results_file, self.output_dir, api_url=server.url,
+                                screenshot_source="walk", manifest_path=self.manifest_path)
+
+        printed = [call.args[0] for call in mock_print.call_args_list if call.args]
+        self.assertIn("Manifest: reusing analyses for 1 of 2 screenshots", printed)
+        self.assertTrue(any(line.startswith("Uploaded 1 screenshots:") for line in printed))
+
+    def test_changed_and_new_screenshots_are_reprocessed(self):
+        paths = self.make_screenshots(3)
+        with StubModelServer() as server:
+            self.run_report(server)
+            write_png(paths[1], width=8, color=(0, 255, 0))
+            write_png(os.path.join(self.screenshot_dir, "screen_100.png"))
+            self.run_report(server)
+            self.assertEqual(server.requests, 5)
+
+            # Touching a file without changing its content still reuses it
+            os.utime(paths[0], ns=(0, 0))
+            self.run_report(server)
+            self.assertEqual(server.requests, 5)
+
+            self.run_report(server, incremental=False)
+            self.assertEqual(server.requests, 9)
+
+    def test_settings_change_invalidates_reuse(self):
+        self.make_screenshots(2)
+        with StubModelServer() as server:
+            self.run_report(server)
+            self.run_report(server, batch_size=2)
+            self.assertEqual(server.requests, 3)
+
+    def test_failed_analyses_are_retried(self):
+        self.make_screenshots(2)
+        with StubModelServer(failures=[(500, {})] * 2) as server:
+            self.run_report(server, client=AIClient(server.url, max_retries=0))
+            self.assertEqual(server.requests, 0)
+            self.run_report(server)
+            self.assertEqual(server.requests, 2)
+
+    def test_rebuild_reads_no_images(self):
+        """The report can be regenerated from the manifest alone."""
+        self.make_screenshots(2)
+        with StubModelServer() as server:
+            first = self.run_report(server)
+        with open(first, encoding="utf-8") as f:
+            original = f.read()
+        os.remove(first)
+
+        real_open = open
+
+        def guarded_open(path, *args, **kwargs):
+            self.assertFalse(str(path).endswith(".png"), f"image read: {path}")
+            return real_open(path, *args, **kwargs)
+
+        with patch("builtins.open", guarded_open), patch("builtins.print"):
+            rebuilt = rebuild_report_from_manifest(self.manifest_path, self.output_dir)
+        with open(rebuilt, encoding="utf-8") as f:
+            html = f.read()
+        self.assertEqual(html.count('<div class="screenshot-item">'), 2)
+        self.assertEqual(html.count("Stub analysis"), original.count("Stub analysis"))
+
+    def test_missing_manifest_cannot_rebuild(self):
+        with patch("builtins.print"):
+            self.assertFalse(rebuild_report_from_manifest(self.manifest_path, self.output_dir))
+
+
+class ResultsFilesTestCase(unittest.TestCase):
+    """Writes one Maestro commands file per run under a temporary directory."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_run(self, run, flow, durations, failed=False, day=0):
+        directory = os.path.join(self.test_dir, f"run_{run:04d}")
+        os.makedirs(directory, exist_ok=True)
+        timestamp = 1716565547000 + day * 86400000
+        commands = [maestro_command("launchApp", duration=durations[0], timestamp=timestamp)]
+        commands += [maestro_command("tapOn", duration=d, timestamp=timestamp) for d in durations[1:]]
+        if failed:
+            commands[-1]["metadata"]["status"] = "FAILED"
+        path = os.path.join(directory, f"commands-({flow}).json")
+        with open(path, "w") as f:
+            json.dump(commands, f)
+        return path
+
+
+class TestAggregation(ResultsFilesTestCase):
+    """Test cases for the multi-run trend report."""
+
+    def test_flow_name(self):
+        self.assertEqual(flow_name("/ci/commands-(hello_world.yaml).json"), "hello_world.yaml")
+        self.assertEqual(flow_name("/ci/results.json"), "results")
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles([4, 1, 3, 2, 5], (0, 50, 100)), [1, 3, 5])
+        self.assertEqual(percentiles([10, 20], (50,)), [15])
+        self.assertEqual(percentiles([float("nan")], (50,)), [None])
+
+    def test_collect_directories_and_globs(self):
+        first = self.write_run(0, "a.yaml", [100])
+        second = self.write_run(1, "b.yaml", [100])
+        with open(os.path.join(self.test_dir, generate_ai_report.MANIFEST_FILENAME), "w") as f:
+            f.write("{}")
+        self.assertEqual(collect_results_files([self.test_dir]), [first, second])
+        pattern = os.path.join(self.test_dir, "**", "commands-(b.yaml).json")
+        self.assertEqual(collect_results_files([pattern, second]), [second])
+
+    def test_index_pass_rates_and_percentiles(self):
+        paths = [self.write_run(i, "hello_world.yaml", [1000, 100 * i], failed=(i == 3)) for i in range(5)]
+        paths.append(self.write_run(5, "basic_navigation.yaml", [2000, 500], day=1))
+        broken = os.path.join(self.test_dir, "broken.json")
+        with open(broken, "w") as f:
+            f.write("not json")
+
+        index = build_results_index(paths + [broken])
+
+        self.assertEqual(len(index), 6)
+        self.assertEqual([path for path, _ in index.errors], [broken])
+        self.assertEqual(len(index.step_duration), 12)
+        summary = {flow["flow"]: flow for flow in index.flow_summary()}
+        hello = summary["hello_world.yaml"]
+        self.assertEqual((hello["runs"], hello["passed"]), (5, 4))
+        self.assertAlmostEqual(hello["pass_rate"], 0.8)
+        self.assertEqual(hello["percentiles"][0], 1200)
+        self.assertEqual([row[:2] for row in index.daily_trend()],
+                         [("2024-05-24", "hello_world.yaml"), ("2024-05-25", "basic_navigation.yaml")])
+
+    def test_worker_processes_match_single_process(self):
+        paths = [self.write_run(i, f"flow_{i % 3}.yaml", [100 + i, 200], failed=(i % 7 == 0))
+                 for i in range(40)]
+        sequential = build_results_index(paths)
+        parallel = build_results_index(paths, max_workers=2, chunk_size=8)
+        self.assertEqual(parallel.flow_summary(), sequential.flow_summary())
+        self.assertEqual(parallel.run_files, sequential.run_files)
+
+    def test_aggregate_report(self):
+        for i in range(4):
+            self.write_run(i, "hello_world.yaml", [1000], failed=(i == 0))
+        output_dir = os.path.join(self.test_dir, "report")
+        with patch("builtins.print"):
+            report_path = generate_aggregate_report([self.test_dir], output_dir)
+            self.assertFalse(generate_aggregate_report([os.path.join(self.test_dir, "none")], output_dir))
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertIn("<tr><td>hello_world.yaml</td><td>4</td><td>3</td>", html)
+        self.assertIn("75.0%", html)
+
+
+class TestStepAnalytics(ResultsFilesTestCase):
+    """Test cases for step latency and flakiness analytics."""
+
+    def test_command_latency_sorted_by_p95(self):
+        latency = command_latency([("tapOn", 100), ("launchApp", 3000), ("tapOn", 300),
+                                   ("launchApp", 1000), ("assertVisible", None)])
+        self.assertEqual([row["command"] for row in latency], ["launchApp", "tapOn"])
+        self.assertEqual(latency[0]["count"], 2)
+        self.assertEqual(latency[0]["max_ms"], 3000)
+        self.assertEqual(latency[1]["percentiles"][0], 200)
+
+    def test_slowest_steps_of_one_run(self):
+        steps = [{"index": i, "command": "tapOn", "status": "COMPLETED", "duration_ms": d}
+                 for i, d in enumerate([50, None, 900, 300], start=1)]
+        self.assertEqual([step["index"] for step in slowest_steps(steps, limit=2)], [3, 4])
+
+    def test_slowest_steps_across_runs(self):
+        paths = [self.write_run(i, "hello_world.yaml", [4000 + i, 100, 200]) for i in range(4)]
+        index = build_results_index(paths)
+        slowest = index.slowest_steps(limit=2)
+        self.assertEqual([(step["index"], step["command"]) for step in slowest],
+                         [(1, "launchApp"), (3, "tapOn")])
+        self.assertEqual(slowest[0]["runs"], 4)
+
+    def test_flaky_steps(self):
+        # Step 2 fails on runs 1 and 3, step 1 always passes
+        paths = [self.write_run(i, "hello_world.yaml", [1000, 200], failed=i in (1, 3), day=i)
+                 for i in range(5)]
+        paths.append(self.write_run(5, "basic_navigation.yaml", [1000, 200], failed=True))
+        index = build_results_index(paths)
+
+        flaky = index.flaky_steps()
+        self.assertEqual(len(flaky), 1)
+        step = flaky[0]
+        self.assertEqual((step["flow"], step["index"], step["command"]), ("hello_world.yaml", 2, "tapOn"))
+        self.assertEqual((step["runs"], step["failures"], step["flips"]), (5, 2, 4))
+        self.assertAlmostEqual(step["failure_rate"], 0.4)
+
+    def test_report_tables(self):
+        for i in range(3):
+            self.write_run(i, "hello_world.yaml", [5000, 100], failed=(i == 1))
+        with patch("builtins.print"):
+            report_path = generate_aggregate_report([self.test_dir], os.path.join(self.test_dir, "out"))
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertIn("<h3>Command Latency</h3>", html)
+        self.assertIn("<tr><td>launchApp</td><td>3</td><td>5.00</td>", html)
+        self.assertIn("<tr><td>hello_world.yaml</td><td>2</td><td>tapOn</td><td>3</td><td>1</td>", html)
+
+
+@unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+class TestThumbnails(ReportTestCase):
+    """Test cases for report thumbnails and the zip bundle."""
+
+    def test_thumbnails_sized_and_shared_by_content(self):
+        large = os.path.join(self.screenshot_dir, "large.png")
+        write_png(large, width=1080, height=1920)
+        copy = os.path.join(self.screenshot_dir, "copy.png")
+        shutil.copy(large, copy)
+        thumbnail_dir = os.path.join(self.output_dir, "thumbnails")
+
+        thumbnails = make_thumbnails([large, copy], thumbnail_dir, size=160, max_workers=2)
+
+        self.assertEqual(thumbnails[large], thumbnails[copy])
+        self.assertEqual((thumbnails[large]["width"], thumbnails[large]["height"]), (90, 160))
+        self.assertEqual(os.listdir(thumbnail_dir), [thumbnails[large]["file"]])
+
+        with patch("PIL.Image.open", side_effect=AssertionError("decoded again")):
+            self.assertEqual(make_thumbnails([large], thumbnail_dir, size=160), {large: thumbnails[large]})
+
+    def test_report_uses_lazy_thumbnails(self):
+        self.make_screenshots(2)
+        with patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                          thumbnail_size=64)
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertEqual(html.count('loading="lazy"'), 2)
+        full_size = os.path.relpath(os.path.join(self.screenshot_dir, "screen_000.png"), self.output_dir)
+        self.assertIn(f'<a href="{full_size}"><img src="thumbnails/', html)
+
+    def test_bundle_is_self_contained(self):
+        self.make_screenshots(2)
+        with patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                          thumbnail_size=64, bundle=True)
+        bundle_path = report_path[:-len(".html")] + ".zip"
+
+        with zipfile.ZipFile(bundle_path) as archive:
+            names = set(archive.namelist())
+            html = archive.read(os.path.basename(report_path)).decode("utf-8")
+        self.assertIn("screenshots/0001_screen_000.png", names)
+        self.assertEqual(sum(name.startswith("thumbnails/") for name in names), 2)
+        for reference in re.findall(r'(?:src|href)="([^"#]+)"', html):
+            self.assertIn(reference, names)
+
+    def test_assets_stream_with_the_report(self):
+        """Thumbnails are rendered as the report is written, and the bundle leaves no temporary files."""
+        self.make_screenshots(4)
+        written = []
+        make_thumbnail = generate_ai_report.make_thumbnail
+
+        def recording_thumbnail(screenshot_path, *args):
+            written.append(read_partial_report(self.output_dir).count('class="screenshot-item"'))
+            return make_thumbnail(screenshot_path, *args)
+
+        with patch("generate_ai_report.make_thumbnail", side_effect=recording_thumbnail), \
+                patch("builtins.print"):
+            generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                            thumbnail_size=64, bundle=True)
+
+        self.assertEqual(written, [0, 1, 2, 3])
+        self.assertEqual([name for name in os.listdir(self.output_dir) if name.endswith(".tmp")], [])
+
+    def test_bundle_leaves_loose_report_linked_to_disk(self):
+        """Only the archived copy links into the bundle; the report and manifest keep on-disk paths."""
+        self.make_screenshots(2)
+        manifest_path = os.path.join(self.output_dir, generate_ai_report.MANIFEST_FILENAME)
+        with patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                          thumbnail_size=64, bundle=True, manifest_path=manifest_path)
+            rebuilt_path = rebuild_report_from_manifest(manifest_path, self.output_dir)
+
+        for path in (report_path, rebuilt_path):
+            with open(path, encoding="utf-8") as f:
+                references = re.findall(r'(?:src|href)="([^"#]+)"', f.read())
+            self.assertEqual(len(references), 4)
+            for reference in references:
+                self.assertTrue(os.path.isfile(os.path.join(self.output_dir, reference)), reference)
+
+
+@unittest.skipUnless(generate_ai_report.HAS_PIL and generate_ai_report.HAS_NUMPY,
+                     "Pillow and NumPy not installed")
+class TestBaselineComparison(ReportTestCase):
+    """Test cases for pixel diffs against a baseline set."""
+
+    def setUp(self):
+        super().setUp()
+        self.baseline_dir = os.path.join(self.test_dir, "baseline")
+        os.makedirs(self.baseline_dir)
+        self.diff_dir = os.path.join(self.test_dir, "diffs")
+        os.makedirs(self.diff_dir)
+
+    def write_frame(self, path, changed_box=None, size=(120, 200)):
+        from PIL import Image, ImageDraw
+        img = Image.new("RGB", size, (30, 60, 90))
+        if changed_box:
+            ImageDraw.Draw(img).rectangle(changed_box, fill=(255, 255, 255))
+        img.save(path)
+        return path
+
+    def test_identical_files_are_not_decoded(self):
+        current = self.write_frame(os.path.join(self.screenshot_dir, "a.png"))
+        baseline = shutil.copy(current, os.path.join(self.baseline_dir, "a.png"))
+        with patch("PIL.Image.open", side_effect=AssertionError("decoded")):
+            comparison = compare_to_baseline(current, baseline)
+        self.assertEqual((comparison["status"], comparison["similarity"]), ("unchanged", 1.0))
+
+    def test_changed_frame_gets_heatmap(self):
+        current = self.write_frame(os.path.join(self.screenshot_dir, "a.png"), changed_box=(10, 10, 19, 19))
+        baseline = self.write_frame(os.path.join(self.baseline_dir, "a.png"))
+        heatmap = os.path.join(self.diff_dir, "a_diff.png")
+
+        comparison = compare_to_baseline(current, baseline, heatmap)
+
+        self.assertEqual(comparison["status"], "changed")
+        self.assertEqual(comparison["changed_pixels"], 100)
+        self.assertAlmostEqual(comparison["similarity"], 1 - 100 / (120 * 200))
+        self.assertEqual(comparison["heatmap"], heatmap)
+        from PIL import Image
+        with Image.open(heatmap) as img:
+            self.assertEqual(img.getpixel((15, 15))[0], 252)
+            self.assertLess(img.getpixel((60, 100))[0], 40)
+
+    def test_tolerance_and_threshold(self):
+        from PIL import Image
+        current = os.path.join(self.screenshot_dir, "a.png")
+        Image.new("RGB", (120, 200), (38, 60, 90)).save(current)
+        baseline = self.write_frame(os.path.join(self.baseline_dir, "a.png"))
+        self.assertEqual(compare_to_baseline(current, baseline)["changed_pixels"], 0)
+
+        changed = self.write_frame(current, changed_box=(0, 0, 0, 0))
+        self.assertEqual(compare_to_baseline(changed, baseline)["status"], "unchanged")
+        self.assertEqual(compare_to_baseline(changed, baseline, threshold=1.0)["status"], "changed")
+
+    def test_new_and_resized_frames(self):
+        new = self.write_frame(os.path.join(self.screenshot_dir, "new.png"))
+        resized = self.write_frame(os.path.join(self.screenshot_dir, "resized.png"), size=(100, 100))
+        self.write_frame(os.path.join(self.baseline_dir, "resized.jpg"))
+
+        comparisons = compare_with_baseline([new, resized], self.baseline_dir, self.diff_dir, max_workers=2)
+
+        self.assertEqual(comparisons[new]["status"], "new")
+        self.assertEqual(comparisons[resized]["status"], "size-changed")
+        self.assertEqual(comparisons[resized]["baseline"], os.path.join(self.baseline_dir, "resized.jpg"))
+
+    def test_comparisons_stream_with_the_report(self):
+        """Frames are compared as the report is written; a job still never queues matching frames."""
+        for name in ("a", "b", "c"):
+            self.write_frame(os.path.join(self.screenshot_dir, f"{name}.png"),
+                             changed_box=(5, 5, 50, 50) if name == "b" else None)
+            self.write_frame(os.path.join(self.baseline_dir, f"{name}.png"))
+        written = []
+        compare_to_baseline = generate_ai_report.compare_to_baseline
+
+        def recording_compare(*args):
+            written.append(read_partial_report(self.output_dir).count('class="screenshot-item"'))
+            return compare_to_baseline(*args)
+
+        analyzer = RecordingAnalyzer()
+        with patch("generate_ai_report.compare_to_baseline", side_effect=recording_compare), \
+                patch("builtins.print") as mock_print:
+            generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                            baseline_dir=self.baseline_dir, analyzer=analyzer)
+        self.assertEqual(written, [0, 1, 2])
+        self.assertEqual(analyzer.calls, ["b.png"])
+        printed = [call.args[0] for call in mock_print.call_args_list if call.args]
+        self.assertIn(f"Baseline: 2 of 3 screenshots match {self.baseline_dir}; only the rest were analysed",
+                      printed)
+
+        analyzer = RecordingAnalyzer()
+        queue = JobQueue(os.path.join(self.test_dir, "job.sqlite"))
+        try:
+            with patch("builtins.print"):
+                report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                              baseline_dir=self.baseline_dir, analyzer=analyzer, job_queue=queue)
+            self.assertEqual(queue.counts(), {"done": 1})
+        finally:
+            queue.close()
+        self.assertEqual(analyzer.calls, ["b.png"])
+        with open(report_path, encoding="utf-8") as f:
+            self.assertEqual(f.read().count("(unchanged)"), 2)
+
+    @unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+    def test_only_changed_frames_are_analysed(self):
+        for name in ("same", "changed", "new"):
+            self.write_frame(os.path.join(self.screenshot_dir, f"{name}.png"),
+                             changed_box=(5, 5, 50, 50) if name == "changed" else None)
+        for name in ("same", "changed"):
+            self.write_frame(os.path.join(self.baseline_dir, f"{name}.png"))
+
+        with StubModelServer() as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, api_url=server.url,
+                                          screenshot_source="walk", baseline_dir=self.baseline_dir)
+        self.assertEqual(server.requests, 2)
+
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertIn("(unchanged)", html)
+        self.assertIn("no baseline image", html)
+        self.assertIn('<a href="diffs/0001_changed_diff.png">diff heatmap</a>', html)
+        self.assertTrue(os.path.isfile(os.path.join(self.output_dir, "diffs", "0001_changed_diff.png")))
+
+
+@unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+class TestVideoKeyframes(ReportTestCase):
+    """Test cases for picking keyframes out of screen recordings."""
+
+    def screen(self, seed):
+        import random
+        from PIL import Image
+        rng = random.Random(seed)
+        blocks = Image.frombytes("L", (8, 16), bytes(rng.randrange(256) for _ in range(128)))
+        return blocks.resize((72, 144), Image.NEAREST).convert("RGB")
+
+    def frames(self, screens):
+        from PIL import Image
+        images = {"A": self.screen(1), "B": self.screen(2), "C": self.screen(3)}
+        images["A/B"] = Image.blend(images["A"], images["B"], 0.5)
+        return [(index / 2, images[name]) for index, name in enumerate(screens)]
+
+    def select(self, screens, **kwargs):
+        frames = self.frames(screens)
+        timestamps = [timestamp for timestamp, _ in KeyframeExtractor(**kwargs).select(iter(frames))]
+        return [screens[int(timestamp * 2)] + f"@{int(timestamp * 2)}" for timestamp in timestamps]
+
+    def test_keyframe_after_transition_settles(self):
+        self.assertEqual(self.select(["A", "A", "A/B", "B", "B", "B", "A", "A"]), ["A@0", "B@4", "A@7"])
+
+    def test_screen_changing_at_end_is_kept(self):
+        self.assertEqual(self.select(["A", "A", "C"]), ["A@0", "C@2"])
+
+    def test_return_to_same_screen_is_not_a_keyframe(self):
+        self.assertEqual(self.select(["A", "A/B", "A", "A", "A"]), ["A@0"])
+
+    def test_max_keyframes(self):
+        self.assertEqual(self.select(["A", "B", "B", "C", "C"], max_keyframes=2), ["A@0", "B@2"])
+
+    def fake_ffmpeg(self, images):
+        stream = io.BytesIO(b"".join(
+            b"P6\n%d %d\n255\n" % img.size + img.tobytes() for img in images
+        ))
+
+        class Process:
+            stdout = stream
+
+            def poll(self):
+                return 0
+
+            def wait(self):
+                return 0
+
+        return patch("generate_ai_report.subprocess.Popen", return_value=Process())
+
+    def test_frames_streamed_from_ffmpeg_pipe(self):
+        images = [self.screen(1), self.screen(2)]
+        with self.fake_ffmpeg(images) as popen:
+            frames = list(iter_video_frames("run.mp4", fps=4))
+        self.assertIn("fps=4", " ".join(popen.call_args[0][0]))
+        self.assertEqual([timestamp for timestamp, _ in frames], [0, 0.25])
+        self.assertEqual(frames[1][1].tobytes(), images[1].tobytes())
+
+    def test_report_includes_video_keyframes(self):
+        video_dir = os.path.join(self.test_dir, "maestro_videos")
+        os.makedirs(video_dir)
+        open(os.path.join(video_dir, "flow_20250523.mp4"), "wb").close()
+        open(os.path.join(video_dir, "maestro.log"), "w").close()
+        frames = [img for _, img in self.frames(["A", "A", "B", "B"])]
+
+        with self.fake_ffmpeg(frames), patch("generate_ai_report.shutil.which", return_value="ffmpeg"), \
+                patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                          videos=[video_dir])
+
+        keyframe_dir = os.path.join(self.output_dir, "keyframes", "flow_20250523")
+        self.assertEqual(sorted(os.listdir(keyframe_dir)),
+                         ["flow_20250523_00000000ms.png", "flow_20250523_00001500ms.png"])
+        with open(report_path, encoding="utf-8") as f:
+            self.assertEqual(f.read().count('<div class="screenshot-item">'), 2)
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg not installed")
+    def test_real_video(self):
+        video = os.path.join(self.test_dir, "clip.mp4")
+        subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=10",
+                        "-t", "2", video], check=True)
+        frames = list(iter_video_frames(video, fps=2, width=160))
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(frames[0][1].size, (160, 120))
+
+
+class TestAnalyzers(ReportTestCase):
+    """Test cases for the interchangeable analysis backends."""
+
+    def test_contrast_ratio(self):
+        self.assertAlmostEqual(contrast_ratio((255, 255, 255), (0, 0, 0)), 21.0)
+        self.assertAlmostEqual(contrast_ratio((118, 118, 118), (255, 255, 255)), 4.54, places=2)
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_heuristic_gradient_has_no_content_region(self):
+        """A smooth gradient has no edges to measure; it is described, not a crash."""
+        from PIL import Image
+        gradient = os.path.join(self.screenshot_dir, "gradient.png")
+        img = Image.new("L", (200, 400))
+        img.putdata([y * 255 // 400 for y in range(400) for _ in range(200)])
+        img.convert("RGB").save(gradient)
+
+        analyzer = HeuristicAnalyzer()
+        result = analyzer.analyze(gradient)
+        self.assertEqual(result["status"], "success")
+        self.assertIsNone(result["metrics"]["content_top"])
+        self.assertIn("no distinct content region", result["analysis"])
+
+        with patch.object(analyzer, "describe", side_effect=ValueError("bad metrics")):
+            self.assertEqual(analyzer.analyze(gradient), {"status": "error", "reason": "bad metrics"})
+        with patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                          analyzer=analyzer)
+        with open(report_path, encoding="utf-8") as f:
+            self.assertIn("no distinct content region", f.read())
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_heuristic_findings(self):
+        from PIL import Image, ImageDraw
+        blank = os.path.join(self.screenshot_dir, "blank.png")
+        Image.new("RGB", (200, 400), (250, 250, 250)).save(blank)
+        low = os.path.join(self.screenshot_dir, "low.png")
+        high = os.path.join(self.screenshot_dir, "high.png")
+        for path, ink in ((low, (190, 190, 190)), (high, (20, 20, 20))):
+            img = Image.new("RGB", (200, 400), (250, 250, 250))
+            draw = ImageDraw.Draw(img)
+            for top in (40, 200):
+                draw.rectangle((20, top, 180, top + 60), fill=ink)
+            img.save(path)
+
+        analyzer = HeuristicAnalyzer()
+        self.assertIn("blank", analyzer.analyze(blank)["analysis"])
+        result = analyzer.analyze(low)
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["metrics"]["content_bands"], 2)
+        self.assertIn("Low foreground/background contrast", result["analysis"])
+        self.assertGreater(analyzer.analyze(high)["metrics"]["contrast_ratio"], 15)
+        self.assertEqual(analyzer.analyze(os.path.join(self.test_dir, "missing.png"))["status"], "error")
+
+    @unittest.skipUnless(generate_ai_report.HAS_PIL, "Pillow not installed")
+    def test_heuristic_report_needs_no_network_or_key(self):
+        self.make_screenshots(2)
+        with patch.dict(os.environ, {}, clear=True), \
+                patch("generate_ai_report.analyze_screenshot_with_ai", side_effect=AssertionError), \
+                patch("builtins.print"):
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                          analyzer=HeuristicAnalyzer(), batch_size=2)
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertEqual(html.count("(success)"), 2)
+
+    @unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+    def test_bundled_stub_server_is_deterministic(self):
+        paths = self.make_screenshots(3)
+        shutil.copy(paths[0], os.path.join(self.screenshot_dir, "copy.png"))
+        paths.append(os.path.join(self.screenshot_dir, "copy.png"))
+        with patch.dict(os.environ, {}, clear=True), patch("builtins.print"), StubModelServer() as server:
+            analyzer = RemoteAnalyzer(server.url, api_key="stub")
+            single = analyze_screenshots(paths, self.test_dir, analyzer=analyzer)
+            batched = analyze_screenshots(paths, self.test_dir, analyzer=analyzer, batch_size=4)
+
+        self.assertEqual(server.requests, 5)
+        analyses = [r["ai_analysis"]["analysis"] for r in single]
+        self.assertEqual(analyses, [r["ai_analysis"]["analysis"] for r in batched])
+        self.assertEqual(analyses[0], analyses[3])
+        self.assertEqual(len(set(analyses)), 3)
+
+    @unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+    def test_stub_analyses_are_not_reused_by_remote_runs(self):
+        self.make_screenshots(2)
+        manifest_path = os.path.join(self.output_dir, generate_ai_report.MANIFEST_FILENAME)
+        with StubModelServer() as server, patch("builtins.print"):
+            generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                            manifest_path=manifest_path, analyzer=StubAnalyzer(server.url, api_key="stub"))
+            with patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}):
+                generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                manifest_path=manifest_path, analyzer=RemoteAnalyzer(server.url))
+        self.assertEqual(server.requests, 4)
+        analyzer, _ = generate_ai_report.analyzer_from_config({"analyzer": "stub", "api_key": "stub"})
+        self.assertEqual(analyzer.name, "stub")
+
+    def test_remote_analyzer_availability(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsNotNone(RemoteAnalyzer().unavailable_reason())
+            if generate_ai_report.HAS_REQUESTS:
+                self.assertIsNone(RemoteAnalyzer(api_key="key").unavailable_reason())
+
+
+@unittest.skipUnless(generate_ai_report.HAS_PIL and generate_ai_report.HAS_REQUESTS,
+                     "Pillow and requests not installed")
+@unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+class TestTracing(ReportTestCase):
+    """Test cases for per-stage tracing and its exports."""
+
+    def test_spans_from_threads(self):
+        tracer = Tracer()
+
+        def work(index):
+            with tracer.span("encode", items=1) as span:
+                span.add(bytes=100)
+                span.add(bytes=index)
+
+        threads = [threading.Thread(target=work, args=(i,), name=f"worker-{i}") for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with tracer.span("html"):
+            pass
+
+        summary = {stage["stage"]: stage for stage in tracer.summary()}
+        self.assertEqual(summary["encode"]["count"], 3)
+        self.assertEqual(summary["encode"]["items"], 3)
+        self.assertEqual(summary["encode"]["bytes"], 303)
+        self.assertEqual(summary["html"]["bytes"], 0)
+
+        chrome = os.path.join(self.test_dir, "trace.json")
+        tracer.write_chrome_trace(chrome)
+        with open(chrome) as f:
+            events = json.load(f)["traceEvents"]
+        names = {event["args"]["name"] for event in events if event["ph"] == "M"}
+        self.assertEqual(names, {"worker-0", "worker-1", "worker-2", threading.current_thread().name})
+        spans = [event for event in events if event["ph"] == "X"]
+        self.assertEqual(len(spans), 4)
+        self.assertTrue(all(event["dur"] >= 0 and event["ts"] >= 0 for event in spans))
+
+    def test_tracing_off_is_a_no_op(self):
+        self.assertIsNone(generate_ai_report._active_tracer)
+        with generate_ai_report.trace("encode") as span:
+            span.add(bytes=1)
+        tracer = Tracer()
+        with tracing(tracer):
+            with generate_ai_report.trace("encode") as span:
+                span.add(bytes=1)
+        self.assertIsNone(generate_ai_report._active_tracer)
+        self.assertEqual(len(tracer.spans), 1)
+
+    def test_report_run_is_traced(self):
+        self.make_screenshots(3)
+        tracer = Tracer()
+        with StubModelServer() as server, \
+                patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), \
+                patch("builtins.print"), tracing(tracer):
+            report_path = generate_report(self.results_file, self.output_dir, max_workers=2,
+                                          api_url=server.url, screenshot_source="walk",
+                                          embed_trace=True)
+
+        stages = {stage["stage"]: stage for stage in tracer.summary()}
+        for name in ("parse_results", "find_screenshots", "metadata", "encode", "api_call",
+                     "analysis", "html"):
+            self.assertIn(name, stages)
+        self.assertEqual(stages["api_call"]["count"], 3)
+        self.assertEqual(stages["encode"]["bytes"], sum(
+            os.path.getsize(path) for path in find_screenshots(self.results_file)))
+
+        jsonl = os.path.join(self.test_dir, "trace.jsonl")
+        tracer.write_jsonl(jsonl)
+        with open(jsonl) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), len(tracer.spans))
+        self.assertEqual(records, sorted(records, key=lambda record: record["start_us"]))
+        with open(report_path, encoding="utf-8") as f:
+            html = f.read()
+        self.assertIn("<h2>Timing</h2>", html)
+        self.assertIn("<td>api_call</td><td>3</td>", html)
+
+
+class RecordingAnalyzer:
+    """Analysis backend that records its calls, fails on request and can be interrupted."""
+
+    name = "recording"
+
+    def __init__(self, interrupt_at=None, failing=()):
+        self.calls = []
+        self.interrupt_at = interrupt_at
+        self.failing = set(failing)
+
+    def unavailable_reason(self):
+        return None
+
+    def analyze(self, screenshot_path):
+        self.calls.append(os.path.basename(screenshot_path))
+        if len(self.calls) == self.interrupt_at:
+            raise KeyboardInterrupt
+        if os.path.basename(screenshot_path) in self.failing:
+            return {"status": "error", "reason": "API error: 500"}
+        return {"status": "success", "analysis": "Looks fine"}
+
+
+class TestJobQueue(ReportTestCase):
+    """Test cases for resumable job mode (--queue)."""
+
+    def setUp(self):
+        super().setUp()
+        self.queue_path = os.path.join(self.test_dir, "job.sqlite")
+
+    def run_job(self, analyzer, **kwargs):
+        queue = JobQueue(self.queue_path)
+        try:
+            with patch("builtins.print"):
+                return generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                       analyzer=analyzer, job_queue=queue, **kwargs)
+        finally:
+            queue.close()
+
+    def test_claims_are_exclusive(self):
+        paths = self.make_screenshots(5)
+        first, second = JobQueue(self.queue_path), JobQueue(self.queue_path)
+        first.enqueue(paths, "settings", self.test_dir)
+        claimed = first.claim(3) + second.claim(3)
+        self.assertEqual(sorted(claimed), paths)
+        self.assertEqual(second.claim(1), [])
+
+        first.finish([(paths[0], {"ai_analysis": {"status": "success"}}),
+                      (paths[1], {"ai_analysis": {"status": "error", "reason": "timeout"}})])
+        second.release(paths[2:])
+        self.assertEqual(second.counts(), {"done": 1, "failed": 1, "pending": 3})
+        self.assertEqual(second.failures(), [(paths[1], 1, "timeout")])
+        self.assertEqual(set(second.results()), {paths[0], paths[1]})
+        first.close()
+        second.close()
+
+    def test_unavailable_analysis_is_not_finished(self):
+        """Screenshots are left pending while analysis is unavailable, and analysed once it is."""
+        paths = self.make_screenshots(2)
+        queue = JobQueue(self.queue_path)
+        queue.enqueue(paths, "settings", self.test_dir)
+        queue.finish([(paths[0], {"ai_analysis": {"status": "skipped", "reason": "no key"}})])
+        self.assertEqual(queue.counts(), {"pending": 2})
+        queue.close()
+
+        with patch.dict(os.environ, {}, clear=True):
+            self.run_job(RemoteAnalyzer("http://127.0.0.1:9/unused"))
+        with JobQueue(self.queue_path) as queue:
+            self.assertEqual(queue.counts(), {"pending": 2})
+
+        analyzer = RecordingAnalyzer()
+        self.run_job(analyzer)
+        self.assertEqual(analyzer.calls, ["screen_000.png", "screen_001.png"])
+        with JobQueue(self.queue_path) as queue:
+            self.assertEqual(queue.counts(), {"done": 2})
+
+    def test_changed_settings_discard_results(self):
+        paths = self.make_screenshots(2)
+        queue = JobQueue(self.queue_path)
+        queue.enqueue(paths, "settings", self.test_dir)
+        queue.finish([(path, {"ai_analysis": {"status": "success"}}) for path in queue.claim(2)])
+        queue.enqueue(paths[:1], "settings", self.test_dir)
+        self.assertEqual(queue.counts(), {"done": 1})
+        queue.enqueue(paths[:1], "other settings", self.test_dir)
+        self.assertEqual(queue.counts(), {"pending": 1})
+        queue.close()
+
+    def test_interrupted_job_resumes(self):
+        self.make_screenshots(5)
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_job(RecordingAnalyzer(interrupt_at=3))
+        with JobQueue(self.queue_path) as queue:
+            self.assertEqual(queue.counts(), {"done": 2, "pending": 3})
+
+        analyzer = RecordingAnalyzer()
+        report_path = self.run_job(analyzer)
+        self.assertEqual(analyzer.calls, ["screen_002.png", "screen_003.png", "screen_004.png"])
+        with open(report_path, encoding="utf-8") as f:
+            self.assertEqual(f.read().count("(success)"), 5)
+
+    def test_failures_are_retried_selectively(self):
+        self.make_screenshots(4)
+        self.run_job(RecordingAnalyzer(failing={"screen_001.png", "screen_002.png"}))
+        analyzer = RecordingAnalyzer()
+        self.run_job(analyzer)
+        self.assertEqual(analyzer.calls, [])
+
+        with patch("builtins.print"):
+            self.assertEqual(generate_ai_report.main(["job", "retry", self.queue_path, "screen_002.png"]), 0)
+        self.run_job(analyzer)
+        self.assertEqual(analyzer.calls, ["screen_002.png"])
+        with JobQueue(self.queue_path) as queue:
+            self.assertEqual(queue.counts(), {"done": 3, "failed": 1})
+
+    @unittest.skipUnless(generate_ai_report.HAS_REQUESTS, "requests not installed")
+    def test_worker_processes_share_the_queue(self):
+        self.make_screenshots(6)
+        with StubModelServer() as server, patch("builtins.print"):
+            queue = JobQueue(self.queue_path, config={"api_url": server.url, "api_key": "test-key"})
+            report_path = generate_report(self.results_file, self.output_dir, screenshot_source="walk",
+                                          api_url=server.url, job_queue=queue, job_workers=2)
+            self.assertEqual(queue.counts(), {"done": 6})
+            queue.close()
+        self.assertEqual(server.requests, 6)
+        with open(report_path, encoding="utf-8") as f:
+            self.assertEqual(f.read().count("(success)"), 6)
+
+
+class TestStartup(ReportTestCase):
+    """Test cases for import-time cost and side effects."""
+
+    def test_import_is_quiet_and_defers_heavy_modules(self):
+        result = measure_import_time(runs=1)
+        self.assertEqual(result["deferred_loaded"], [])
+        self.assertEqual(result["stdout"], "")
+        self.assertGreater(result["import_ms"], 0)
+
+    def test_run_without_screenshots_does_not_import_requests(self):
+        script_dir = os.path.dirname(os.path.abspath(generate_ai_report.__file__))
+        code = (f"import sys; sys.path.insert(0, {script_dir!r}); import generate_ai_report; "
+                f"generate_ai_report.main([{self.results_file!r}, '-o', {self.output_dir!r}, '--walk-screenshots']); "
+                f"print('requests' in sys.modules)")
+        process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(process.stdout.splitlines()[-1], "False")
+
+    def test_bench_imports_command(self):
+        with patch("builtins.print") as mock_print:
+            self.assertEqual(generate_ai_report.main(["bench", "--imports", "--import-budget", "100000"]), 0)
+        self.assertIn("import time", mock_print.call_args_list[0][0][0])
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test cases for the bench subcommand."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_synthesized_run_is_a_valid_results_file(self):
+        results_file = synthesize_run(self.test_dir, 3, size=(60, 120), image_format="JPEG")
+        results = parse_maestro_results(results_file)
+        self.assertEqual(len(results["screenshot_paths"]), 3)
+        self.assertEqual(len(results["steps"]), 7)
+        self.assertEqual(read_image_header(results["screenshot_paths"][0])["format"], "JPEG")
+
+    def test_run_benchmark_times_every_stage(self):
+        with patch("builtins.print"):
+            result = run_benchmark(4, size=(60, 120), max_workers=2, batch_size=2)
+        self.assertEqual(result["count"], 4)
+        self.assertEqual(set(result["stages"]), set(generate_ai_report.BENCH_STAGES))
+        self.assertGreater(result["bytes"], 0)
+
+    def test_compare_benchmarks(self):
+        baseline = [{"count": 10, "stages": {"encode": 1.0, "html": 0.01}}]
+        current = [{"count": 10, "stages": {"encode": 1.5, "html": 0.03}},
+                   {"count": 50, "stages": {"encode": 9.0}}]
+        regressions = compare_benchmarks(current, baseline, tolerance=0.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("N=10 encode", regressions[0])
+        self.assertEqual(compare_benchmarks(current, baseline, tolerance=0.6), [])
+
+    def test_compare_benchmarks_uses_fastest_run_and_spread(self):
+        """Slow outliers and noisy stages do not fail the gate; a consistent slowdown does."""
+        baseline = [summarize_benchmark_runs([
+            {"count": 10, "bytes": 1, "peak_rss_kb": 100, "stages": {"encode": 1.0, "html": 0.5}},
+            {"count": 10, "bytes": 1, "peak_rss_kb": 120, "stages": {"encode": 1.0, "html": 1.0}},
+            {"count": 10, "bytes": 1, "peak_rss_kb": 110, "stages": {"encode": 1.0, "html": 1.5}},
+        ])]
+        self.assertEqual(baseline[0]["stages"], {"encode": 1.0, "html": 1.0})
+        self.assertEqual(baseline[0]["peak_rss_kb"], 120)
+
+        outlier = [{"count": 10, "stages": {"encode": 1.6, "html": 1.3},
+                    "runs": {"encode": [1.2, 1.6, 1.7], "html": [1.3, 1.3, 1.3]}}]
+        self.assertEqual(compare_benchmarks(outlier, baseline), [])
+
+        slower = [{"count": 10, "stages": {"encode": 2.05, "html": 1.0},
+                   "runs": {"encode": [2.0, 2.1, 2.05], "html": [1.0, 1.0, 1.0]}}]
+        regressions = compare_benchmarks(slower, baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("N=10 encode", regressions[0])
+        self.assertEqual(compare_benchmarks(slower, baseline, noise=2.0), [])
+
+    def test_identical_runs_never_trip_the_gate(self):
+        """Benchmarking the same code twice passes --baseline against itself."""
+        first = os.path.join(self.test_dir, "first.json")
+        args = ["bench", "--counts", "2", "8", "--size", "40x80", "--repeat", "2"]
+        with patch("builtins.print"):
+            self.assertEqual(generate_ai_report.main(args + ["--json", first]), 0)
+            self.assertEqual(generate_ai_report.main(args + ["--baseline", first]), 0)
+        with open(first) as f:
+            results = json.load(f)
+        self.assertEqual([len(result["runs"]["report"]) for result in results], [2, 2])
+
+    def test_bench_command(self):
+        output = os.path.join(self.test_dir, "bench.json")
+        with patch("builtins.print"):
+            self.assertEqual(generate_ai_report.main(["bench", "--counts", "2", "--size", "40x80",
+                                                      "--json", output]), 0)
+        with open(output) as f:
+            results = json.load(f)
+        self.assertEqual([result["count"] for result in results], [2])
+        self.assertIsInstance(results[0]["peak_rss_kb"], int)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -6,31 +6,568 @@ This script helps create and maintain AI interaction logs for development sessio
 It provides templates and utilities for tracking AI-assisted development work.
 """
 
+import contextlib
+import json
 import os
+import re
+import string
 import sys
+import threading
+import time
+import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# "## Session 12: Title" headings; the template's "## Session Template ..." has no number
+SESSION_HEADING = re.compile(r"^## Session (\d+):\s*(.*?)\s*$")
+# Session sections kept by parse_sessions, by heading in the session and the log templates;
+# sections sharing a field are joined
+SECTION_HEADINGS = {
+    "### Prompts": "prompts",
+    "### Initial Prompt": "prompts",
+    "### Follow-up Prompts": "prompts",
+    "### Actions Taken": "actions",
+    "### Commands": "commands",
+    "### Build Commands Executed": "commands",
+    "### Status": "status",
+    "### Current Status": "status",
+}
+# "**Date**: ..." lines above a session's first section
+HEADER_FIELDS = {
+    "**Date**:": "date",
+    "**Time**:": "time",
+    "**AI Assistant**:": "assistant",
+    "**Duration**:": "duration",
+}
+INDEX_SUFFIX = ".index.jsonl"
+# Fixed-width first line of the index: the log size and mtime it covers, rewritten in place
+INDEX_HEADER_SIZE = 96
+# Sidecar files guarding concurrent writers: the log's lock, and the group-commit journal and its lock
+LOCK_SUFFIX = ".lock"
+JOURNAL_SUFFIX = ".journal.jsonl"
+JOURNAL_LOCK_SUFFIX = ".journal.lock"
+# Fields a session record may set (see AIInteractionsLogger.add_session)
+SESSION_FIELDS = (
+    'session_number', 'title', 'date', 'time', 'assistant', 'duration', 'prompts',
+    'actions', 'challenges', 'status', 'next_steps', 'code_changes', 'commands',
+)
+# Placeholders the log template (ai_interactions_template.md) may use
+LOG_TEMPLATE_FIELDS = ('branch_name', 'branch_prefix', 'session_title', 'date', 'time', 'duration')
+# Write buffer for bulk imports
+IMPORT_BUFFER_SIZE = 1024 * 1024
+
+
+class TemplateError(ValueError):
+    """A template with malformed braces or placeholders its caller does not provide."""
+
+
+class CompiledTemplate:
+    """
+    A str.format-style template parsed once into literal chunks and field slots.
+    
+    Placeholders are checked when compiling: only plain {name} slots are
+    accepted and, given allowed, only names in it, so a bad template fails
+    before anything is written instead of on every render.
+    """
+    
+    __slots__ = ("text", "chunks", "fields")
+    
+    def __init__(self, text: str, allowed: Optional[Iterable[str]] = None, name: str = "template"):
+        try:
+            parsed = list(string.Formatter().parse(text))
+        except ValueError as e:
+            raise TemplateError(f"{name}: {e}") from None
+        allowed = None if allowed is None else set(allowed)
+        for _, field, spec, conversion in parsed:
+            if field is None:
+                continue
+            if not field.isidentifier():
+                raise TemplateError(f"{name}: placeholder {{{field}}} is not a plain field name")
+            if spec or conversion:
+                raise TemplateError(f"{name}: placeholder {{{field}}} may not use a conversion or format spec")
+            if allowed is not None and field not in allowed:
+                raise TemplateError(f"{name}: unknown placeholder {{{field}}} "
+                                    f"(expected one of: {', '.join(sorted(allowed))})")
+        self.text = text
+        self.chunks = [(literal, field) for literal, field, _, _ in parsed]
+        self.fields = frozenset(field for _, field in self.chunks if field is not None)
+    
+    def render(self, values: Dict) -> str:
+        """Fill the slots from values; same result as text.format(**values) for plain {field}s."""
+        parts = []
+        for literal, field in self.chunks:
+            parts.append(literal)
+            if field is not None:
+                parts.append(str(values[field]))
+        return "".join(parts)
+
+
+# Lock files held by the current thread, so nested file_lock() calls don't deadlock
+_held_locks = threading.local()
+
+
+def _lock(f) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    # msvcrt.locking gives up after ten seconds when blocking, so poll instead
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(0.01)
+
+
+def _unlock(f) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """
+    Hold an exclusive advisory lock on path (created if missing) for the block.
+    
+    Waits while another process holds it. Re-entering a lock this thread
+    already holds is a no-op.
+    """
+    held = _held_locks.__dict__.setdefault("paths", set())
+    # A forked child inherits the set but not the locks
+    key = (os.getpid(), os.path.abspath(path))
+    if key in held:
+        yield
+        return
+    with open(path, 'a+b') as f:
+        _lock(f)
+        held.add(key)
+        try:
+            yield
+        finally:
+            held.discard(key)
+            _unlock(f)
+
+
+def _sidecar(log_file, suffix: str) -> Path:
+    log_file = Path(log_file)
+    return log_file.with_name(log_file.stem + suffix)
+
+
+# Compiled templates shared by every logger in the process:
+# {(path or default text, allowed fields): (file mtime and size, CompiledTemplate)}
+_template_cache: Dict = {}
+_template_cache_lock = threading.Lock()
+
+
+def load_template(path: Optional[Path], default: str, allowed: Iterable[str]) -> CompiledTemplate:
+    """
+    Return the compiled template at path, or the compiled default if there is no such file.
+    
+    A file is read and compiled again only when its mtime or size changed, so
+    creating many logs re-parses nothing.
+    
+    Raises:
+        TemplateError: If the template's placeholders are invalid
+    """
+    allowed = tuple(allowed)
+    try:
+        stat = os.stat(path) if path is not None else None
+    except FileNotFoundError:
+        stat = None
+    if stat is None:
+        key, version = (default, allowed), None
+    else:
+        key, version = (os.path.abspath(path), allowed), (stat.st_mtime_ns, stat.st_size)
+    
+    with _template_cache_lock:
+        cached = _template_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    
+    if stat is None:
+        compiled = CompiledTemplate(default, allowed, name="default template")
+    else:
+        compiled = CompiledTemplate(Path(path).read_text(encoding='utf-8'), allowed, name=str(path))
+    with _template_cache_lock:
+        _template_cache[key] = (version, compiled)
+    return compiled
+
+
+class SessionRecord:
+    """One parsed session of an interactions log; section texts are stripped of surrounding blank lines."""
+    
+    __slots__ = ('number', 'title', 'date', 'time', 'assistant', 'duration',
+                 'prompts', 'actions', 'commands', 'status', 'offset', 'length')
+    
+    def __init__(self, number: int, title: str, offset: int):
+        self.number = number
+        self.title = title
+        self.date = self.time = self.assistant = self.duration = ""
+        self.prompts = self.actions = self.commands = self.status = ""
+        self.offset = offset
+        self.length = 0
+    
+    def to_dict(self) -> Dict:
+        """Return the record as a plain dict, e.g. for JSON export."""
+        return {name: getattr(self, name) for name in self.__slots__}
+    
+    def __repr__(self) -> str:
+        return f"SessionRecord(number={self.number!r}, title={self.title!r})"
+
+
+def parse_sessions(log_file: str, start: int = 0) -> Iterator[SessionRecord]:
+    """
+    Parse the "## Session N:" blocks of a log into SessionRecords, one at a time.
+    
+    The log is read line by line and only the current session's kept sections
+    are held in memory, so a log of any size parses in constant memory. Headings
+    inside ``` code blocks are treated as text.
+    
+    Args:
+        log_file: Path to the log
+        start: Byte offset to start at; must be the start of a line
+        
+    Yields:
+        A SessionRecord per session, in log order
+    """
+    current = None
+    field = None  # kept section being read, if any
+    lines: List[bytes] = []
+    in_header = False  # above the session's first section
+    in_code = False
+    offset = start
+    
+    def store_section():
+        text = b"".join(lines).decode('utf-8', 'replace')
+        text = (text.replace("\r\n", "\n") if "\r" in text else text).strip()
+        previous = getattr(current, field)
+        setattr(current, field, f"{previous}\n\n{text}" if previous and text else previous or text)
+    
+    # Lines are tested as bytes and only decoded when kept; most lines are neither
+    with open(log_file, 'rb') as log:
+        log.seek(start)
+        for raw in log:
+            if raw.startswith(b"```"):
+                in_code = not in_code
+            elif not in_code and (raw.startswith(b"## ") or (current is not None and raw.startswith(b"### "))):
+                line = raw.decode('utf-8', 'replace').rstrip()
+                if field is not None:
+                    store_section()
+                field, lines = None, []
+                if line.startswith("### "):
+                    # Sections other than the kept ones are skipped, not buffered
+                    field = SECTION_HEADINGS.get(line)
+                    in_header = False
+                else:
+                    if current is not None:
+                        current.length = offset - current.offset
+                        yield current
+                    match = SESSION_HEADING.match(line)
+                    current = SessionRecord(int(match.group(1)), match.group(2), offset) if match else None
+                    in_header = True
+                offset += len(raw)
+                continue
+            
+            if field is not None:
+                lines.append(raw)
+            elif in_header and current is not None and not in_code and raw.startswith(b"**"):
+                line = raw.decode('utf-8', 'replace')
+                for prefix, name in HEADER_FIELDS.items():
+                    if line.startswith(prefix) and not getattr(current, name):
+                        setattr(current, name, line[len(prefix):].strip())
+            offset += len(raw)
+    
+    if current is not None:
+        if field is not None:
+            store_section()
+        current.length = offset - current.offset
+        yield current
+
+
+class SessionIndex:
+    """
+    Sidecar index of the sessions in one interactions log.
+    
+    The index holds one JSON line per session (number, title, date, status and
+    the session's byte offset and length in the log), in log order, next to the
+    log as <log name>.index.jsonl. Reading its last line gives the next session
+    number and lookups bisect it, so neither depends on the size of the log.
+    Its first line records the log size and mtime it was written for, so an up
+    to date index is recognised from one stat, whatever follows the last session.
+    A missing index is rebuilt from the markdown; sessions appended to the log
+    by hand are picked up by rescanning only the tail after the last indexed one.
+    
+    Writers hold the log's lock (<log name>.lock) while appending to the log
+    and the index; readers only take it when the index has to be repaired, and
+    ignore a last index line that is still being written.
+    """
+    
+    def __init__(self, log_file: str):
+        self.log_file = Path(log_file)
+        self.path = _sidecar(log_file, INDEX_SUFFIX)
+        self.lock_path = _sidecar(log_file, LOCK_SUFFIX)
+    
+    def is_current(self) -> bool:
+        """Whether the index was written for the log as it is now."""
+        header = self._read_header()
+        return header is not None and self._covers(header)
+    
+    def refresh(self) -> None:
+        """Bring the index up to date with the log, scanning as little of it as possible."""
+        if self.is_current():
+            return
+        with file_lock(self.lock_path):
+            self._refresh_locked()
+    
+    def _refresh_locked(self) -> None:
+        if not self.log_file.exists():
+            if self.path.exists():
+                self.path.unlink()
+            return
+        header = self._read_header()
+        if header is None:
+            self.rebuild()
+            return
+        if self._covers(header):
+            return
+        last = self.last()
+        if last is not None and self.log_file.stat().st_size > last["offset"] and self._heading_at(last):
+            # The log grew (or its last session changed): rescan from the last session on
+            with open(self.path, 'r+b') as f:
+                f.truncate(self._last_line(f)[0])
+            self._scan(last["offset"], 'ab')
+        else:
+            self.rebuild()
+    
+    def rebuild(self) -> int:
+        """
+        Rebuild the index from the markdown log.
+        
+        Returns:
+            Number of sessions indexed
+        """
+        with file_lock(self.lock_path):
+            return self._scan(0, 'wb')
+    
+    def last(self) -> Optional[Dict]:
+        """Return the last indexed session, reading only the end of the index."""
+        if not self.path.exists():
+            return None
+        with open(self.path, 'rb') as f:
+            offset, line = self._last_line(f)
+        return json.loads(line) if line and offset >= INDEX_HEADER_SIZE else None
+    
+    def next_number(self) -> int:
+        """Return the number following the log's last session."""
+        self.refresh()
+        last = self.last()
+        return last["number"] + 1 if last else 1
+    
+    def find(self, number: int) -> Optional[Dict]:
+        """
+        Look up a session by number.
+        
+        Sessions are normally numbered in log order, so the index is bisected;
+        if that misses (numbers added out of order), it is scanned instead.
+        """
+        self.refresh()
+        if not self.path.exists():
+            return None
+        with open(self.path, 'rb') as f:
+            size = self._complete_size(f)
+            # Invariant: lines starting before lo hold smaller numbers, lines starting at or after hi do not
+            lo, hi = INDEX_HEADER_SIZE, size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                f.seek(mid)
+                if mid > lo:
+                    f.readline()
+                start = f.tell()
+                if start >= hi:
+                    hi = mid
+                    continue
+                record = json.loads(f.readline())
+                if record["number"] < number:
+                    lo = f.tell()
+                else:
+                    hi = start
+            f.seek(lo)
+            line = f.readline()
+            if line and json.loads(line)["number"] == number:
+                return json.loads(line)
+        return next((record for record in self if record["number"] == number), None)
+    
+    def read(self, number: int) -> Optional[str]:
+        """Return the markdown of one session, read straight from its offset in the log."""
+        record = self.find(number)
+        if record is None:
+            return None
+        with open(self.log_file, 'rb') as f:
+            f.seek(record["offset"])
+            return f.read(record["length"]).decode('utf-8').rstrip()
+    
+    def __iter__(self) -> Iterator[Dict]:
+        """Yield every indexed session, in log order."""
+        self.refresh()
+        if not self.path.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            f.readline()
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+    
+    def append(self, record: Dict) -> None:
+        """Record a session that was just appended to the log."""
+        self.extend([record])
+    
+    def extend(self, records: Iterable[Dict]) -> int:
+        """Record sessions appended to the log, consuming records as they are produced."""
+        count = 0
+        with open(self.path, 'r+b' if self.path.exists() else 'w+b', buffering=IMPORT_BUFFER_SIZE) as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                f.write(self._header_line(None))
+            for record in records:
+                f.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+                count += 1
+            self._write_header(f)
+        return count
+    
+    def _header_line(self, stat) -> bytes:
+        fields = {"log_size": stat.st_size, "log_mtime_ns": stat.st_mtime_ns} if stat else {"log_size": -1}
+        return json.dumps(fields).ljust(INDEX_HEADER_SIZE - 1).encode('ascii') + b"\n"
+    
+    def _write_header(self, f) -> None:
+        """Record in the index that it now covers the log as it is; callers hold the log's lock."""
+        f.flush()
+        f.seek(0)
+        f.write(self._header_line(self.log_file.stat()))
+    
+    def _read_header(self) -> Optional[Dict]:
+        try:
+            with open(self.path, 'rb') as f:
+                line = f.read(INDEX_HEADER_SIZE)
+        except FileNotFoundError:
+            return None
+        try:
+            header = json.loads(line) if len(line) == INDEX_HEADER_SIZE and line.endswith(b"\n") else None
+        except ValueError:
+            return None
+        return header if isinstance(header, dict) and "log_size" in header else None
+    
+    def _covers(self, header: Dict) -> bool:
+        try:
+            stat = self.log_file.stat()
+        except FileNotFoundError:
+            return False
+        return header["log_size"] == stat.st_size and header.get("log_mtime_ns") == stat.st_mtime_ns
+    
+    def _heading_at(self, record: Dict) -> bool:
+        with open(self.log_file, 'rb') as f:
+            f.seek(record["offset"])
+            match = SESSION_HEADING.match(f.readline().decode('utf-8', 'replace'))
+        return match is not None and int(match.group(1)) == record["number"]
+    
+    @staticmethod
+    def _complete_size(f) -> int:
+        """Size of a binary file up to its last newline, leaving out a line still being written."""
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            newline = f.read(step).rfind(b"\n")
+            if newline >= 0:
+                return position + newline + 1
+        return 0
+    
+    @classmethod
+    def _last_line(cls, f) -> tuple:
+        """Return (offset, bytes) of the last complete line of a binary file, reading backwards from its end."""
+        end = cls._complete_size(f)
+        if end == 0:
+            return 0, b""
+        tail = b""
+        position = end
+        while position > 0:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            newline = tail.rfind(b"\n", 0, len(tail) - 1)
+            if newline >= 0:
+                return position + newline + 1, tail[newline + 1:]
+        return 0, tail
+    
+    def _scan(self, start: int, mode: str) -> int:
+        """Index the sessions of the log from byte offset start on; mode 'wb' replaces the index."""
+        count = 0
+        target = self.path if mode == 'ab' else self.path.with_name(self.path.name + ".tmp")
+        # Appending rewrites the header too, which append mode cannot do
+        with open(target, 'r+b' if mode == 'ab' else 'w+b') as f:
+            if mode == 'ab':
+                f.seek(0, os.SEEK_END)
+            else:
+                f.write(self._header_line(None))
+            for session in parse_sessions(self.log_file, start):
+                record = {"number": session.number, "title": session.title, "date": session.date,
+                          "status": session.status.split("\n", 1)[0].strip(),
+                          "offset": session.offset, "length": session.length}
+                f.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+                count += 1
+            self._write_header(f)
+        if target != self.path:
+            os.replace(target, self.path)
+        return count
 
 
 class AIInteractionsLogger:
-    """Handles creation and management of AI interactions log files."""
+    """
+    Handles creation and management of AI interactions log files.
     
-    def __init__(self, project_root: str = "."):
+    Several processes may write to the same log: every append holds the log's
+    advisory lock. With group_commit, add_session queues sessions in a journal
+    next to the log before waiting for the lock, and whichever writer gets it
+    appends everything queued so far in one write.
+    """
+    
+    def __init__(self, project_root: str = ".", group_commit: bool = False):
         self.project_root = Path(project_root)
         self.template_file = self.project_root / "ai_interactions_template.md"
         self.example_file = self.project_root / "ai_interactions_example.md"
+        self.group_commit = group_commit
     
-    def create_log_file(self, branch_name: str, session_title: str = "New Session") -> str:
+    def create_log_file(self, branch_name: str, session_title: str = "New Session",
+                        overwrite: bool = False) -> str:
         """
         Create a new AI interactions log file for a branch.
         
+        The log is written to a temporary file and renamed into place, so other
+        processes never see a partial log.
+        
         Args:
             branch_name: Name of the branch (used as prefix)
             session_title: Title for the first session
+            overwrite: Replace an existing log instead of refusing
             
         Returns:
             Path to the created log file
+            
+        Raises:
+            FileExistsError: If the log exists and overwrite is not set
         """
         # Extract branch prefix (e.g., "5" from "5_feature_branch")
         branch_prefix = branch_name.split('_')[0] if '_' in branch_name else branch_name
@@ -38,64 +575,300 @@ class AIInteractionsLogger:
         log_path = self.project_root / log_filename
         
         # Load template
-        template_content = self._load_template()
+        template = self._log_template()
         
         # Replace placeholders
-        content = template_content.format(
-            branch_name=branch_name,
-            branch_prefix=branch_prefix,
-            session_title=session_title,
-            date=datetime.now().strftime("%d-%b-%Y"),
-            time=datetime.now().strftime("%I:%M %p"),
-            duration="[Ongoing]"
-        )
-        
-        # Write to file
-        with open(log_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        content = template.render({
+            'branch_name': branch_name,
+            'branch_prefix': branch_prefix,
+            'session_title': session_title,
+            'date': datetime.now().strftime("%d-%b-%Y"),
+            'time': datetime.now().strftime("%I:%M %p"),
+            'duration': "[Ongoing]",
+        })
+        
+        # Write to a temporary file, then move it into place
+        index = SessionIndex(log_path)
+        tmp_path = self.project_root / f".{log_filename}.{uuid.uuid4().hex}.tmp"
+        # Created like open() would, so the log gets the usual umask permissions
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            with file_lock(index.lock_path):
+                if overwrite:
+                    os.replace(tmp_path, log_path)
+                else:
+                    # Hard-linking fails if the log exists, unlike a rename
+                    os.link(tmp_path, log_path)
+                index.rebuild()
+        except FileExistsError:
+            raise FileExistsError(f"{log_path} already exists") from None
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
         
         print(f"Created AI interactions log: {log_filename}")
         return str(log_path)
     
-    def add_session(self, log_file: str, session_data: Dict) -> None:
+    def add_session(self, log_file: str, session_data: Dict) -> Optional[int]:
         """
         Add a new session to an existing log file.
         
         Args:
             log_file: Path to existing log file
-            session_data: Dictionary containing session information
+            session_data: Dictionary containing session information; without a
+                session_number the next free number is taken from the index
+            
+        Returns:
+            Number of the added session. With group_commit, None when another
+            writer committed it (numbers are assigned at commit).
         """
-        session_template = self._get_session_template()
-        
-        # Format session data
-        session_content = session_template.format(
-            session_number=session_data.get('session_number', 'N'),
-            title=session_data.get('title', 'Untitled Session'),
-            date=session_data.get('date', datetime.now().strftime("%d-%b-%Y")),
-            time=session_data.get('time', datetime.now().strftime("%I:%M %p")),
-            assistant=session_data.get('assistant', 'Claude 4 Sonnet'),
-            duration=session_data.get('duration', '[Duration]'),
-            prompts=session_data.get('prompts', '[Prompts]'),
-            actions=session_data.get('actions', '[Actions taken]'),
-            challenges=session_data.get('challenges', '[Challenges encountered]'),
-            status=session_data.get('status', '[Current status]'),
-            next_steps=session_data.get('next_steps', '[Next steps]'),
-            code_changes=session_data.get('code_changes', '[Code changes]'),
-            commands=session_data.get('commands', '[Commands executed]')
-        )
-        
-        # Append to file
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(f"\n\n{session_content}")
+        if self.group_commit:
+            return self._add_session_journaled(log_file, session_data)
+        
+        with file_lock(SessionIndex(log_file).lock_path):
+            _, number = self._append_sessions(log_file, [session_data])
         
         print(f"Added session to {log_file}")
+        return number
+    
+    def _add_session_journaled(self, log_file: str, session_data: Dict) -> Optional[int]:
+        """
+        Queue a session in the journal, then wait for the log's lock and commit the journal.
+        
+        Writers queueing while the lock is held are committed together by the
+        next one to get it; the others find their session already written.
+        Every writer waits for the lock, so no session stays queued behind a
+        lock holder that doesn't read the journal.
+        """
+        entry_id = uuid.uuid4().hex
+        line = json.dumps({"id": entry_id, "session": session_data}, ensure_ascii=False, default=str) + "\n"
+        with file_lock(_sidecar(log_file, JOURNAL_LOCK_SUFFIX)):
+            with open(_sidecar(log_file, JOURNAL_SUFFIX), 'a', encoding='utf-8') as f:
+                f.write(line)
+        
+        with file_lock(SessionIndex(log_file).lock_path):
+            number = self._commit_journal_locked(log_file).get(entry_id)
+        
+        if number is None:
+            print(f"Queued session for {log_file}; another writer committed it")
+        else:
+            print(f"Added session to {log_file}")
+        return number
+    
+    def commit_journal(self, log_file: str) -> int:
+        """
+        Append every session queued in the log's journal, waiting for the lock.
+        
+        Returns:
+            Number of sessions committed
+        """
+        with file_lock(SessionIndex(log_file).lock_path):
+            return len(self._commit_journal_locked(log_file))
+    
+    def _commit_journal_locked(self, log_file: str) -> Dict[str, int]:
+        """
+        Append the queued sessions and drop them from the journal; returns their numbers by entry id.
+        
+        Entries queued meanwhile stay in the journal. A crash between appending
+        and trimming the journal commits those sessions again on the next run,
+        so sessions can be duplicated but never lost.
+        """
+        journal = _sidecar(log_file, JOURNAL_SUFFIX)
+        journal_lock = _sidecar(log_file, JOURNAL_LOCK_SUFFIX)
+        with file_lock(journal_lock):
+            data = journal.read_bytes() if journal.exists() else b""
+        committed = data[:data.rfind(b"\n") + 1]
+        entries = [json.loads(line) for line in committed.splitlines() if line.strip()]
+        if not entries:
+            return {}
+        
+        _, assigned = self._append_sessions(log_file, (entry["session"] for entry in entries), all_numbers=True)
+        with file_lock(journal_lock):
+            with open(journal, 'r+b') as f:
+                rest = f.read()[len(committed):]
+                f.seek(0)
+                f.write(rest)
+                f.truncate()
+        return {entry["id"]: number for entry, number in zip(entries, assigned)}
+    
+    def _append_sessions(self, log_file: str, sessions: Iterable[Dict], all_numbers: bool = False) -> Tuple[int, object]:
+        """
+        Append sessions to a log in one buffered pass, with their index records.
+        
+        Callers hold the log's lock. Returns the number of sessions and the
+        last session's number (every number, with all_numbers).
+        """
+        index = SessionIndex(log_file)
+        index.refresh()
+        next_number = index.next_number()
+        template = self._session_template()
+        defaults = self._session_defaults(datetime.now())
+        numbers = []
+        
+        def write_sessions(log):
+            nonlocal next_number
+            offset = log.tell()
+            for session_data in sessions:
+                fields = self._session_fields(session_data, session_data.get('session_number') or next_number, defaults)
+                data = template.render(fields).encode('utf-8')
+                log.write(b"\n\n")
+                log.write(data)
+                yield self._index_record(fields, offset + 2, len(data))
+                offset += 2 + len(data)
+                next_number = fields['session_number'] + 1
+                if all_numbers or not numbers:
+                    numbers.append(next_number - 1)
+                else:
+                    numbers[0] = next_number - 1
+            # The log must hit the disk before the index that points into it
+            log.flush()
+        
+        with open(log_file, 'ab', buffering=IMPORT_BUFFER_SIZE) as log:
+            count = index.extend(write_sessions(log))
+        return count, numbers if all_numbers else (numbers[0] if numbers else None)
+    
+    def import_sessions(self, log_file: str, sessions_file: str) -> int:
+        """
+        Append every session of a JSONL file (one session dict per line) to a log.
+        
+        The file is streamed twice: first every record is validated, so a bad
+        record aborts the import before anything is written; then the sessions
+        are rendered with a compiled session template and written in a single
+        buffered append, with their index records. Records without a
+        session_number are numbered on from the log's last session.
+        
+        Args:
+            log_file: Path to existing log file
+            sessions_file: Path to the JSONL file of session dicts
+            
+        Returns:
+            Number of imported sessions
+            
+        Raises:
+            ValueError: If any record is invalid
+        """
+        errors = []
+        for line_number, session_data in self._read_sessions(sessions_file, errors):
+            error = self._validate_session(session_data)
+            if error:
+                errors.append(f"line {line_number}: {error}")
+        if errors:
+            raise ValueError(f"{len(errors)} invalid session records in {sessions_file}:\n" + "\n".join(errors[:20]))
+        
+        with file_lock(SessionIndex(log_file).lock_path):
+            count, _ = self._append_sessions(
+                log_file, (session_data for _, session_data in self._read_sessions(sessions_file))
+            )
+        
+        print(f"Imported {count} sessions into {log_file}")
+        return count
+    
+    @staticmethod
+    def _read_sessions(sessions_file: str, errors: Optional[List[str]] = None) -> Iterator:
+        """Yield (line number, parsed record) for each non-blank line; JSON errors go to errors."""
+        with open(sessions_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    if errors is None:
+                        raise
+                    errors.append(f"line {line_number}: invalid JSON ({e.msg})")
+    
+    @staticmethod
+    def _validate_session(session_data) -> Optional[str]:
+        """Return why a session record is invalid, or None."""
+        if not isinstance(session_data, dict):
+            return "not a JSON object"
+        unknown = sorted(set(session_data) - set(SESSION_FIELDS))
+        if unknown:
+            return f"unknown fields: {', '.join(unknown)}"
+        number = session_data.get('session_number')
+        if number is not None and (isinstance(number, bool) or not isinstance(number, int) or number < 1):
+            return f"session_number must be a positive integer, got {number!r}"
+        for key, value in session_data.items():
+            if not isinstance(value, (str, int, float)):
+                return f"{key} must be a string or number"
+        return None
+    
+    @staticmethod
+    def _session_defaults(now: datetime) -> Dict:
+        """Template values used for fields a session does not set."""
+        return {
+            'title': 'Untitled Session',
+            'date': now.strftime("%d-%b-%Y"),
+            'time': now.strftime("%I:%M %p"),
+            'assistant': 'Claude 4 Sonnet',
+            'duration': '[Duration]',
+            'prompts': '[Prompts]',
+            'actions': '[Actions taken]',
+            'challenges': '[Challenges encountered]',
+            'status': '[Current status]',
+            'next_steps': '[Next steps]',
+            'code_changes': '[Code changes]',
+            'commands': '[Commands executed]',
+        }
+    
+    def _session_fields(self, session_data: Dict, session_number: int, defaults: Optional[Dict] = None) -> Dict:
+        """Template values for a session: its own fields over the defaults."""
+        fields = dict(defaults or self._session_defaults(datetime.now()))
+        fields.update((key, session_data[key]) for key in SESSION_FIELDS if key in session_data)
+        fields['session_number'] = int(session_number)
+        return fields
+    
+    @staticmethod
+    def _index_record(fields: Dict, offset: int, length: int) -> Dict:
+        """Index entry for a session rendered from fields at offset in the log."""
+        status_lines = str(fields['status']).strip().splitlines()
+        return {
+            "number": fields['session_number'],
+            "title": fields['title'],
+            "date": fields['date'],
+            "status": status_lines[0].strip() if status_lines else "",
+            "offset": offset,
+            "length": length,
+        }
+    
+    def list_sessions(self, log_file: str) -> List[Dict]:
+        """
+        List the sessions of a log from its index.
+        
+        Args:
+            log_file: Path to existing log file
+            
+        Returns:
+            Index records (number, title, date, status, offset, length) in log order
+        """
+        return list(SessionIndex(log_file))
+    
+    def get_session(self, log_file: str, session_number: int) -> Optional[str]:
+        """
+        Return the markdown of one session without scanning the log.
+        
+        Args:
+            log_file: Path to existing log file
+            session_number: Number of the session to read
+            
+        Returns:
+            The session's markdown, or None if the log has no such session
+        """
+        return SessionIndex(log_file).read(session_number)
     
     def _load_template(self) -> str:
         """Load the template file content."""
-        if self.template_file.exists():
-            return self.template_file.read_text(encoding='utf-8')
-        else:
-            return self._get_default_template()
+        return self._log_template().text
+    
+    def _log_template(self) -> CompiledTemplate:
+        """The compiled log template: the template file if there is one, else the default."""
+        return load_template(self.template_file, self._get_default_template(), LOG_TEMPLATE_FIELDS)
+    
+    def _session_template(self) -> CompiledTemplate:
+        """The compiled template for individual sessions."""
+        return load_template(None, self._get_session_template(), SESSION_FIELDS)
     
     def _get_default_template(self) -> str:
         """Return default template if template file doesn't exist."""
@@ -298,7 +1071,13 @@ def main():
     if len(sys.argv) < 2:
         print("Usage: python make_ai_interactions_script.py <command> [args]")
         print("Commands:")
-        print("  create <branch_name> [session_title] - Create new log file")
+        print("  create <branch_name> [session_title] [--overwrite] - Create new log file")
+        print("  list <log_file> - List the sessions of a log")
+        print("  show <log_file> <session_number> - Print one session")
+        print("  reindex <log_file> - Rebuild a log's session index")
+        print("  export <log_file> - Print the parsed sessions of a log as JSON lines")
+        print("  import <log_file> <sessions.jsonl> - Append sessions from a JSONL file")
+        print("  commit <log_file> - Append sessions queued in the log's group-commit journal")
         print("  setup - Create template and example files")
         print("  help - Show this help message")
         return
@@ -307,15 +1086,54 @@ def main():
     logger = AIInteractionsLogger()
     
     if command == "create":
-        if len(sys.argv) < 3:
+        overwrite = "--overwrite" in sys.argv[2:]
+        args = [arg for arg in sys.argv[2:] if arg != "--overwrite"]
+        if not args:
             print("Error: branch_name is required")
             return
         
-        branch_name = sys.argv[2]
-        session_title = sys.argv[3] if len(sys.argv) > 3 else "Initial Session"
-        log_file = logger.create_log_file(branch_name, session_title)
+        branch_name = args[0]
+        session_title = args[1] if len(args) > 1 else "Initial Session"
+        try:
+            log_file = logger.create_log_file(branch_name, session_title, overwrite=overwrite)
+        except (TemplateError, FileExistsError) as e:
+            print(f"Error: {e}")
+            return
         print(f"Log file created: {log_file}")
         
+    elif command in ("list", "show", "reindex", "commit", "export"):
+        if len(sys.argv) < (4 if command == "show" else 3):
+            print(f"Error: {command} needs a log file" + (" and a session number" if command == "show" else ""))
+            return
+        
+        log_file = sys.argv[2]
+        if not os.path.exists(log_file):
+            print(f"Error: log file not found: {log_file}")
+            return
+        if command == "list":
+            for session in logger.list_sessions(log_file):
+                print(f"{session['number']:>4}  {session['date']:<12} {session['title']}  [{session['status']}]")
+        elif command == "show":
+            session = logger.get_session(log_file, int(sys.argv[3]))
+            print(session if session is not None else f"No session {sys.argv[3]} in {log_file}")
+        elif command == "export":
+            for session in parse_sessions(log_file):
+                print(json.dumps(session.to_dict(), ensure_ascii=False))
+        elif command == "commit":
+            print(f"Committed {logger.commit_journal(log_file)} queued sessions")
+        else:
+            print(f"Indexed {SessionIndex(log_file).rebuild()} sessions")
+        
+    elif command == "import":
+        if len(sys.argv) < 4:
+            print("Error: import needs a log file and a JSONL sessions file")
+            return
+        
+        try:
+            logger.import_sessions(sys.argv[2], sys.argv[3])
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+        
     elif command == "setup":
         logger.create_template_files()
         print("Template files created successfully")
@@ -323,7 +1141,13 @@ def main():
     elif command == "help":
         print(__doc__)
         print("\nCommands:")
-        print("  create <branch_name> [session_title] - Create new log file")
+        print("  create <branch_name> [session_title] [--overwrite] - Create new log file")
+        print("  list <log_file> - List the sessions of a log")
+        print("  show <log_file> <session_number> - Print one session")
+        print("  reindex <log_file> - Rebuild a log's session index")
+        print("  export <log_file> - Print the parsed sessions of a log as JSON lines")
+        print("  import <log_file> <sessions.jsonl> - Append sessions from a JSONL file")
+        print("  commit <log_file> - Append sessions queued in the log's group-commit journal")
         print("  setup - Create template and example files")
         print("  help - Show this help message")
         
@@ -3,15 +3,27 @@
 Unit tests for AI Interactions Log Generator Script
 """
 
+import json
+import multiprocessing
+import os
 import unittest
 import tempfile
 import shutil
+import time
 from pathlib import Path
 from datetime import datetime
 from unittest.mock import patch, MagicMock
 
 # Import the module we're testing
-from make_ai_interactions_script import AIInteractionsLogger
+import make_ai_interactions_script
+from make_ai_interactions_script import (
+    AIInteractionsLogger,
+    CompiledTemplate,
+    SessionIndex,
+    SessionRecord,
+    TemplateError,
+    parse_sessions,
+)
 
 
 class TestAIInteractionsLogger(unittest.TestCase):
@@ -192,6 +204,395 @@ class TestAIInteractionsLogger(unittest.TestCase):
             self.assertIn(placeholder, template)
 
 
+class TestSessionIndex(unittest.TestCase):
+    """Test cases for the sidecar session index."""
+    
+    def setUp(self):
+        """Set up a log with an initial session."""
+        self.test_dir = tempfile.mkdtemp()
+        self.logger = AIInteractionsLogger(self.test_dir)
+        with patch('builtins.print'):
+            self.log_path = self.logger.create_log_file("7_index_branch", "First Session")
+        self.index = SessionIndex(self.log_path)
+    
+    def tearDown(self):
+        """Clean up after tests."""
+        shutil.rmtree(self.test_dir)
+    
+    def add(self, **session_data):
+        with patch('builtins.print'):
+            return self.logger.add_session(self.log_path, session_data)
+    
+    def test_next_number_allocated_from_index(self):
+        """Sessions without a number get the next one."""
+        self.assertEqual(self.index.path, Path(self.test_dir) / "7_ai_interactions_log.index.jsonl")
+        self.assertEqual(self.add(title="Second"), 2)
+        self.assertEqual(self.add(title="Third", status="✅ Done\n⏳ Tests"), 3)
+        self.assertEqual(self.add(session_number=10, title="Tenth"), 10)
+        self.assertEqual(self.index.next_number(), 11)
+        
+        sessions = self.logger.list_sessions(self.log_path)
+        self.assertEqual([s['number'] for s in sessions], [1, 2, 3, 10])
+        self.assertEqual(sessions[0]['title'], "First Session")
+        self.assertEqual(sessions[2]['status'], "✅ Done")
+    
+    def test_get_session_reads_only_that_session(self):
+        """Lookups return exactly one session's markdown."""
+        for number in range(2, 40):
+            self.add(title=f"Session title {number}", prompts=f"prompt {number}")
+        session = self.logger.get_session(self.log_path, 37)
+        self.assertTrue(session.startswith("## Session 37: Session title 37"))
+        self.assertIn("prompt 37", session)
+        self.assertNotIn("prompt 38", session)
+        self.assertIsNone(self.logger.get_session(self.log_path, 99))
+    
+    def test_rebuild_matches_incremental_index(self):
+        """An index rebuilt from the markdown agrees with the one kept on append."""
+        self.add(title="Second", date="24-May-2025", status="⏳ In Progress")
+        self.add(title="Third", date="25-May-2025", status="✅ Complete")
+        kept = self.logger.list_sessions(self.log_path)
+        
+        self.index.path.unlink()
+        rebuilt = self.logger.list_sessions(self.log_path)
+        fields = ('number', 'title', 'date', 'status', 'offset')
+        self.assertEqual([[r[k] for k in fields] for r in rebuilt], [[r[k] for k in fields] for r in kept])
+        self.assertEqual(rebuilt[1]['date'], "24-May-2025")
+    
+    def test_hand_edited_log_is_picked_up(self):
+        """Sessions appended to the log directly, including fenced headings, are indexed correctly."""
+        self.add(title="Second")
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write("\n\n## Session 3: Written by hand\n**Date**: 26-May-2025\n\n"
+                    "```\n## Session 9: inside a code block\n```\n")
+        self.assertEqual(self.index.next_number(), 4)
+        self.assertEqual(self.index.find(3)['title'], "Written by hand")
+        self.assertIsNone(self.index.find(9))
+    
+    def test_trailing_text_does_not_rewrite_index(self):
+        """Reading a log whose last session is followed by other text leaves the index alone."""
+        self.index.path.unlink()
+        self.assertEqual(self.index.next_number(), 2)
+        last = self.index.last()
+        self.assertLess(last['offset'] + last['length'], os.path.getsize(self.log_path))
+        before = self.index.path.stat().st_mtime_ns, self.index.path.read_bytes()
+        
+        with patch.object(SessionIndex, '_scan', side_effect=AssertionError("index rewritten")), \
+             patch('make_ai_interactions_script.file_lock', side_effect=AssertionError("lock taken")):
+            self.assertTrue(self.index.is_current())
+            self.assertEqual(self.index.find(1)['title'], "First Session")
+            self.assertEqual(len(self.logger.list_sessions(self.log_path)), 1)
+        self.assertEqual((self.index.path.stat().st_mtime_ns, self.index.path.read_bytes()), before)
+    
+    def test_old_index_without_header_is_rebuilt(self):
+        """An index written before it recorded the log it covers is rebuilt on first use."""
+        self.add(title="Second")
+        records = self.index.path.read_text(encoding='utf-8').splitlines(keepends=True)[1:]
+        self.index.path.write_text("".join(records), encoding='utf-8')
+        self.assertFalse(self.index.is_current())
+        self.assertEqual(self.index.find(2)['title'], "Second")
+        self.assertTrue(self.index.is_current())
+    
+    def test_out_of_order_numbers_are_found(self):
+        """Lookups still work when sessions were not numbered in log order."""
+        self.add(session_number=5, title="Five")
+        self.add(session_number=3, title="Three")
+        self.assertEqual(self.index.find(3)['title'], "Three")
+        self.assertEqual(self.index.find(5)['title'], "Five")
+
+
+class TestBulkImport(unittest.TestCase):
+    """Test cases for importing sessions from JSONL."""
+    
+    def setUp(self):
+        """Set up a log and a sessions file path."""
+        self.test_dir = tempfile.mkdtemp()
+        self.logger = AIInteractionsLogger(self.test_dir)
+        with patch('builtins.print'):
+            self.log_path = self.logger.create_log_file("8_bulk", "Start")
+        self.sessions_file = Path(self.test_dir) / "sessions.jsonl"
+    
+    def tearDown(self):
+        """Clean up after tests."""
+        shutil.rmtree(self.test_dir)
+    
+    def write_sessions(self, records):
+        with open(self.sessions_file, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write((record if isinstance(record, str) else json.dumps(record)) + "\n")
+    
+    def test_import_matches_add_session(self):
+        """Imported sessions render exactly like add_session and are indexed."""
+        records = [{'title': f'Imported {i}', 'date': '01-Jun-2025', 'time': '10:00 AM',
+                    'prompts': f'prompt {i}', 'status': '✅ Done'} for i in range(500)]
+        records[3]['session_number'] = 40
+        self.write_sessions(records[:2] + [""] + records[2:])
+        
+        with patch('builtins.print'):
+            self.assertEqual(self.logger.import_sessions(self.log_path, str(self.sessions_file)), 500)
+        index = SessionIndex(self.log_path)
+        self.assertEqual(index.next_number(), 537)
+        self.assertEqual(index.find(40)['title'], 'Imported 3')
+        self.assertEqual(index.find(41)['title'], 'Imported 4')
+        
+        other_dir = tempfile.mkdtemp()
+        try:
+            other = AIInteractionsLogger(other_dir)
+            with patch('builtins.print'):
+                other_log = other.create_log_file("8_bulk", "Start")
+                other.add_session(other_log, dict(records[0], session_number=2))
+            self.assertEqual(index.read(2), SessionIndex(other_log).read(2))
+        finally:
+            shutil.rmtree(other_dir)
+        
+        index.path.unlink()
+        self.assertEqual(len(self.logger.list_sessions(self.log_path)), 501)
+    
+    def test_invalid_records_abort_before_writing(self):
+        """One bad record fails the whole import and leaves the log untouched."""
+        before = Path(self.log_path).read_bytes()
+        self.write_sessions([{'title': 'Fine'}, '{"title": ', {'title': 'x', 'mood': 'good'},
+                             {'session_number': 0}, ['not', 'a', 'dict'], {'prompts': ['a', 'b']}])
+        
+        with self.assertRaises(ValueError) as raised:
+            self.logger.import_sessions(self.log_path, str(self.sessions_file))
+        message = str(raised.exception)
+        self.assertIn("5 invalid session records", message)
+        for expected in ("line 2: invalid JSON", "line 3: unknown fields: mood",
+                         "line 4: session_number", "line 5: not a JSON object", "line 6: prompts"):
+            self.assertIn(expected, message)
+        self.assertEqual(Path(self.log_path).read_bytes(), before)
+
+
+def append_sessions_worker(project_root, log_path, worker, count, group_commit):
+    """Append count sessions from a separate process."""
+    logger = AIInteractionsLogger(project_root, group_commit=group_commit)
+    with patch('builtins.print'):
+        for i in range(count):
+            logger.add_session(log_path, {'title': f'Worker {worker} session {i}',
+                                          'prompts': f'prompt {worker}/{i}\n' * 20})
+
+
+class TestConcurrentWrites(unittest.TestCase):
+    """Test cases for several processes writing to one log."""
+    
+    WORKERS = 8
+    SESSIONS = 25
+    
+    def setUp(self):
+        """Set up a log shared by the workers."""
+        self.test_dir = tempfile.mkdtemp()
+        self.logger = AIInteractionsLogger(self.test_dir)
+        with patch('builtins.print'):
+            self.log_path = self.logger.create_log_file("9_concurrent", "Start")
+    
+    def tearDown(self):
+        """Clean up after tests."""
+        shutil.rmtree(self.test_dir)
+    
+    def run_workers(self, group_commit):
+        processes = [
+            multiprocessing.Process(target=append_sessions_worker,
+                                    args=(self.test_dir, self.log_path, worker, self.SESSIONS, group_commit))
+            for worker in range(self.WORKERS)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+    
+    def assert_all_sessions_intact(self):
+        index = SessionIndex(self.log_path)
+        records = list(index)
+        self.assertEqual([r['number'] for r in records], list(range(1, self.WORKERS * self.SESSIONS + 2)))
+        titles = {r['title'] for r in records[1:]}
+        self.assertEqual(titles, {f'Worker {w} session {i}' for w in range(self.WORKERS) for i in range(self.SESSIONS)})
+        for record in records[1:]:
+            worker, i = record['title'].split()[1::2]
+            self.assertIn(f'prompt {worker}/{i}\n' * 20, index.read(record['number']))
+        
+        index.rebuild()
+        key = lambda r: (r['number'], r['title'], r['offset'])
+        self.assertEqual([key(r) for r in index], [key(r) for r in records])
+    
+    def test_parallel_appends(self):
+        """Appends from several processes get unique numbers and never interleave."""
+        self.run_workers(group_commit=False)
+        self.assert_all_sessions_intact()
+    
+    def test_parallel_group_commit(self):
+        """Journaled appends from several processes all land in the log and drain the journal."""
+        self.run_workers(group_commit=True)
+        with patch('builtins.print'):
+            self.logger.commit_journal(self.log_path)
+        self.assert_all_sessions_intact()
+        journal = Path(self.log_path).with_name("9_ai_interactions_log.journal.jsonl")
+        self.assertEqual(journal.read_text(), "")
+    
+    def test_group_commit_returns_number(self):
+        """A writer that commits its own journal entry gets the session number back."""
+        logger = AIInteractionsLogger(self.test_dir, group_commit=True)
+        with patch('builtins.print') as mock_print:
+            self.assertEqual(logger.add_session(self.log_path, {'title': 'Queued'}), 2)
+        mock_print.assert_called_once_with(f"Added session to {self.log_path}")
+    
+    def test_group_commit_waits_for_other_lock_holders(self):
+        """A session queued while a plain writer holds the lock is committed once it is released."""
+        journal = Path(self.log_path).with_name("9_ai_interactions_log.journal.jsonl")
+        with make_ai_interactions_script.file_lock(SessionIndex(self.log_path).lock_path):
+            writer = multiprocessing.Process(target=append_sessions_worker,
+                                             args=(self.test_dir, self.log_path, 0, 1, True))
+            writer.start()
+            deadline = time.monotonic() + 10
+            while not (journal.exists() and journal.stat().st_size) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(writer.is_alive())
+            with patch('builtins.print'):
+                self.logger.add_session(self.log_path, {'title': 'Plain'})
+        writer.join()
+        
+        self.assertEqual(writer.exitcode, 0)
+        self.assertEqual(journal.read_text(), "")
+        self.assertEqual([r['title'] for r in SessionIndex(self.log_path)],
+                         ['Start', 'Plain', 'Worker 0 session 0'])
+    
+    def test_create_does_not_overwrite(self):
+        """Creating an existing log fails unless overwrite is set, which replaces it whole."""
+        with patch('builtins.print'):
+            self.logger.add_session(self.log_path, {'title': 'Keep me'})
+        with self.assertRaises(FileExistsError):
+            self.logger.create_log_file("9_concurrent", "Again")
+        self.assertIn("Keep me", Path(self.log_path).read_text(encoding='utf-8'))
+        
+        self.logger.create_log_file("9_concurrent", "Again", overwrite=True)
+        content = Path(self.log_path).read_text(encoding='utf-8')
+        self.assertNotIn("Keep me", content)
+        self.assertIn("Again", content)
+        self.assertEqual(SessionIndex(self.log_path).next_number(), 2)
+        self.assertEqual([p.name for p in Path(self.test_dir).glob("*.tmp")], [])
+        plain = Path(self.test_dir) / "plain.txt"
+        plain.write_text("")
+        self.assertEqual(os.stat(self.log_path).st_mode & 0o777, plain.stat().st_mode & 0o777)
+
+
+class TestSessionParser(unittest.TestCase):
+    """Test cases for parsing logs back into session records."""
+    
+    def setUp(self):
+        """Set up a log with one session."""
+        self.test_dir = tempfile.mkdtemp()
+        self.logger = AIInteractionsLogger(self.test_dir)
+        with patch('builtins.print'):
+            self.log_path = self.logger.create_log_file("10_parse", "Start")
+    
+    def tearDown(self):
+        """Clean up after tests."""
+        shutil.rmtree(self.test_dir)
+    
+    def test_round_trips_added_sessions(self):
+        """Fields written by add_session come back from the parser."""
+        session = {'title': 'Parser', 'date': '01-Jun-2025', 'time': '09:30 AM', 'duration': '1 hour',
+                   'prompts': 'first prompt\n```\n## Session 99: not a heading\n### Commands\n```',
+                   'actions': '- parsed', 'commands': '```bash\npytest\n```', 'status': '✅ Done\n- more'}
+        with patch('builtins.print'):
+            self.logger.add_session(self.log_path, session)
+            self.logger.add_session(self.log_path, {'title': 'Next'})
+        
+        records = list(parse_sessions(self.log_path))
+        self.assertEqual([(r.number, r.title) for r in records], [(1, 'Start'), (2, 'Parser'), (3, 'Next')])
+        record = records[1]
+        self.assertIsInstance(record, SessionRecord)
+        for field in ('date', 'time', 'duration', 'prompts', 'actions', 'commands', 'status'):
+            self.assertEqual(getattr(record, field), session[field])
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(records[2].prompts, '[Prompts]')
+        
+        with open(self.log_path, 'rb') as f:
+            f.seek(record.offset)
+            self.assertTrue(f.read(record.length).startswith(b"## Session 2: Parser"))
+        self.assertEqual([r.to_dict() for r in parse_sessions(self.log_path, record.offset)],
+                         [r.to_dict() for r in records[1:]])
+    
+    def test_log_template_sections(self):
+        """Sections of the log template map onto the same fields, joined."""
+        example = Path(self.test_dir) / "example.md"
+        example.write_text(self.logger._get_example_content(), encoding='utf-8')
+        
+        record, = parse_sessions(str(example))
+        self.assertEqual(record.assistant, 'Claude 4 Sonnet')
+        self.assertTrue(record.prompts.startswith('```\nPlease help me'))
+        self.assertIn('"Can you create a Maestro test for this?"', record.prompts)
+        self.assertEqual(record.commands.splitlines()[1], 'flutter create -t module flutter_module')
+        self.assertEqual(record.status.splitlines()[0], '- ✅ Flutter module created')
+        self.assertNotIn('Could not find', record.commands)
+    
+    def test_parses_lazily(self):
+        """Records are yielded while the log is read, not after."""
+        with patch('builtins.print'):
+            for i in range(3):
+                self.logger.add_session(self.log_path, {'title': f'Lazy {i}'})
+        sessions = parse_sessions(self.log_path)
+        self.assertEqual(next(sessions).number, 1)
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write("\n\n## Session 5: Late\n")
+        self.assertEqual([r.number for r in sessions], [2, 3, 4, 5])
+
+
+class TestTemplates(unittest.TestCase):
+    """Test cases for compiled, cached templates."""
+    
+    def setUp(self):
+        """Set up a project directory."""
+        self.test_dir = tempfile.mkdtemp()
+        self.logger = AIInteractionsLogger(self.test_dir)
+    
+    def tearDown(self):
+        """Clean up after tests."""
+        shutil.rmtree(self.test_dir)
+    
+    def test_render_matches_format(self):
+        """Compiled templates render exactly like str.format."""
+        values = {'branch_name': '6_x', 'branch_prefix': '6', 'session_title': 'Set {up}',
+                  'date': '01-Jun-2025', 'time': '10:00 AM', 'duration': '5 min'}
+        default = self.logger._get_default_template()
+        self.assertEqual(CompiledTemplate(default).render(values), default.format(**values))
+        self.assertEqual(CompiledTemplate("{{literal}} {date}").render(values), "{literal} 01-Jun-2025")
+        self.assertEqual(self.logger._session_template().fields, set(make_ai_interactions_script.SESSION_FIELDS))
+    
+    def test_compiled_once_and_shared(self):
+        """Loggers share one compiled template until the file changes."""
+        self.logger.template_file.write_text("# Log {branch_prefix}\n", encoding='utf-8')
+        other = AIInteractionsLogger(self.test_dir)
+        first = self.logger._log_template()
+        with patch.object(Path, 'read_text', side_effect=AssertionError("template re-read")):
+            self.assertIs(other._log_template(), first)
+            with patch('builtins.print'):
+                for branch in ("1_a", "2_b", "3_c"):
+                    other.create_log_file(branch)
+        self.assertEqual((Path(self.test_dir) / "2_ai_interactions_log.md").read_text(encoding='utf-8'), "# Log 2\n")
+        
+        self.logger.template_file.write_text("# Changed log {branch_name}\n", encoding='utf-8')
+        stat = self.logger.template_file.stat()
+        os.utime(self.logger.template_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(other._load_template(), "# Changed log {branch_name}\n")
+    
+    def test_invalid_placeholders_rejected_up_front(self):
+        """Unknown, positional or formatted placeholders and stray braces fail before writing."""
+        for text, expected in (("# {branch}", "unknown placeholder {branch}"),
+                               ("# {0}", "not a plain field name"),
+                               ("# {date:%Y}", "format spec"),
+                               ("# {date!r}", "conversion"),
+                               ("# } oops", "Single '}'")):
+            with self.subTest(text=text):
+                self.logger.template_file.write_text(text, encoding='utf-8')
+                stat = self.logger.template_file.stat()
+                os.utime(self.logger.template_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+                with self.assertRaises(TemplateError) as raised:
+                    self.logger.create_log_file("4_bad")
+                self.assertIn(expected, str(raised.exception))
+                self.assertFalse((Path(self.test_dir) / "4_ai_interactions_log.md").exists())
+
+
 class TestMainFunction(unittest.TestCase):
     """Test cases for main function and command line interface."""
     